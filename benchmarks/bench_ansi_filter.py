@@ -0,0 +1,112 @@
+"""throughput of the ANSI filter used for the scripted shell output
+
+Synthetic terminal streams in the style of ``top`` (full screen redraws,
+colors) and ``vim`` (cursor movement, window titles, multibyte text) are fed
+in reads of ``--chunk-size`` bytes. A captured stream (e.g. recorded with
+``script -q /dev/null``) can be passed with ``--capture``.
+
+The ``legacy`` cases use the previous per-chunk regex compile and decode,
+with ``errors='replace'`` since a strict decode fails on split characters.
+"""
+import random
+import re
+import time
+
+from common import parser, report  # sets up sys.path
+
+from ssh_mitm_plugins.ssh.ansi import AnsiFilter
+
+
+def top_stream(size):
+    rnd = random.Random(1)
+    frames = []
+    length = 0
+    while length < size:
+        lines = [b'\x1b[H\x1b[1mtop - 12:00:00 up 1 day,  2 users,  load average: 0.42, 0.37, 0.30\x1b[m\x1b[K']
+        lines.append(b'\x1b[7m  PID USER      PR  NI    VIRT    RES  %CPU  %MEM     TIME+ COMMAND \x1b[m\x1b[K')
+        for row in range(40):
+            lines.append(
+                b'\x1b[%d;1H\x1b[1m%5d\x1b[m root      20   0 %7d %6d %5.1f %5.1f   0:%02d.%02d \x1b[1;32mworker/%d\x1b[m\x1b[K' % (
+                    row + 3, rnd.randint(1, 99999), rnd.randint(1000, 9999999), rnd.randint(100, 99999),
+                    rnd.random() * 100, rnd.random() * 10, rnd.randint(0, 59), rnd.randint(0, 99), row
+                )
+            )
+        frame = b'\r\n'.join(lines) + b'\x1b[J'
+        frames.append(frame)
+        length += len(frame)
+    return b''.join(frames)
+
+
+def vim_stream(size):
+    rnd = random.Random(2)
+    words = ['über', 'naïve', 'ελληνικά', 'кириллица', '日本語', 'emoji 🙂', 'plain', 'ascii', 'text', '│', '─']
+    parts = [b'\x1b[?1049h\x1b[22;0;0t\x1b[?1h\x1b=\x1b[H\x1b[2J\x1b]0;file.txt - VIM\x07']
+    length = 0
+    while length < size:
+        row = rnd.randint(1, 50)
+        text = ' '.join(rnd.choice(words) for _ in range(rnd.randint(3, 15))).encode()
+        part = b'\x1b[%d;1H\x1b[38;5;%dm%s\x1b[0m\x1b[K\x1b[?25l\x1b(B\x1b[?25h' % (row, rnd.randint(0, 255), text)
+        if rnd.random() < 0.05:
+            part += b'\x1b]2;file.txt + (~/src) - VIM\x1b\\'
+        parts.append(part)
+        length += len(part)
+    return b''.join(parts)
+
+
+def legacy_stdout(text):
+    # previous SSHScriptedForwarder.stdout
+    def escape_ansi(line):
+        ansi_escape = re.compile(r'(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]')
+        return ansi_escape.sub('', line)
+    return escape_ansi(text.decode('utf-8', errors='replace'))
+
+
+def run_legacy(chunks):
+    return ''.join(legacy_stdout(chunk) for chunk in chunks)
+
+
+def run_filter(chunks):
+    ansi_filter = AnsiFilter()
+    return ''.join(ansi_filter.decode(chunk) for chunk in chunks) + ansi_filter.flush()
+
+
+def measure(function, chunks, rounds):
+    total = sum(len(chunk) for chunk in chunks)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(chunks)
+        samples.append(time.perf_counter() - start)
+    best = min(samples)
+    return {'rounds': rounds, 'bytes': total, 'best_ms': best * 1000, 'mb_per_s': total / best / 1e6}
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--size', type=int, default=8 * 1024 * 1024, help='bytes per synthetic stream')
+    p.add_argument('--chunk-size', type=int, default=4096, help='bytes per simulated read')
+    p.add_argument('--capture', action='append', default=[], help='captured terminal stream to include')
+    args = p.parse_args()
+
+    streams = {'top': top_stream(args.size), 'vim': vim_stream(args.size)}
+    for path in args.capture:
+        with open(path, 'rb') as f:
+            streams[path] = f.read()
+
+    results = {}
+    for name, stream in streams.items():
+        chunks = [stream[i:i + args.chunk_size] for i in range(0, len(stream), args.chunk_size)]
+        # reads must not change the result
+        expected = run_filter([stream])
+        filtered = run_filter(chunks)
+        if filtered != expected:
+            raise AssertionError("filter output of %s depends on the read boundaries" % name)
+        results[name + '-legacy'] = measure(run_legacy, chunks, args.rounds)
+        results[name + '-filter'] = measure(run_filter, chunks, args.rounds)
+        results[name + '-legacy']['replaced_chars'] = run_legacy(chunks).count('�')
+        results[name + '-filter']['replaced_chars'] = filtered.count('�')
+    report("ansi filter throughput (%d byte reads)" % args.chunk_size, results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
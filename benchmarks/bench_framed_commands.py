@@ -0,0 +1,107 @@
+"""automated queries through the stealth shell with marker-framed output
+
+``sequential`` injects one command at a time with ``inject_command`` and
+waits for its result, ``pipelined`` queues all commands at once and
+``commented`` queues commands ending with a ``# comment``. The
+results are collected with a callback, ``leaked_bytes`` is the output of
+the queries (markers included) which reached the victim. ``parser`` feeds
+``--size`` bytes of victim output through ``OutputFramer`` while a command
+is waiting for its markers.
+"""
+import threading
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import PROMPT, StandInServer, plugin_args, read_until, start_forwarder
+
+import paramiko
+
+from ssh_mitm_plugins.ssh.framing import OutputFramer
+from ssh_mitm_plugins.ssh.stealthshell import SSHStealthForwarder
+
+
+def drain(channel, received):
+    try:
+        while True:
+            data = channel.recv(65536)
+            if not data:
+                return
+            received.append(data)
+    except (OSError, EOFError, paramiko.SSHException):
+        pass
+
+
+def wait_for(results, count, timeout=30):
+    deadline = time.monotonic() + timeout
+    while len(results) < count and time.monotonic() < deadline:
+        time.sleep(0.0005)
+
+
+def measure(standin_server, rounds, pipelined, suffix=''):
+    session, forwarder, thread = start_forwarder(SSHStealthForwarder, standin_server)
+    read_until(session.victim_channel, PROMPT)
+    results = []
+    # the first injection lets the stealth shell learn the prompt
+    forwarder.inject_command('echo warmup', on_result=results.append)
+    wait_for(results, 1)
+    received = []
+    threading.Thread(target=drain, args=(session.victim_channel, received), daemon=True).start()
+
+    samples = []
+    started = time.perf_counter()
+    if pipelined:
+        for index in range(rounds):
+            forwarder.inject_command('echo query-{}{}'.format(index, suffix), on_result=results.append)
+        wait_for(results, rounds + 1)
+    else:
+        for index in range(rounds):
+            sent = time.perf_counter()
+            forwarder.inject_command('echo query-{}'.format(index), on_result=results.append)
+            wait_for(results, index + 2)
+            samples.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - started
+    session.close()
+    thread.join(5)
+
+    answered = sum(1 for result in results[1:] if result.complete and result.text().startswith('query-'))
+    result = {'query_' + key: value for key, value in summarize(samples).items() if key != 'rounds'} if samples else {}
+    result.update({
+        'queries_per_s': rounds / elapsed,
+        'failed': rounds - answered,
+        'leaked_bytes': sum(len(data) for data in received),
+    })
+    return result
+
+
+def parser_throughput(size):
+    framer = OutputFramer()
+    framer.wrap('sleep 1')
+    chunk = (b'x' * 79 + b'\n') * 400
+    rounds = max(1, size // len(chunk))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        framer.feed(chunk, len)
+    elapsed = time.perf_counter() - started
+    return {'feed_mb_per_s': rounds * len(chunk) / elapsed / 1e6, 'feed_us': elapsed / rounds * 1e6}
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.set_defaults(rounds=50)
+    p.add_argument('--size', type=int, default=64000000, help='bytes of victim output fed to the parser')
+    args = p.parse_args()
+
+    plugin_args('--ssh-injector-key-type', 'ed25519')
+    standin_server = StandInServer()
+    results = {
+        'sequential': measure(standin_server, args.rounds, False),
+        'pipelined': measure(standin_server, args.rounds, True),
+        'commented': measure(standin_server, args.rounds, True, ' # a comment'),
+        'parser': parser_throughput(args.size),
+    }
+    standin_server.close()
+    report('framed command injection', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""cost of the forwarder hook instrumentation
+
+Measures the keystroke round trip of the victim session and the time of an
+idle ``forward_stdout`` call (nothing to read, the common case of the 10ms
+forwarder loop) with and without ``--ssh-hook-metrics``, and prints what the
+instrumentation recorded for the hooks of the instrumented sessions.
+"""
+import os
+import tempfile
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import PROMPT, StandInServer, plugin_args, read_until, start_forwarder
+
+from ssh_mitm_plugins.ssh.hookmetrics import HookMetrics
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+from ssh_mitm_plugins.ssh.stealthshell import SSHStealthForwarder
+
+
+IDLE_CALLS = 100000
+
+
+def measure(forwarder_class, standin_server, rounds):
+    session, forwarder, thread = start_forwarder(forwarder_class, standin_server)
+    read_until(session.victim_channel, PROMPT)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        session.victim_channel.sendall(b'a')
+        read_until(session.victim_channel, b'a')
+        samples.append(time.perf_counter() - start)
+    result = summarize(samples)
+
+    # the forwarder loop calls the hook concurrently, which only adds noise
+    start = time.perf_counter()
+    for _ in range(IDLE_CALLS):
+        forwarder.forward_stdout()
+    result['idle_call_us'] = (time.perf_counter() - start) / IDLE_CALLS * 1e6
+    session.close()
+    thread.join(5)
+    return result
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    args = p.parse_args()
+    standin_server = StandInServer()
+    metrics_file = os.path.join(tempfile.mkdtemp(), 'hooks.prom')
+
+    results = {}
+    for name, forwarder_class in (('injector', SSHInjectableForwarder), ('stealth', SSHStealthForwarder)):
+        plugin_args('--ssh-injector-key-type', 'ed25519')
+        results[name] = measure(forwarder_class, standin_server, args.rounds)
+        plugin_args('--ssh-injector-key-type', 'ed25519', '--ssh-hook-metrics', metrics_file)
+        results[name + '-metrics'] = measure(forwarder_class, standin_server, args.rounds)
+    standin_server.close()
+    report('forwarder hook instrumentation', results, args.json_out)
+
+    recorded = {}
+    for metric in HookMetrics.collect():
+        for labels, value in metric.samples:
+            if metric.kind == 'histogram':
+                continue
+            key = '{plugin} {hook}'.format(**labels)
+            recorded.setdefault(key, {})[metric.name.replace('ssh_mitm_hook_', '')] = value
+    report('recorded hook metrics', recorded)
+
+
+if __name__ == '__main__':
+    main()
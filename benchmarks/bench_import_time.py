@@ -0,0 +1,81 @@
+"""import time of the plugin modules, measured with ``python -X importtime``
+
+ssh-mitm imports every registered plugin module at startup to list them in
+``--help``, whether the plugin is used or not. Every case imports the
+forwarder base classes of ssh-mitm first, which ssh-mitm has loaded anyway,
+so ``import_ms`` is the cost a plugin module adds to the startup of
+ssh-mitm. ``entrypoints`` imports all registered plugins, ``ssh-mitm`` is
+the base import for comparison.
+"""
+import compileall
+import os
+import statistics
+import subprocess
+import sys
+
+from common import parser, report  # sets up sys.path
+
+from ssh_mitm_plugins.__entrypoints__ import entry_points
+
+
+BASE_MODULES = (
+    'ssh_proxy_server.forwarders.ssh',
+    'ssh_proxy_server.forwarders.tunnel',
+    'ssh_proxy_server.plugins.session.tcpserver',
+)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def plugin_modules():
+    """(name, module) of the registered plugins"""
+    for group in entry_points.values():
+        for entry_point in group:
+            name, target = [part.strip() for part in entry_point.split('=')]
+            yield name.replace('plugin-', ''), target.split(':')[0]
+
+
+def import_time(modules, base=BASE_MODULES):
+    """microseconds the import of ``modules`` took and the number of modules it loaded"""
+    code = "import {}\nimport {}".format(', '.join(base), ', '.join(modules)) if base else "import " + ', '.join(modules)
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONWARNINGS='ignore')
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE, env=env, universal_newlines=True, check=True
+    ).stderr
+    lines = [line for line in output.splitlines() if line.startswith('import time:') and 'self [us]' not in line]
+    # the base modules are the first top level imports, everything after belongs to the measured modules
+    measured = lines
+    if base:
+        last_base = max(i for i, line in enumerate(lines) if line.split('|')[2].strip() in base)
+        measured = lines[last_base + 1:]
+    total = sum(int(line.split('|')[0].split(':')[1]) for line in measured)
+    return total, len(measured)
+
+
+def measure(modules, rounds, base=BASE_MODULES):
+    samples = [import_time(modules, base) for _ in range(rounds)]
+    return {
+        'import_ms': statistics.median(total for total, _ in samples) / 1000,
+        'modules': samples[-1][1],
+    }
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.set_defaults(rounds=5)
+    args = p.parse_args()
+
+    # fill the bytecode caches, the first import after a change compiles the sources
+    compileall.compile_dir(os.path.join(ROOT, 'ssh_mitm_plugins'), quiet=1)
+
+    results = {'ssh-mitm': measure(BASE_MODULES, args.rounds, base=())}
+    modules = []
+    for name, module in plugin_modules():
+        modules.append(module)
+        results[name] = measure([module], args.rounds)
+    results['entrypoints'] = measure(modules, args.rounds)
+    report('plugin import time', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
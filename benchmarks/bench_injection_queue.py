@@ -0,0 +1,115 @@
+"""victim keystrokes while an injector shell pastes a large input
+
+An injector shell pastes ``--paste`` bytes, faster than the stand-in shell
+consumes them, while the victim keeps typing. ``keystroke_*`` is the time a
+victim keystroke waits in the input queue of the forwarder until it is sent
+to the server, ``max_queued_kb`` the peak size of the queue. The ``fifo``
+case puts the victim's input behind the injected input in one unbounded
+queue, like the plain ``queue.Queue`` the injector shell used before.
+"""
+import threading
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import PROMPT, StandInServer, attach_injector, injector_address, plugin_args, read_until, start_forwarder
+
+import paramiko
+
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+from ssh_mitm_plugins.ssh.inputqueue import InjectionQueue
+
+
+MARKER = b'\x01'
+
+
+def drain(channel):
+    try:
+        while channel.recv(65536):
+            pass
+    except (OSError, EOFError, paramiko.SSHException):
+        pass
+
+
+def record_dispatch(forwarder, dispatched):
+    """remember when input containing the marker was sent to the server"""
+    sendall = forwarder.server_channel.sendall
+
+    def recording_sendall(data):
+        if MARKER in data:
+            dispatched.append(time.perf_counter())
+        return sendall(data)
+    forwarder.server_channel.sendall = recording_sendall
+
+
+def measure(standin_server, paste_size, rounds, fifo=False):
+    session, forwarder, thread = start_forwarder(SSHInjectableForwarder, standin_server)
+    read_until(session.victim_channel, PROMPT)
+    if fifo:
+        forwarder.queue.put_client = forwarder.queue.put
+    dispatched = []
+    record_dispatch(forwarder, dispatched)
+    injector = attach_injector(injector_address(forwarder), forwarder.injector_name)
+    read_until(injector, b'CTRL+C')
+    threading.Thread(target=drain, args=(injector,), daemon=True).start()
+    threading.Thread(target=drain, args=(session.victim_channel,), daemon=True).start()
+
+    paste = (b'x' * 79 + b'\r') * (paste_size // 80)
+    started = time.perf_counter()
+    paster = threading.Thread(target=injector.sendall, args=(paste,), daemon=True)
+    paster.start()
+    time.sleep(0.05)
+    samples = []
+    for _ in range(rounds):
+        sent = time.perf_counter()
+        session.victim_channel.sendall(MARKER)
+        deadline = time.monotonic() + 60
+        while len(dispatched) <= len(samples) and time.monotonic() < deadline:
+            time.sleep(0.0005)
+        if len(dispatched) > len(samples):
+            samples.append(dispatched[len(samples)] - sent)
+        time.sleep(0.02)
+    paster.join(120)
+    while not forwarder.queue.empty() and time.perf_counter() - started < 120:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    stats = forwarder.queue.stats()
+    injector.get_transport().close()
+    session.close()
+    thread.join(5)
+
+    result = {'keystroke_' + key: value for key, value in summarize(samples).items() if key != 'rounds'}
+    result.update({
+        'paste_s': elapsed,
+        'max_queued_kb': stats['max_size'] / 1000,
+        'blocked': stats['blocked'],
+        'coalesced': stats['coalesced'],
+    })
+    return result
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.set_defaults(rounds=20)
+    p.add_argument('--paste', type=int, default=262144, help='bytes pasted by the injector shell')
+    args = p.parse_args()
+
+    standin_server = StandInServer()
+    cases = (
+        ('fifo', str(1 << 40), True),
+        ('bounded-1m', str(InjectionQueue().max_bytes), False),
+        ('bounded-64k', '65536', False),
+    )
+    results = {}
+    for name, queue_bytes, fifo in cases:
+        plugin_args(
+            '--ssh-injector-key-type', 'ed25519',
+            '--ssh-injector-queue-bytes', queue_bytes,
+            '--ssh-injector-queue-entries', str(1 << 30) if fifo else '1024'
+        )
+        results[name] = measure(standin_server, args.paste, args.rounds, fifo)
+    standin_server.close()
+    report('injection queue under a paste', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
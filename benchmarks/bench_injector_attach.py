@@ -0,0 +1,115 @@
+"""time-to-shell for injector attaches
+
+``legacy-rsa`` is the previous handshake, which loaded the moduli and
+generated a rsa key for every attach. The other cases attach injector
+clients to an injector shell session through the shared
+``InjectorListener``, which serves one host key per address and measure
+until the banner of the injector shell arrived. ``first_session_ms`` is the
+start of the session which binds the address and generates the host key of
+the case (or loads it from a file).
+"""
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import StandInServer, attach_injector, injector_address, plugin_args, read_until, start_forwarder
+
+import paramiko
+from ssh_proxy_server.plugins.ssh.mirrorshell import InjectServer
+
+from ssh_mitm_plugins.ssh.hostkeys import generate_host_key, load_server_moduli
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+
+
+def legacy_key():
+    paramiko.Transport.load_server_moduli()
+    return paramiko.RSAKey.generate(bits=2048)
+
+
+def serve(listener, key_factory, rounds, channels):
+    for _ in range(rounds):
+        client, _ = listener.accept()
+        t = paramiko.Transport(client)
+        t.add_server_key(key_factory())
+        t.start_server(server=InjectServer(paramiko.Channel(0)))
+        channel = None
+        while not channel:
+            channel = t.accept(0.5)
+        channels.append(channel)
+
+
+def attach(port):
+    start = time.perf_counter()
+    client = paramiko.Transport(socket.create_connection(('127.0.0.1', port)))
+    client.start_client()
+    client.auth_none('bench')
+    client.open_session().invoke_shell()
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+
+def legacy(rounds):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    # paramiko only keeps weak references to channels
+    channels = []
+    server = threading.Thread(target=serve, args=(listener, legacy_key, rounds, channels), daemon=True)
+    server.start()
+    samples = [attach(listener.getsockname()[1]) for _ in range(rounds)]
+    server.join()
+    listener.close()
+    return summarize(samples)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def listener_case(standin_server, key_args, rounds):
+    # a new address, so the case binds it with its own host key
+    plugin_args('--ssh-injector-port', str(free_port()), *key_args)
+    started = time.perf_counter()
+    session, forwarder, thread = start_forwarder(SSHInjectableForwarder, standin_server)
+    first_session = time.perf_counter() - started
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        channel = attach_injector(injector_address(forwarder), forwarder.injector_name)
+        read_until(channel, b'CTRL+C')
+        samples.append(time.perf_counter() - started)
+        channel.get_transport().close()
+    session.close()
+    thread.join(5)
+    result = summarize(samples)
+    result['first_session_ms'] = first_session * 1000
+    return result
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    args = p.parse_args()
+
+    key_file = os.path.join(tempfile.mkdtemp(), 'injector_key')
+    generate_host_key('rsa').write_private_key_file(key_file)
+    # loaded once per process, not part of the first session of a case
+    load_server_moduli()
+
+    results = {'legacy-rsa': legacy(args.rounds)}
+    standin_server = StandInServer()
+    cases = [('keyfile', ('--ssh-injectshell-key', key_file))]
+    cases += [(key_type, ('--ssh-injector-key-type', key_type)) for key_type in ('rsa', 'ecdsa', 'ed25519')]
+    for name, key_args in cases:
+        results[name] = listener_case(standin_server, key_args, args.rounds)
+    standin_server.close()
+    report('injector attach time-to-shell', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
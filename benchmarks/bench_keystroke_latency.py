@@ -0,0 +1,82 @@
+"""per-keystroke round trip through an injector shell
+
+A keystroke typed in an attached injector shell travels through the plugin
+forwarder to the stand-in server, which echoes it back the way a tty does.
+The ``polling`` cases run every shell in its own thread with the previous
+recv_ready/sleep loop for comparison with the shared shell pool.
+"""
+import threading
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import PROMPT, StandInServer, attach_injector, injector_address, plugin_args, read_until, start_forwarder
+
+import paramiko
+
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+from ssh_mitm_plugins.ssh.shellpool import ShellPool
+from ssh_mitm_plugins.ssh.stealthshell import SSHStealthForwarder
+
+
+def polling_admit(pool, shell):
+    """serve the shell from its own thread with the previous recv_ready/sleep loop"""
+    def poll():
+        try:
+            if not shell.open():
+                return
+            while not shell.forwarder.session.ssh_channel.closed:
+                if shell.client_channel.recv_ready() and not shell.serve():
+                    break
+                if shell.client_channel.exit_status_ready():
+                    break
+                time.sleep(0.1)
+        except paramiko.SSHException:
+            pass
+        finally:
+            shell.terminate()
+    threading.Thread(target=poll, daemon=True).start()
+    return True
+
+
+def measure(forwarder_class, standin_server, rounds):
+    session, forwarder, thread = start_forwarder(forwarder_class, standin_server)
+    read_until(session.victim_channel, PROMPT)
+    injector = attach_injector(injector_address(forwarder), forwarder.injector_name)
+    read_until(injector, b'CTRL+C')
+    injector.sendall(b'\r')
+    read_until(injector, PROMPT)
+
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        injector.sendall(b'a')
+        read_until(injector, b'a')
+        samples.append(time.perf_counter() - start)
+    injector.get_transport().close()
+    session.close()
+    thread.join(5)
+    return summarize(samples)
+
+
+def main():
+    args = parser(__doc__).parse_args()
+    plugin_args('--ssh-injector-key-type', 'ed25519')
+    standin_server = StandInServer()
+
+    cases = (
+        ('injector', SSHInjectableForwarder),
+        ('stealth', SSHStealthForwarder),
+    )
+    results = {}
+    for name, forwarder_class in cases:
+        pool_admit = ShellPool.admit
+        ShellPool.admit = polling_admit
+        results[name + '-polling'] = measure(forwarder_class, standin_server, args.rounds)
+        ShellPool.admit = pool_admit
+        results[name + '-pool'] = measure(forwarder_class, standin_server, args.rounds)
+    standin_server.close()
+    report('injector keystroke round trip', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
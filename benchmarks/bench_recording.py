@@ -0,0 +1,168 @@
+"""cost of recording a session and of seeking in a long recording
+
+``hot-path`` is the time the forwarder thread spends per 16 KB chunk of
+output with debug logging off: formatting the chunk for the old debug log,
+the lazy debug log and queueing the chunk with ``SessionRecorder``.
+``session`` records a stealth shell session with an injected command and
+checks that the frames of the client, server and injector come back.
+``writer`` records ``--size`` bytes and measures until the recording is
+closed. ``seek-*`` opens a synthetic recording of an eight hour session
+(``--size`` bytes) and jumps to random timestamps and to the injected
+commands, ``seek-scan`` walks the frames from the start instead.
+"""
+import logging
+import os
+import random
+import tempfile
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import PROMPT, StandInServer, plugin_args, read_until, start_forwarder
+
+from ssh_mitm_plugins.ssh.recording import (
+    FRAME, SOURCE_CLIENT, SOURCE_INJECTOR, SOURCE_SERVER, TO_CLIENT, TO_SERVER, SessionRecorder, SessionRecording
+)
+from ssh_mitm_plugins.ssh.stealthshell import SSHStealthForwarder
+
+
+CHUNK = (b'x' * 79 + b'\n') * 200
+
+
+def per_call(function, rounds=100000):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return {'per_chunk_us': (time.perf_counter() - started) / rounds * 1e6}
+
+
+def hot_path(directory):
+    logging.getLogger().setLevel(logging.INFO)
+    recorder = SessionRecorder(os.path.join(directory, 'hot-path.sshrec'), 'hot-path')
+    results = {
+        'hot-path-str-log': per_call(lambda: logging.debug("Server:" + str(CHUNK))),
+        'hot-path-lazy-log': per_call(lambda: logging.debug("Server: %r", CHUNK)),
+        # stays below the bound of queued bytes, dropped chunks would be cheaper
+        'hot-path-recorder': per_call(lambda: recorder.output(CHUNK, True), 2000),
+    }
+    recorder.close()
+    recorder.done.wait()
+    return results
+
+
+def session(directory, standin_server):
+    plugin_args('--ssh-injector-key-type', 'ed25519', '--ssh-injector-record', directory)
+    session, forwarder, thread = start_forwarder(SSHStealthForwarder, standin_server)
+    read_until(session.victim_channel, PROMPT)
+    session.victim_channel.sendall(b'echo from-client\r')
+    read_until(session.victim_channel, b'from-client\r\n' + PROMPT)
+    results = []
+    forwarder.inject_command('echo from-injector', on_result=results.append)
+    deadline = time.monotonic() + 10
+    while not results and time.monotonic() < deadline:
+        time.sleep(0.001)
+    session.close()
+    thread.join(5)
+    forwarder.recorder.done.wait(5)
+
+    with SessionRecording(forwarder.recorder.path) as recording:
+        sources = [0, 0, 0]
+        for frame in recording.frames():
+            sources[frame.source] += len(frame.data)
+        injected = [frame.data for frame in recording.injected_frames()]
+        return {
+            'client_bytes': sources[SOURCE_CLIENT],
+            'server_bytes': sources[SOURCE_SERVER],
+            'injector_bytes': sources[SOURCE_INJECTOR],
+            'injected_commands': sum(1 for data in injected if b'from-injector' in data),
+            'complete': int(recording.complete),
+        }
+
+
+def writer(directory, size):
+    recorder = SessionRecorder(os.path.join(directory, 'writer.sshrec'), 'writer')
+    rounds = max(1, size // len(CHUNK))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        # measures the writer thread, so the queue is kept from running full
+        while recorder.pending > SessionRecorder.MAX_PENDING // 2:
+            time.sleep(0.001)
+        recorder.output(CHUNK, True)
+    recorder.close()
+    recorder.done.wait()
+    elapsed = time.perf_counter() - started
+    return {
+        'mb_per_s': rounds * len(CHUNK) / elapsed / 1e6,
+        'overhead_pct': (os.path.getsize(recorder.path) / (rounds * len(CHUNK)) - 1) * 100,
+        'dropped': recorder.dropped,
+    }
+
+
+def synthetic_recording(directory, size):
+    """an eight hour session with an injected command every minute, written without the writer thread"""
+    recorder = SessionRecorder(os.path.join(directory, 'synthetic.sshrec'), 'synthetic')
+    rounds = max(1, size // len(CHUNK))
+    start = time.time()
+    step = 8 * 3600.0 / rounds
+    next_command = start
+    for index in range(rounds):
+        timestamp = start + index * step
+        if timestamp >= next_command:
+            recorder.write(timestamp, SOURCE_INJECTOR, TO_SERVER, b'id\r')
+            next_command += 60
+        recorder.write(timestamp, SOURCE_SERVER, TO_CLIENT, CHUNK)
+    recorder.finish()
+    return recorder.path, start, start + 8 * 3600.0
+
+
+def scan(recording, timestamp):
+    offset = recording.start
+    while offset < recording.end:
+        frame_time, _, _, length = FRAME.unpack_from(recording.map, offset)
+        if frame_time >= timestamp:
+            break
+        offset += FRAME.size + length
+    return offset
+
+
+def seek(path, start, end, rounds):
+    started = time.perf_counter()
+    recording = SessionRecording(path)
+    opened = time.perf_counter() - started
+    targets = [random.uniform(start, end) for _ in range(rounds)]
+    results = {}
+    for name, function in (('seek-index', recording.seek), ('seek-scan', lambda t: scan(recording, t))):
+        samples = []
+        for timestamp in targets:
+            sample_start = time.perf_counter()
+            function(timestamp)
+            samples.append(time.perf_counter() - sample_start)
+        results[name] = summarize(samples)
+    samples = []
+    for offset in random.sample(recording.injected, min(rounds, len(recording.injected))):
+        sample_start = time.perf_counter()
+        list(recording.frames(offset=offset, end=recording.frame_at(offset).timestamp + 1))
+        samples.append(time.perf_counter() - sample_start)
+    results['seek-command'] = summarize(samples)
+    results['seek-index']['open_ms'] = opened * 1000
+    recording.close()
+    return results
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--size', type=int, default=256000000, help='bytes of output in the writer and seek cases')
+    args = p.parse_args()
+
+    standin_server = StandInServer()
+    with tempfile.TemporaryDirectory() as directory:
+        results = hot_path(directory)
+        results['session'] = session(directory, standin_server)
+        results['writer'] = writer(directory, args.size)
+        path, start, end = synthetic_recording(directory, args.size)
+        results.update(seek(path, start, end, args.rounds))
+    standin_server.close()
+    report('session recording', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
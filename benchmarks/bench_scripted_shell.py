@@ -0,0 +1,86 @@
+"""wall time of a script run by the scripted shell on concurrent sessions
+
+Every case starts ``--sessions`` sessions against the stand-in server at
+once and measures until all of them finished the script. ``line`` is the
+original one line per forwarder tick mode, ``prompt`` waits for the prompt
+after each command and ``marker-N`` pipelines N commands between markers.
+"""
+import os
+import tempfile
+import time
+
+from common import parser, report  # sets up sys.path
+from standin import StandInServer, plugin_args, start_forwarder
+
+from ssh_mitm_plugins.ssh.scriptedshell import SSHScriptedForwarder
+
+
+def write_script(path, commands, bulk):
+    with open(path, 'w') as f:
+        f.write("#!/bin/sh\n# generated by bench_scripted_shell\n")
+        for index in range(commands):
+            if index % 10 == 9:
+                f.write("bulk {}\n".format(bulk))
+            elif index % 10 == 4:
+                f.write("false\n")
+            else:
+                f.write("echo command {}\n".format(index))
+
+
+def run_sessions(standin_server, script, out_dir, mode, batch_size, sessions, timeout):
+    plugin_args(
+        '--ssh-script', script,
+        '--ssh-out-dir', out_dir,
+        '--ssh-script-mode', mode,
+        '--ssh-script-batch-size', str(batch_size),
+    )
+    started = time.monotonic()
+    running = [start_forwarder(SSHScriptedForwarder, standin_server) for _ in range(sessions)]
+    deadline = started + timeout
+    while not all(forwarder.finished for _, forwarder, _ in running):
+        if time.monotonic() > deadline:
+            raise TimeoutError("script did not finish in {}s ({} mode)".format(timeout, mode))
+        time.sleep(0.005)
+    elapsed = time.monotonic() - started
+    results = [forwarder.execution.results for _, forwarder, _ in running if forwarder.execution is not None]
+    for session, _, thread in running:
+        session.close()
+        thread.join(5)
+    return elapsed, results
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--sessions', type=int, default=10, help='concurrent sessions per case')
+    p.add_argument('--commands', type=int, default=200, help='commands in the generated script')
+    p.add_argument('--bulk', type=int, default=20000, help='output bytes of every tenth command')
+    p.add_argument('--timeout', type=float, default=300, help='seconds a case may take')
+    args = p.parse_args()
+
+    cases = [('line', 'line', 1), ('prompt', 'prompt', 1), ('marker-1', 'marker', 1), ('marker-16', 'marker', 16)]
+    standin_server = StandInServer()
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        script = os.path.join(out_dir, 'script.sh')
+        write_script(script, args.commands, args.bulk)
+        for name, mode, batch_size in cases:
+            samples = []
+            complete = 0
+            for _ in range(max(1, args.rounds // 10)):
+                elapsed, executions = run_sessions(
+                    standin_server, script, out_dir, mode, batch_size, args.sessions, args.timeout
+                )
+                samples.append(elapsed)
+                complete = sum(result.complete for execution in executions for result in execution)
+            results[name] = {
+                'sessions': args.sessions,
+                'commands': args.commands,
+                'best_s': min(samples),
+                'complete_commands': complete if mode != 'line' else '',
+            }
+    standin_server.close()
+    report("scripted shell wall time", results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""time until a late joining injector shell sees the recent session output
+
+The victim prints ``--history`` bytes followed by a marker line before an
+injector shell attaches with mirroring enabled. ``context_*`` is the time
+from the attach until the marker shows up on the injector shell. Without a
+scrollback the injector shell has to run the command again to see it, with
+``--ssh-injector-scrollback`` the recorded output is replayed right after
+the banner.
+"""
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import PROMPT, StandInServer, attach_injector, injector_address, plugin_args, read_until, start_forwarder
+
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+
+
+MARKER = b'scrollback-marker'
+
+
+def measure(standin_server, history, rounds, replay):
+    session, forwarder, thread = start_forwarder(SSHInjectableForwarder, standin_server)
+    read_until(session.victim_channel, PROMPT)
+    session.victim_channel.sendall('bulk {}\r'.format(history).encode())
+    read_until(session.victim_channel, PROMPT, timeout=60)
+    session.victim_channel.sendall(b'echo ' + MARKER + b'\r')
+    read_until(session.victim_channel, MARKER + b'\r\n' + PROMPT)
+    address = injector_address(forwarder)
+
+    samples = []
+    received = 0
+    for _ in range(rounds):
+        started = time.perf_counter()
+        injector = attach_injector(address, forwarder.injector_name)
+        if not replay:
+            read_until(injector, b'CTRL+C')
+            injector.sendall(b'echo ' + MARKER + b'\r')
+        data = read_until(injector, MARKER + b'\r\n', timeout=60)
+        samples.append(time.perf_counter() - started)
+        received += len(data)
+        injector.get_transport().close()
+    session.close()
+    thread.join(5)
+
+    result = {'context_' + key: value for key, value in summarize(samples).items() if key != 'rounds'}
+    result['received_kb'] = received / rounds / 1000
+    return result
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--history', type=int, default=32768, help='bytes printed before the injector shell attaches')
+    args = p.parse_args()
+
+    standin_server = StandInServer()
+    cases = (
+        ('rerun-command', '0'),
+        ('scrollback-64k', '65536'),
+    )
+    results = {}
+    for name, scrollback in cases:
+        plugin_args(
+            '--ssh-injector-key-type', 'ed25519',
+            '--ssh-injector-enable-mirror',
+            '--ssh-injector-scrollback', scrollback
+        )
+        results[name] = measure(standin_server, args.history, args.rounds, scrollback != '0')
+    standin_server.close()
+    report('scrollback replay for late joining injector shells', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""shell output throughput of every ssh forwarder plugin
+
+Every forwarder registered for ``SSHBaseForwarder`` in ``__entrypoints__``
+forwards ``--size`` bytes of shell output from the stand-in server to the
+victim client, ``--rounds`` times. The ``mirror-N`` cases of the injector
+and stealth shell additionally mirror the output to N attached injector
+shells, which read it as fast as they can. ``writes_per_mb`` counts the
+writes of the forwarder to the victim channel.
+"""
+import importlib
+import os
+import tempfile
+import threading
+import time
+
+from common import parser, report  # sets up sys.path
+from standin import PROMPT, StandInServer, attach_injector, injector_address, plugin_args, read_until, start_forwarder
+
+import paramiko
+
+from ssh_mitm_plugins.__entrypoints__ import entry_points
+
+
+def ssh_plugins():
+    """(name, class) of the registered ssh forwarder plugins"""
+    for entry_point in entry_points['SSHBaseForwarder']:
+        name, target = [part.strip() for part in entry_point.split('=')]
+        module, class_name = target.split(':')
+        yield name.replace('plugin-', ''), getattr(importlib.import_module(module), class_name)
+
+
+def drain(channel, received):
+    try:
+        while True:
+            data = channel.recv(65536)
+            if not data:
+                return
+            received[0] += len(data)
+    except (OSError, EOFError, paramiko.SSHException):
+        pass
+
+
+def transfer(channel, size):
+    """request ``size`` bytes of output and return the seconds until they arrived"""
+    started = time.perf_counter()
+    channel.sendall('bulk {}\r'.format(size).encode())
+    received = 0
+    tail = b''
+    while received < size or PROMPT not in tail:
+        data = channel.recv(1048576)
+        if not data:
+            raise RuntimeError("session closed during the transfer")
+        received += len(data)
+        tail = (tail + data)[-len(PROMPT) - 2:]
+    return time.perf_counter() - started
+
+
+def count_writes(channel, writes):
+    sendall = channel.sendall
+
+    def counting_sendall(data):
+        writes[0] += 1
+        return sendall(data)
+    channel.sendall = counting_sendall
+
+
+def measure(forwarder_class, standin_server, size, rounds, mirrors=0):
+    session, forwarder, thread = start_forwarder(forwarder_class, standin_server)
+    if hasattr(forwarder, 'finished'):
+        # the scripted shell runs its script before the victim gets a prompt
+        deadline = time.monotonic() + 10
+        while not forwarder.finished and time.monotonic() < deadline:
+            time.sleep(0.01)
+    read_until(session.victim_channel, PROMPT)
+    mirror_threads = []
+    mirrored = [0]
+    for _ in range(mirrors):
+        channel = attach_injector(injector_address(forwarder), forwarder.injector_name)
+        read_until(channel, b'CTRL+C')
+        mirror_thread = threading.Thread(target=drain, args=(channel, mirrored), daemon=True)
+        mirror_thread.start()
+        mirror_threads.append((channel, mirror_thread))
+    # wait until the injector shells are subscribed to the mirror
+    time.sleep(0.2 if mirrors else 0)
+    writes = [0]
+    count_writes(session.ssh_channel, writes)
+
+    elapsed = [transfer(session.victim_channel, size) for _ in range(rounds)]
+    for channel, mirror_thread in mirror_threads:
+        channel.get_transport().close()
+        mirror_thread.join(5)
+    session.close()
+    thread.join(5)
+    total = sum(elapsed)
+    result = {
+        'mb_per_s': size * rounds / total / 1e6,
+        'round_ms': total / rounds * 1000,
+        'writes_per_mb': writes[0] / (size * rounds / 1e6),
+    }
+    if mirrors:
+        result['mirrored_mb'] = mirrored[0] / 1e6
+    return result
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.set_defaults(rounds=5)
+    p.add_argument('--size', type=int, default=4000000, help='bytes of shell output per round')
+    p.add_argument('--mirrors', type=int, nargs='*', default=[1, 5], help='numbers of mirrored injector shells')
+    args = p.parse_args()
+
+    script = os.path.join(tempfile.mkdtemp(), 'script.sh')
+    with open(script, 'w') as f:
+        f.write("echo scripted\n")
+    plugin_args(
+        '--ssh-injector-key-type', 'ed25519',
+        '--ssh-injector-enable-mirror',
+        '--ssh-script', script,
+        '--ssh-out-dir', os.path.dirname(script)
+    )
+    standin_server = StandInServer()
+    results = {}
+    for name, forwarder_class in ssh_plugins():
+        results[name] = measure(forwarder_class, standin_server, args.size, args.rounds)
+        if name in ('injectorshell', 'stealthshell'):
+            for mirrors in args.mirrors:
+                results['{}-mirror-{}'.format(name, mirrors)] = measure(
+                    forwarder_class, standin_server, args.size, args.rounds, mirrors
+                )
+    standin_server.close()
+    report('shell output throughput', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
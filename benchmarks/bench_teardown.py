@@ -0,0 +1,93 @@
+"""session teardown latency with attached injector shells
+
+The session channel of the victim is closed on the ssh-mitm side while N
+injector shells are attached to the session. The round trip is the time
+until the forwarder thread finished, which includes waiting for all
+shells, ``leftover_threads`` counts the forwarder thread and the shells of
+the session still running afterwards. The ``tunnel-thread`` case
+closes a session with a client tunnel served by a listener thread and
+measures until that thread stopped.
+"""
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import (
+    EchoServer, PROMPT, StandInServer, StandInTunnelSession, attach_injector, injector_address, plugin_args,
+    read_until, start_forwarder
+)
+
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+from ssh_mitm_plugins.ssh.stealthshell import SSHStealthForwarder
+from ssh_mitm_plugins.tunnel.injectclienttunnel import InjectableClientTunnelForwarder
+
+
+def teardown(forwarder_class, standin_server, shells):
+    session, forwarder, thread = start_forwarder(forwarder_class, standin_server)
+    read_until(session.victim_channel, PROMPT)
+    injectors = []
+    for _ in range(shells):
+        channel = attach_injector(injector_address(forwarder), forwarder.injector_name)
+        read_until(channel, b'CTRL+C')
+        injectors.append(channel)
+    # the shells are admitted after the injector client got its channel
+    deadline = time.monotonic() + 5
+    while len(forwarder.injector_shells) < shells and time.monotonic() < deadline:
+        time.sleep(0.001)
+    attached = list(forwarder.injector_shells)
+
+    started = time.perf_counter()
+    session.ssh_channel.close()
+    thread.join(10)
+    elapsed = time.perf_counter() - started
+    leftover = int(thread.is_alive()) + sum(1 for shell in attached if not shell.finished.is_set())
+    session.close()
+    for channel in injectors:
+        channel.get_transport().close()
+    return elapsed, leftover
+
+
+def tunnel_teardown(standin_server, echo_server):
+    session = StandInTunnelSession(standin_server)
+    handler, = InjectableClientTunnelForwarder.setup_injector(session)
+    listener = handler.server
+    started = time.perf_counter()
+    session.close()
+    listener.join(10)
+    return time.perf_counter() - started, int(listener.is_alive())
+
+
+def measure(run, rounds):
+    samples = []
+    leftover = 0
+    for _ in range(rounds):
+        elapsed, alive = run()
+        samples.append(elapsed)
+        leftover += alive
+    result = summarize(samples)
+    result['leftover_threads'] = leftover
+    return result
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.set_defaults(rounds=10)
+    p.add_argument('--shells', type=int, nargs='+', default=[0, 1, 5], help='numbers of attached injector shells')
+    args = p.parse_args()
+
+    plugin_args('--ssh-injector-key-type', 'ed25519')
+    standin_server = StandInServer()
+    echo_server = EchoServer()
+    results = {}
+    for name, forwarder_class in (('injector', SSHInjectableForwarder), ('stealth', SSHStealthForwarder)):
+        for shells in args.shells:
+            results['{}-{}'.format(name, shells)] = measure(
+                lambda: teardown(forwarder_class, standin_server, shells), args.rounds
+            )
+    plugin_args('--tunnel-client-dest', '{}:{}'.format(*echo_server.address), '--tunnel-client-relay', 'thread')
+    results['tunnel-thread'] = measure(lambda: tunnel_teardown(standin_server, echo_server), args.rounds)
+    standin_server.close()
+    report('session teardown', results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
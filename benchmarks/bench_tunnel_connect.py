@@ -0,0 +1,72 @@
+"""connect latency of short lived connections through an injected client tunnel
+
+Every round connects to the tunnel port, sends one request, reads the echoed
+response and closes the connection, like HTTP/1.0 or DNS over TCP. The
+stand-in server is ``--latency`` seconds away in both directions, so opening
+a direct-tcpip channel costs a round trip. ``--interval`` is the pause between
+connections, which gives the channel pool time to refill.
+"""
+import socket
+import time
+
+from common import parser, report, summarize  # sets up sys.path
+from standin import EchoServer, StandInServer, StandInTunnelSession, plugin_args
+
+from ssh_mitm_plugins.tunnel.injectclienttunnel import InjectableClientTunnelForwarder
+
+
+def request(address, payload):
+    started = time.perf_counter()
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(payload)
+    received = 0
+    while received < len(payload):
+        data = sock.recv(65536)
+        if not data:
+            raise RuntimeError("tunnel closed the connection")
+        received += len(data)
+    sock.close()
+    return time.perf_counter() - started
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--latency', type=float, default=0.01, help='one way delay to the stand-in server in seconds')
+    p.add_argument('--interval', type=float, default=0.05, help='seconds between connections')
+    p.add_argument('--pool-size', type=int, default=4, help='channel pool size of the pooled case')
+    p.add_argument('--relay', default='selector', choices=('thread', 'selector'))
+    args = p.parse_args()
+
+    standin_server = StandInServer(latency=args.latency)
+    echo_server = EchoServer()
+    payload = b'GET / HTTP/1.0\r\n\r\n'
+    results = {}
+    for pool_size in (0, args.pool_size):
+        plugin_args(
+            '--tunnel-client-dest', '{}:{}'.format(*echo_server.address),
+            '--tunnel-client-relay', args.relay,
+            '--tunnel-client-pool-size', str(pool_size)
+        )
+        session = StandInTunnelSession(standin_server)
+        handler, = InjectableClientTunnelForwarder.setup_injector(session)
+        address = handler.address
+        # let the pool fill before measuring
+        time.sleep(2 * args.latency * pool_size + 0.2)
+        samples = []
+        for _ in range(args.rounds):
+            samples.append(request(address, payload))
+            time.sleep(args.interval)
+        result = summarize(samples)
+        if pool_size:
+            stats = handler.pool.stats()
+            result['hit_rate'] = stats['hit_rate']
+            result['saved_ms'] = stats['time_saved_per_connection'] * 1000
+        results['pool-{}'.format(pool_size)] = result
+        session.close()
+    standin_server.close()
+    report("client tunnel connect latency", results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""concurrent connections through an injected client tunnel
+
+``--connections`` clients connect at once to the tunnel port of one session
+and each does ``--round-trips`` request/response exchanges with an echo
+server behind the stand-in ssh server. The clients are driven by one
+selector loop, so the thread count shows what the relay itself needs.
+Connections still open after ``--timeout`` are reported as unfinished,
+connections closed by the tunnel before their last response as failed.
+"""
+import selectors
+import socket
+import time
+
+from common import parser, percentile, report  # sets up sys.path
+from standin import EchoServer, StandInServer, StandInTunnelSession, plugin_args, plugin_threads
+
+from ssh_mitm_plugins.tunnel.injectclienttunnel import InjectableClientTunnelForwarder
+
+
+class Client:
+
+    def __init__(self, address, round_trips, payload):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.sock.connect_ex(address)
+        self.left = round_trips
+        self.payload = payload
+        self.received = 0
+        self.sent_at = None
+        self.connected_at = None
+
+
+def drive(address, connections, round_trips, size, timeout):
+    payload = b'x' * size
+    selector = selectors.DefaultSelector()
+    started = time.monotonic()
+    clients = [Client(address, round_trips, payload) for _ in range(connections)]
+    for client in clients:
+        selector.register(client.sock, selectors.EVENT_WRITE, client)
+    latencies = []
+    first_bytes = []
+    open_clients = len(clients)
+    failed = 0
+    max_threads = plugin_threads()
+    buffer = bytearray(65536)
+    while open_clients:
+        if time.monotonic() - started > timeout:
+            break
+        max_threads = max(max_threads, plugin_threads())
+        for key, mask in selector.select(1):
+            client = key.data
+            if mask & selectors.EVENT_WRITE:
+                client.sock.send(client.payload)
+                client.sent_at = time.monotonic()
+                selector.modify(client.sock, selectors.EVENT_READ, client)
+                continue
+            try:
+                length = client.sock.recv_into(buffer)
+            except ConnectionError:
+                length = 0
+            if not length:
+                failed += 1
+                selector.unregister(client.sock)
+                client.sock.close()
+                open_clients -= 1
+                continue
+            client.received += length
+            if client.received < size:
+                continue
+            now = time.monotonic()
+            if client.connected_at is None:
+                client.connected_at = now
+                first_bytes.append(now - started)
+            latencies.append(now - client.sent_at)
+            client.received = 0
+            client.left -= 1
+            if client.left:
+                client.sock.send(client.payload)
+                client.sent_at = now
+            else:
+                selector.unregister(client.sock)
+                client.sock.close()
+                open_clients -= 1
+    elapsed = time.monotonic() - started
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    return {
+        'connections': connections,
+        'unfinished': open_clients,
+        'failed': failed,
+        'total_s': elapsed,
+        'first_byte_p99_ms': percentile(first_bytes, 99) * 1000,
+        'rtt_p50_ms': percentile(latencies, 50) * 1000,
+        'rtt_p99_ms': percentile(latencies, 99) * 1000,
+        'mb_per_s': 2 * size * len(latencies) / elapsed / 1e6,
+        'max_threads': max_threads,
+    }
+
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--connections', type=int, default=200, help='concurrent tunnel connections')
+    p.add_argument('--round-trips', type=int, default=20, help='request/response exchanges per connection')
+    p.add_argument('--size', type=int, default=512, help='bytes per request')
+    p.add_argument('--timeout', type=float, default=60, help='seconds a case may take')
+    args = p.parse_args()
+
+    standin_server = StandInServer()
+    echo_server = EchoServer()
+    results = {}
+    for mode in ('thread', 'selector'):
+        plugin_args(
+            '--tunnel-client-dest', '{}:{}'.format(*echo_server.address),
+            '--tunnel-client-relay', mode
+        )
+        session = StandInTunnelSession(standin_server)
+        handler, = InjectableClientTunnelForwarder.setup_injector(session)
+        address = handler.address
+        results[mode] = drive(address, args.connections, args.round_trips, args.size, args.timeout)
+        session.close()
+    standin_server.close()
+    report("client tunnel relay", results, args.json_out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""helpers shared by the benchmark scripts
+
+The benchmarks are plain scripts and not part of the installed package.
+Run them from the repository root, e.g. ``python benchmarks/bench_injector_attach.py``,
+or all of them with ``python benchmarks/run.py``.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import warnings
+
+# make the plugins importable when running from a source checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# connections are torn down hard between rounds, which paramiko reports loudly
+logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+warnings.filterwarnings('ignore', module='paramiko')
+
+
+def parser(description):
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('--json', dest='json_out', help='write machine readable results to this file')
+    p.add_argument('--rounds', type=int, default=20, help='number of measured rounds per case')
+    return p
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    """summarize a list of durations in seconds as milliseconds"""
+    return {
+        'rounds': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000 if samples else 0.0,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'max_ms': max(samples) * 1000 if samples else 0.0,
+    }
+
+
+def report(benchmark, results, json_out=None):
+    """print results as a table and optionally store them as json
+
+    ``results`` maps a case name to a dict of numeric metrics.
+    """
+    columns = []
+    for metrics in results.values():
+        for key in metrics:
+            if key not in columns:
+                columns.append(key)
+    width = max([len(name) for name in results] + [4])
+    print(benchmark)
+    print("  ".join(["case".ljust(width)] + [c.rjust(12) for c in columns]))
+    for name, metrics in results.items():
+        row = [name.ljust(width)]
+        for column in columns:
+            value = metrics.get(column, '')
+            row.append(("%.3f" % value if isinstance(value, float) else str(value)).rjust(12))
+        print("  ".join(row))
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump({'benchmark': benchmark, 'timestamp': time.time(), 'results': results}, f, indent=2)
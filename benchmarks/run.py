@@ -0,0 +1,155 @@
+"""run the benchmark suite and compare it with a stored baseline
+
+Runs every ``bench_*.py`` script (or the ones given with ``--only``) with
+``--json`` and collects their results into one file::
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --baseline results.json
+
+With ``--baseline`` every metric is compared with the baseline, metrics
+which got worse by more than ``--threshold`` are reported as regressions
+and the exit status is 1. Durations (``_ms``, ``_s``, ``_us``), failure and
+leak counts and costs such as ``writes_per_mb`` are better when lower,
+throughputs (``_per_s``) and hit rates when higher, all other metrics
+describe the case and are not compared.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+# metric names are looked up before the suffixes, e.g. saved_ms is a duration which is better when higher
+LOWER_IS_BETTER = {
+    'failed', 'unfinished', 'dropped', 'leaked_bytes', 'leftover_threads', 'max_threads', 'max_queued_kb',
+    'overhead_pct', 'writes_per_mb',
+}
+HIGHER_IS_BETTER = {'hit_rate', 'saved_ms'}
+LOWER_IS_BETTER_SUFFIXES = ('_ms', '_s', '_us')
+HIGHER_IS_BETTER_SUFFIXES = ('_per_s',)
+
+
+def benchmarks(only=None):
+    names = sorted(
+        os.path.basename(path)[len('bench_'):-len('.py')]
+        for path in glob.glob(os.path.join(BENCHMARK_DIR, 'bench_*.py'))
+    )
+    if only:
+        unknown = set(only) - set(names)
+        if unknown:
+            raise SystemExit("unknown benchmarks: {} (available: {})".format(', '.join(sorted(unknown)), ', '.join(names)))
+        names = [name for name in names if name in only]
+    return names
+
+
+def run(name, extra_args, timeout):
+    with tempfile.TemporaryDirectory() as tmp:
+        json_out = os.path.join(tmp, 'result.json')
+        command = [sys.executable, os.path.join(BENCHMARK_DIR, 'bench_{}.py'.format(name)), '--json', json_out]
+        started = time.monotonic()
+        process = subprocess.run(command + extra_args, timeout=timeout)
+        if process.returncode != 0 or not os.path.exists(json_out):
+            return None
+        with open(json_out) as f:
+            result = json.load(f)
+        result['duration_s'] = time.monotonic() - started
+        return result
+
+
+def direction(metric):
+    """1 if higher is better, -1 if lower is better, 0 if the metric is not compared"""
+    if metric in HIGHER_IS_BETTER:
+        return 1
+    if metric in LOWER_IS_BETTER:
+        return -1
+    if metric.endswith(HIGHER_IS_BETTER_SUFFIXES):
+        return 1
+    if metric.endswith(LOWER_IS_BETTER_SUFFIXES):
+        return -1
+    return 0
+
+
+def compare(baseline, current, threshold):
+    """return (benchmark, case, metric, baseline, current, change) of all regressions"""
+    regressions = []
+    for name, result in current['benchmarks'].items():
+        base_result = baseline['benchmarks'].get(name)
+        if base_result is None:
+            continue
+        for case, metrics in result['results'].items():
+            base_metrics = base_result['results'].get(case, {})
+            for metric, value in metrics.items():
+                sign = direction(metric)
+                base = base_metrics.get(metric)
+                if not sign or not isinstance(value, (int, float)) or not isinstance(base, (int, float)):
+                    continue
+                if base == 0:
+                    # a failure count going up from zero is a regression
+                    worse = sign < 0 and value > 0
+                    change = float('inf') if worse else 0.0
+                else:
+                    change = (value - base) / abs(base) * -sign
+                    worse = change > threshold
+                if worse:
+                    regressions.append((name, case, metric, base, value, change))
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--only', nargs='+', help='benchmarks to run, e.g. shell_throughput tunnel_relay')
+    p.add_argument('--output', help='write the collected results to this file')
+    p.add_argument('--baseline', help='compare the results with this file')
+    p.add_argument('--threshold', type=float, default=0.25, help='relative change counted as regression (default: 0.25)')
+    p.add_argument('--rounds', type=int, help='passed to every benchmark')
+    p.add_argument('--timeout', type=float, default=900, help='seconds a benchmark may take')
+    args = p.parse_args()
+
+    extra_args = ['--rounds', str(args.rounds)] if args.rounds else []
+    current = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': {},
+    }
+    failed = []
+    for name in benchmarks(args.only):
+        print("== {}".format(name), flush=True)
+        try:
+            result = run(name, extra_args, args.timeout)
+        except subprocess.TimeoutExpired:
+            result = None
+        if result is None:
+            failed.append(name)
+            continue
+        current['benchmarks'][name] = result
+        print(flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    if failed:
+        print("failed benchmarks: {}".format(', '.join(failed)))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print("regressions against {} (threshold {:.0%}):".format(args.baseline, args.threshold))
+            for name, case, metric, base, value, change in regressions:
+                print("  {} {} {}: {:.3f} -> {:.3f} ({:+.0%} worse)".format(name, case, metric, base, value, change))
+        else:
+            print("no regressions against {}".format(args.baseline))
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""soak test with many concurrent sessions per plugin
+
+Ramps the number of concurrent sessions of each plugin through the
+``--sessions`` steps and holds every step for ``--hold`` seconds. Every
+``--interval`` seconds the process running the plugins is sampled (threads,
+open file descriptors, resident memory and cpu usage) and ``--probes``
+round trips are measured: a keystroke echoed by the shell of a random
+session for the ssh plugins, a connection through the tunnel of a random
+session for the client tunnel. The result is one scaling curve per plugin::
+
+    python benchmarks/soak.py --sessions 100 500 1000 --plugins injectorshell tunnel-selector
+
+Every plugin runs in a fresh process and the stand-in servers run in a
+process of their own. The victim clients are still part of the measured
+process, the ``forwarder`` case (the plain ``SSHForwarder`` of ssh-mitm)
+shows their share. Thread, descriptor and memory figures are read from
+``/proc`` and are not available on every platform.
+
+This is not part of ``run.py``, a soak run takes minutes.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import statistics
+import threading
+import time
+
+from common import percentile, report  # sets up sys.path
+from standin import PROMPT, StandInProcess, StandInTunnelSession, plugin_args, read_until, start_forwarder
+
+import paramiko
+from ssh_proxy_server.forwarders.ssh import SSHForwarder
+
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+from ssh_mitm_plugins.ssh.stealthshell import SSHStealthForwarder
+from ssh_mitm_plugins.tunnel.injectclienttunnel import InjectableClientTunnelForwarder
+
+
+PLUGINS = ('forwarder', 'injectorshell', 'stealthshell', 'tunnel-thread', 'tunnel-selector')
+SESSION_ERRORS = (OSError, EOFError, RuntimeError, paramiko.SSHException)
+# consecutive failed session opens which end the ramp of a plugin
+MAX_OPEN_FAILURES = 10
+
+
+class ShellSessions:
+    """interactive sessions of a ssh forwarder plugin"""
+
+    def __init__(self, forwarder_class, standin):
+        self.forwarder_class = forwarder_class
+        self.standin = standin
+        self.sessions = []
+        plugin_args('--ssh-injector-key-type', 'ed25519')
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self):
+        session, _, thread = start_forwarder(self.forwarder_class, self.standin)
+        self.sessions.append((session, thread))
+        read_until(session.victim_channel, PROMPT)
+
+    def probe(self):
+        channel = random.choice(self.sessions)[0].victim_channel
+        started = time.perf_counter()
+        channel.sendall(b'a')
+        read_until(channel, b'a')
+        return time.perf_counter() - started
+
+    def close(self):
+        for session, _ in self.sessions:
+            session.close()
+        for _, thread in self.sessions:
+            thread.join(1)
+
+
+class TunnelSessions:
+    """sessions with a client tunnel to the echo server of the stand-in process"""
+
+    PAYLOAD = b'GET / HTTP/1.0\r\n\r\n'
+
+    def __init__(self, relay, standin):
+        self.standin = standin
+        self.sessions = []
+        self.addresses = []
+        plugin_args(
+            '--tunnel-client-dest', '{}:{}'.format(*standin.echo_address),
+            '--tunnel-client-relay', relay
+        )
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self):
+        session = StandInTunnelSession(self.standin)
+        self.sessions.append(session)
+        handler, = InjectableClientTunnelForwarder.setup_injector(session)
+        address = handler.address
+        self.addresses.append(address)
+
+    def probe(self):
+        started = time.perf_counter()
+        sock = socket.create_connection(random.choice(self.addresses), timeout=10)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(self.PAYLOAD)
+            received = 0
+            while received < len(self.PAYLOAD):
+                data = sock.recv(65536)
+                if not data:
+                    raise RuntimeError("tunnel closed the connection")
+                received += len(data)
+        finally:
+            sock.close()
+        return time.perf_counter() - started
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+
+def plugin_sessions(plugin, standin):
+    if plugin.startswith('tunnel-'):
+        return TunnelSessions(plugin[len('tunnel-'):], standin)
+    forwarder_class = {
+        'forwarder': SSHForwarder,
+        'injectorshell': SSHInjectableForwarder,
+        'stealthshell': SSHStealthForwarder,
+    }[plugin]
+    return ShellSessions(forwarder_class, standin)
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError):
+        # peak instead of current resident memory, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def raise_fd_limit():
+    """thousands of sessions need more descriptors than the usual soft limit of 1024"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class ProcessSampler:
+    """resource usage of the current process, cpu usage since the previous sample"""
+
+    def __init__(self):
+        self.last = self.clock()
+
+    @staticmethod
+    def clock():
+        times = os.times()
+        return time.monotonic(), times.user + times.system
+
+    def sample(self):
+        now, cpu = self.clock()
+        last_now, last_cpu = self.last
+        self.last = now, cpu
+        return {
+            'threads': threading.active_count(),
+            'fds': open_fds(),
+            'rss_mb': rss_mb(),
+            'cpu_percent': (cpu - last_cpu) / max(now - last_now, 1e-6) * 100,
+        }
+
+
+def ramp(sessions, count):
+    """open sessions until ``count`` are running, return the open durations and failures"""
+    durations = []
+    failures = consecutive = 0
+    while len(sessions) < count and consecutive < MAX_OPEN_FAILURES:
+        started = time.perf_counter()
+        try:
+            sessions.open()
+        except SESSION_ERRORS:
+            failures += 1
+            consecutive += 1
+            continue
+        consecutive = 0
+        durations.append(time.perf_counter() - started)
+    return durations, failures
+
+
+def hold(sessions, args, sampler, started, timeline):
+    """sample the process while the sessions are running, return all probe round trips and failures"""
+    round_trips = []
+    failures = 0
+    deadline = time.monotonic() + args.hold
+    while time.monotonic() < deadline:
+        next_sample = time.monotonic() + args.interval
+        probes = []
+        for _ in range(args.probes):
+            try:
+                probes.append(sessions.probe())
+            except SESSION_ERRORS:
+                failures += 1
+        sample = sampler.sample()
+        sample.update({
+            'time_s': time.monotonic() - started,
+            'sessions': len(sessions),
+            'p50_ms': percentile(probes, 50) * 1000,
+            'p99_ms': percentile(probes, 99) * 1000,
+        })
+        timeline.append(sample)
+        round_trips.extend(probes)
+        time.sleep(max(0, next_sample - time.monotonic()))
+    return round_trips, failures
+
+
+def soak(plugin, args, pipe):
+    standin = StandInProcess()
+    sessions = plugin_sessions(plugin, standin)
+    sampler = ProcessSampler()
+    started = time.monotonic()
+    baseline = sampler.sample()
+    steps = {}
+    timeline = []
+    for count in args.sessions:
+        durations, open_failures = ramp(sessions, count)
+        first = len(timeline)
+        round_trips, probe_failures = hold(sessions, args, sampler, started, timeline)
+        samples = timeline[first:]
+        last = samples[-1]
+        step = {
+            'sessions': len(sessions),
+            'open_ms': percentile(durations, 50) * 1000,
+            'threads': last['threads'],
+            'fds': last['fds'],
+            'rss_mb': last['rss_mb'],
+            'cpu_percent': statistics.mean(sample['cpu_percent'] for sample in samples),
+            'p50_ms': percentile(round_trips, 50) * 1000,
+            'p99_ms': percentile(round_trips, 99) * 1000,
+            'failed': open_failures + probe_failures,
+        }
+        if len(sessions):
+            step['threads_per_session'] = (last['threads'] - baseline['threads']) / len(sessions)
+            step['kb_per_session'] = (last['rss_mb'] - baseline['rss_mb']) * 1000 / len(sessions)
+        steps[str(count)] = step
+        if len(sessions) < count:
+            # opening more sessions keeps failing, most likely a resource limit was hit
+            break
+    sessions.close()
+    standin.close()
+    pipe.send({'baseline': baseline, 'steps': steps, 'timeline': timeline})
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--plugins', nargs='+', default=list(PLUGINS), choices=PLUGINS)
+    p.add_argument('--sessions', type=int, nargs='+', default=[10, 50, 100, 200], help='concurrent sessions of the ramp steps')
+    p.add_argument('--hold', type=float, default=10.0, help='seconds every step is held')
+    p.add_argument('--interval', type=float, default=2.0, help='seconds between samples')
+    p.add_argument('--probes', type=int, default=20, help='round trips measured per sample')
+    p.add_argument('--json', dest='json_out', help='write the steps and the sampled timeline to this file')
+    args = p.parse_args()
+    args.sessions = sorted(args.sessions)
+    raise_fd_limit()
+
+    results = {}
+    for plugin in args.plugins:
+        pipe, child_pipe = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=soak, args=(plugin, args, child_pipe))
+        process.start()
+        child_pipe.close()
+        try:
+            result = pipe.recv()
+        except EOFError:
+            print("{}: soak process exited with {}".format(plugin, process.exitcode))
+            continue
+        finally:
+            process.join()
+        results[plugin] = result
+        report('{} (idle: {} threads, {:.1f} MB)'.format(
+            plugin, result['baseline']['threads'], result['baseline']['rss_mb']
+        ), result['steps'])
+        print(flush=True)
+
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump({'benchmark': 'soak', 'timestamp': time.time(), 'plugins': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,483 @@
+"""local stand-in ssh server, victim client and session for driving plugin forwarders
+
+Nothing here talks to a real sshd. A paramiko server on loopback plays the
+remote host with a tiny line based shell, a second paramiko server plays the
+ssh-mitm side of the victim connection and ``StandInSession`` glues both
+together the way ``ssh_proxy_server.session.Session`` does for a forwarder.
+"""
+import collections
+import multiprocessing
+import selectors
+import socket
+import sys
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import common  # noqa: F401 (sets up sys.path)
+
+import paramiko
+from ssh_proxy_server.session import Session
+
+from ssh_mitm_plugins.ssh.hostkeys import generate_host_key
+
+
+PROMPT = b'user@standin:~$ '
+HOST_KEY = None
+
+
+def host_key():
+    global HOST_KEY
+    if HOST_KEY is None:
+        HOST_KEY = generate_host_key('ed25519')
+    return HOST_KEY
+
+
+class AcceptAllServer(paramiko.ServerInterface):
+
+    def __init__(self):
+        self.shell_requested = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell_requested.set()
+        return True
+
+
+class StandInShell(threading.Thread):
+    """minimal interactive shell: echoes keystrokes and answers a few commands
+
+    ``echo TEXT`` prints TEXT (with ``$?`` expanded and double quotes
+    removed), ``bulk N`` prints N bytes, ``cd DIR`` changes the prompt,
+    ``false`` fails, ``exit`` ends the shell and everything else is echoed
+    back as the command output. Commands can be separated by ``;`` and
+    grouped with ``{ ... }`` over several lines, an open group is continued
+    after a ``> `` prompt like in bash. `` #`` starts a comment up to the end
+    of the line.
+    """
+
+    def __init__(self, channel):
+        super(StandInShell, self).__init__(name="standin", daemon=True)
+        self.channel = channel
+        self.prompt = PROMPT
+        self.status = 0
+
+    def run(self):
+        line = b''
+        group = b''
+        try:
+            self.channel.sendall(self.prompt)
+            while True:
+                data = self.channel.recv(65536)
+                if not data:
+                    break
+                for char in data:
+                    char = bytes([char])
+                    if char in (b'\r', b'\n'):
+                        self.channel.sendall(b'\r\n')
+                        group += line.split(b' #', 1)[0].strip()
+                        line = b''
+                        if group.count(b'{ ') > group.count(b'}'):
+                            group += b';'
+                            self.channel.sendall(b'> ')
+                            continue
+                        command, group = group, b''
+                        if not self.execute(command):
+                            return
+                        self.channel.sendall(self.prompt)
+                    else:
+                        line += char
+                        self.channel.sendall(char)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            self.channel.close()
+
+    def execute(self, command):
+        if b';' in command:
+            return all(self.execute(part.strip()) for part in command.split(b';'))
+        if command.startswith(b'{ '):
+            command = command[2:].strip()
+        if command.startswith(b'}'):
+            command = command[1:].strip()
+        status, self.status = self.status, 0
+        if command == b'exit':
+            self.channel.send_exit_status(0)
+            return False
+        if command.startswith(b'bulk '):
+            remaining = int(command.split()[1])
+            # lines of 80 bytes, written in blocks like a busy program does
+            chunk = (b'x' * 79 + b'\n') * 400
+            while remaining > 0:
+                self.channel.sendall(chunk[:remaining])
+                remaining -= len(chunk)
+            self.channel.sendall(b'\r\n')
+        elif command.startswith(b'cd '):
+            self.prompt = PROMPT.replace(b'~', command[3:])
+        elif command.startswith(b'echo '):
+            self.channel.sendall(command[5:].replace(b'$?', str(status).encode()).replace(b'"', b'') + b'\r\n')
+        elif command == b'false':
+            self.status = 1
+        elif command:
+            self.channel.sendall(command + b'\r\n')
+        return True
+
+
+class DirectTcpipRelay(threading.Thread):
+    """connects an accepted direct-tcpip channel to its requested destination"""
+
+    def __init__(self, channel, destination):
+        super(DirectTcpipRelay, self).__init__(name="standin", daemon=True)
+        self.channel = channel
+        self.destination = destination
+
+    def run(self):
+        try:
+            sock = socket.create_connection(self.destination)
+        except OSError:
+            self.channel.close()
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(self.channel, selectors.EVENT_READ)
+        try:
+            while True:
+                r = [key.fileobj for key, _ in selector.select()]
+                if sock in r:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    self.channel.sendall(data)
+                if self.channel in r:
+                    data = self.channel.recv(65536)
+                    if not data:
+                        break
+                    sock.sendall(data)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            selector.close()
+            sock.close()
+            self.channel.close()
+
+
+class StandInServer(threading.Thread):
+    """loopback ssh server playing the remote host"""
+
+    def __init__(self, latency=0):
+        super(StandInServer, self).__init__(name="standin", daemon=True)
+        # one way delay in seconds between ssh-mitm and the stand-in server
+        self.latency = latency
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.transports = []
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            # like sshd for interactive sessions, keystroke echoes are not delayed
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(client,), name="standin", daemon=True).start()
+
+    def serve(self, client):
+        t = paramiko.Transport(client)
+        t.add_server_key(host_key())
+        server = StandInTcpipServer(t)
+        t.start_server(server=server)
+        self.transports.append(t)
+        while t.is_active():
+            channel = t.accept(1)
+            if channel is None:
+                continue
+            if channel.get_id() in server.tcpip:
+                DirectTcpipRelay(channel, server.tcpip.pop(channel.get_id())).start()
+                continue
+            server.shell_requested.wait(5)
+            server.shell_requested.clear()
+            StandInShell(channel).start()
+
+    def connect(self):
+        """open an authenticated client transport to the stand-in server"""
+        sock = socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.latency:
+            sock = DelayedLink(sock, self.latency).local
+        t = paramiko.Transport(sock)
+        t.start_client()
+        t.auth_none('standin')
+        return t
+
+    def close(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+
+class DelayedLink:
+    """delivers everything sent over a socket ``latency`` seconds later in both directions"""
+
+    def __init__(self, remote, latency):
+        self.local, inner = socket.socketpair()
+        self.latency = latency
+        for source, target in ((inner, remote), (remote, inner)):
+            queue = collections.deque()
+            ready = threading.Condition()
+            threading.Thread(target=self.read, args=(source, queue, ready), name="standin", daemon=True).start()
+            threading.Thread(target=self.write, args=(target, queue, ready), name="standin", daemon=True).start()
+
+    def read(self, source, queue, ready):
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            with ready:
+                queue.append((time.monotonic() + self.latency, data))
+                ready.notify()
+            if not data:
+                return
+
+    def write(self, target, queue, ready):
+        while True:
+            with ready:
+                while not queue:
+                    ready.wait()
+                due, data = queue.popleft()
+            time.sleep(max(0, due - time.monotonic()))
+            try:
+                if not data:
+                    target.shutdown(socket.SHUT_WR)
+                    return
+                target.sendall(data)
+            except OSError:
+                return
+
+
+class StandInTcpipServer(AcceptAllServer):
+
+    def __init__(self, transport):
+        super(StandInTcpipServer, self).__init__()
+        self.transport = transport
+        self.tcpip = {}
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.tcpip[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+
+def open_victim_channel():
+    """return (client side, ssh-mitm side) of an interactive victim connection"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client_sock = socket.create_connection(listener.getsockname())
+    server_sock, _ = listener.accept()
+    listener.close()
+
+    server_t = paramiko.Transport(server_sock)
+    server_t.add_server_key(host_key())
+    server = AcceptAllServer()
+    negotiated = threading.Event()
+    server_t.start_server(event=negotiated, server=server)
+
+    client_t = paramiko.Transport(client_sock)
+    client_t.start_client()
+    client_t.auth_none('victim')
+    client_channel = client_t.open_session()
+    client_channel.invoke_shell()
+    mitm_channel = server_t.accept(5)
+    server.shell_requested.wait(5)
+    return client_channel, mitm_channel
+
+
+class StandInSession(Session):
+    """the parts of ``Session`` a ssh forwarder touches"""
+
+    def __init__(self, standin_server):
+        self.sessionid = uuid.uuid4()
+        self.name = "standin-{}".format(self.sessionid)
+        self.closed = False
+        self.agent = None
+        self.env_requests = {}
+        self.ssh_pty_kwargs = None
+        self.ssh_client = SimpleNamespace(transport=standin_server.connect())
+        self.victim_channel, self.ssh_channel = open_victim_channel()
+        self.stopped = False
+
+    @property
+    def running(self):
+        return not self.stopped and not self.ssh_channel.closed
+
+    def close(self):
+        self.stopped = True
+        self.ssh_channel.close()
+        self.victim_channel.get_transport().close()
+        self.ssh_client.transport.close()
+
+    def __str__(self):
+        return self.name
+
+
+class StandInTunnelSession:
+    """the parts of ``Session`` a client tunnel forwarder touches"""
+
+    def __init__(self, standin_server):
+        self.sessionid = uuid.uuid4()
+        self.ssh_client = SimpleNamespace(transport=standin_server.connect())
+        self.stopped = False
+
+    @property
+    def running(self):
+        return not self.stopped and self.ssh_client.transport.is_active()
+
+    def close(self):
+        self.stopped = True
+        self.ssh_client.transport.close()
+
+    def __str__(self):
+        return "standin-{}".format(self.sessionid)
+
+
+class EchoServer(threading.Thread):
+    """tcp echo server on loopback, all connections are served by one selector loop"""
+
+    def __init__(self):
+        super(EchoServer, self).__init__(name="standin", daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1024)
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.start()
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.sock:
+                    try:
+                        client, _ = self.sock.accept()
+                    except OSError:
+                        continue
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.selector.register(client, selectors.EVENT_READ)
+                    continue
+                client = key.fileobj
+                try:
+                    data = client.recv(65536)
+                    if data:
+                        client.setblocking(True)
+                        client.sendall(data)
+                        client.setblocking(False)
+                        continue
+                except OSError:
+                    pass
+                self.selector.unregister(client)
+                client.close()
+
+
+class StandInProcess:
+    """stand-in ssh and echo servers in a child process
+
+    Keeps the threads, sockets and cpu time of the stand-in servers out of
+    the measurements of the process running the plugins. ``connect`` works
+    like ``StandInServer.connect``.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        pipe, child_pipe = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.serve, args=(child_pipe, latency), daemon=True)
+        self.process.start()
+        self.address, self.echo_address = pipe.recv()
+        self.pipe = pipe
+
+    @staticmethod
+    def serve(pipe, latency):
+        server = StandInServer(latency)
+        echo_server = EchoServer()
+        pipe.send((server.address, echo_server.address))
+        try:
+            # serve until the parent closes its end or exits
+            pipe.recv()
+        except EOFError:
+            pass
+
+    def connect(self):
+        return StandInServer.connect(self)
+
+    def close(self):
+        self.pipe.close()
+        self.process.terminate()
+        self.process.join(5)
+
+
+def plugin_threads():
+    """number of running threads which are not part of the stand-in servers"""
+    return sum(1 for thread in threading.enumerate() if thread.name != "standin")
+
+
+def plugin_args(*args):
+    """set the command line the plugin parsers will read"""
+    sys.argv = [sys.argv[0]] + list(args)
+
+
+def start_forwarder(forwarder_class, standin_server):
+    session = StandInSession(standin_server)
+    forwarder = forwarder_class(session)
+    thread = threading.Thread(target=forwarder.forward, daemon=True)
+    thread.start()
+    return session, forwarder, thread
+
+
+def read_until(channel, marker, timeout=10):
+    """read from a channel until ``marker`` was received and return everything read"""
+    data = b''
+    deadline = time.monotonic() + timeout
+    while marker not in data:
+        if time.monotonic() > deadline:
+            raise TimeoutError("did not receive {!r}, got {!r}".format(marker, data[-200:]))
+        if channel.recv_ready():
+            data += channel.recv(65536)
+        else:
+            time.sleep(0.0005)
+    return data
+
+
+def injector_address(forwarder):
+    return forwarder.injector_listener.sockets[(forwarder.args.ssh_injector_net, forwarder.args.ssh_injector_port)].getsockname()
+
+
+def attach_injector(address, session_name):
+    """attach an injector client the way ``ssh -p PORT SESSION@HOST`` does"""
+    t = paramiko.Transport(socket.create_connection(address))
+    t.start_client()
+    t.auth_none(session_name)
+    channel = t.open_session()
+    channel.get_pty()
+    channel.invoke_shell()
+    return channel
@@ -0,0 +1,44 @@
+"""direction of the metrics compared by run.py, run with ``python -m pytest benchmarks``"""
+import pytest
+
+from run import compare, direction
+
+
+@pytest.mark.parametrize('metric, expected', [
+    ('p99_ms', -1),
+    ('best_s', -1),
+    ('per_chunk_us', -1),
+    ('failed', -1),
+    ('unfinished', -1),
+    ('leaked_bytes', -1),
+    ('leftover_threads', -1),
+    ('writes_per_mb', -1),
+    ('max_queued_kb', -1),
+    ('mb_per_s', 1),
+    ('feed_mb_per_s', 1),
+    ('queries_per_s', 1),
+    ('hit_rate', 1),
+    ('saved_ms', 1),
+    ('sessions', 0),
+    ('mirrored_mb', 0),
+    ('complete_commands', 0),
+])
+def test_direction(metric, expected):
+    assert direction(metric) == expected
+
+
+def test_compare_reports_more_writes_per_mb():
+    baseline = {'benchmarks': {'shell_throughput': {'results': {'injectorshell-mirror-1': {'writes_per_mb': 16.0}}}}}
+    current = {'benchmarks': {'shell_throughput': {'results': {'injectorshell-mirror-1': {'writes_per_mb': 64.0}}}}}
+    assert compare(baseline, current, 0.25) == [
+        ('shell_throughput', 'injectorshell-mirror-1', 'writes_per_mb', 16.0, 64.0, 3.0)
+    ]
+    assert compare(current, baseline, 0.25) == []
+
+
+def test_compare_reports_leaks_from_zero():
+    baseline = {'benchmarks': {'framed_commands': {'results': {'pipelined': {'leaked_bytes': 0}}}}}
+    current = {'benchmarks': {'framed_commands': {'results': {'pipelined': {'leaked_bytes': 12}}}}}
+    assert compare(baseline, current, 0.25) == [
+        ('framed_commands', 'pipelined', 'leaked_bytes', 0, 12, float('inf'))
+    ]
@@ -0,0 +1,38 @@
+"""prompt tracking of ScriptExecution, run with ``python -m pytest benchmarks``"""
+import common  # noqa: F401 (sets up sys.path)
+
+from ssh_mitm_plugins.ssh.script import ScriptExecution
+
+
+def run(execution, output, now):
+    """feed the output of the sent command and poll after the output settled"""
+    execution.feed(output, now)
+    return execution.poll(now + 2 * ScriptExecution.PROMPT_SETTLE_TIME)
+
+
+def test_command_changing_the_prompt():
+    results = []
+    execution = ScriptExecution(('cd /tmp', 'pwd'), 'prompt', timeout=30.0, on_result=results.append)
+    execution.feed(b'Last login: today\r\nuser@host:~$ ', 0.0)
+    assert execution.poll(1.0) == b'cd /tmp\n'
+
+    assert run(execution, b'cd /tmp\r\nuser@host:/tmp$ ', 1.0) is None
+    assert [(result.command, result.complete, result.output) for result in results] == [('cd /tmp', True, b'')]
+
+    # the next command is sent right away and finished at the learned prompt
+    assert execution.poll(2.0) == b'pwd\n'
+    execution.feed(b'pwd\r\n/tmp\r\nuser@host:/tmp$ ', 2.1)
+    assert [(result.command, result.complete, result.output) for result in results][1] == ('pwd', True, b'/tmp')
+    assert execution.done()
+
+
+def test_output_is_not_taken_for_a_prompt():
+    results = []
+    execution = ScriptExecution(('python3',), 'prompt', timeout=30.0, on_result=results.append)
+    execution.feed(b'user@host:~$ ', 0.0)
+    assert execution.poll(1.0) == b'python3\n'
+
+    run(execution, b'python3\r\nPython 3.11\r\n>>> ', 1.0)
+    assert not results
+    execution.poll(40.0)
+    assert [(result.command, result.complete) for result in results] == [('python3', False)]
@@ -0,0 +1,64 @@
+"""sessions end with their injector shells and tunnel listeners, run with ``python -m pytest benchmarks``"""
+import time
+
+import pytest
+
+from standin import (
+    PROMPT, EchoServer, StandInServer, StandInTunnelSession, attach_injector, injector_address, plugin_args,
+    read_until, start_forwarder
+)
+
+from ssh_mitm_plugins.ssh.injectorshell import SSHInjectableForwarder
+from ssh_mitm_plugins.ssh.stealthshell import SSHStealthForwarder
+from ssh_mitm_plugins.tunnel.injectclienttunnel import InjectableClientTunnelForwarder
+
+# far above the milliseconds a teardown takes, far below the timeouts of the shells
+TIME_LIMIT = 2.0
+SHELLS = 4
+
+
+@pytest.fixture(scope='module')
+def standin_server():
+    server = StandInServer()
+    yield server
+    server.close()
+
+
+@pytest.mark.parametrize('forwarder_class', [SSHInjectableForwarder, SSHStealthForwarder])
+def test_session_close_ends_injector_shells(standin_server, forwarder_class):
+    plugin_args('--ssh-injector-key-type', 'ed25519')
+    session, forwarder, thread = start_forwarder(forwarder_class, standin_server)
+    injectors = []
+    try:
+        read_until(session.victim_channel, PROMPT)
+        for _ in range(SHELLS):
+            channel = attach_injector(injector_address(forwarder), forwarder.injector_name)
+            read_until(channel, b'CTRL+C')
+            injectors.append(channel)
+        # the shells are admitted after the injector client got its channel
+        deadline = time.monotonic() + 5
+        while len(forwarder.injector_shells) < SHELLS and time.monotonic() < deadline:
+            time.sleep(0.001)
+        shells = list(forwarder.injector_shells)
+        assert len(shells) == SHELLS
+
+        session.ssh_channel.close()
+        deadline = time.monotonic() + TIME_LIMIT
+        thread.join(TIME_LIMIT)
+        assert not thread.is_alive()
+        for shell in shells:
+            assert shell.finished.wait(max(0.0, deadline - time.monotonic()))
+    finally:
+        session.close()
+        for channel in injectors:
+            channel.get_transport().close()
+
+
+def test_session_close_stops_tunnel_listener(standin_server):
+    echo_server = EchoServer()
+    plugin_args('--tunnel-client-dest', '{}:{}'.format(*echo_server.address), '--tunnel-client-relay', 'thread')
+    session = StandInTunnelSession(standin_server)
+    handler, = InjectableClientTunnelForwarder.setup_injector(session)
+    session.close()
+    handler.server.join(TIME_LIMIT)
+    assert not handler.server.is_alive()
@@ -4,6 +4,7 @@ from setuptools import setup, find_packages
 
 # read the contents of your README file
 from os import path
+from runpy import run_path
 
 this_directory = path.abspath(path.dirname(__file__))
 with open(path.join(this_directory, 'README.md'), encoding='utf-8') as f:
@@ -11,7 +12,8 @@ with open(path.join(this_directory, 'README.md'), encoding='utf-8') as f:
 
 
 def get_entry_points():
-    from ssh_mitm_plugins.__entrypoints__ import entry_points as plugins_entry_points
+    # read the entry points without importing the package
+    plugins_entry_points = run_path(path.join(this_directory, 'ssh_mitm_plugins', '__entrypoints__.py'))['entry_points']
     return {
         **plugins_entry_points
     }
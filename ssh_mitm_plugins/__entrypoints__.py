@@ -1,3 +1,6 @@
+# ssh-mitm imports every module listed here at startup to list the available
+# plugins, so the plugin modules import their helper modules when the plugin
+# is used (parser_arguments, __init__ or setup) instead of at module level
 entry_points = {
     'SSHBaseForwarder': [
         'plugin-scriptedshell = ssh_mitm_plugins.ssh.scriptedshell:SSHScriptedForwarder',
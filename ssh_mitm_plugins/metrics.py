@@ -0,0 +1,161 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+
+METRICS_FORMATS = ('prometheus', 'json')
+
+# seconds, from a local round trip to a slow channel open
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds, from a single request to an interactive connection
+DURATION_BUCKETS = (0.01, 0.1, 1.0, 10.0, 60.0, 300.0, 1800.0, 3600.0)
+
+
+class Histogram:
+    """counts observations in fixed buckets like a prometheus histogram
+
+    Not thread safe, the owner serializes ``observe`` and ``merge``.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.merge(self)
+        return histogram
+
+    def to_dict(self):
+        return {
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metric:
+    """a metric family: ``samples`` is a list of (labels, value) with a number or a Histogram as value"""
+
+    def __init__(self, name, kind, description, samples=None):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.samples = samples if samples is not None else []
+
+    def add(self, labels, value):
+        self.samples.append((labels, value))
+
+
+def format_labels(labels, extra=None):
+    items = list(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in items
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_prometheus(metrics):
+    """render metric families in the prometheus text exposition format"""
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.description))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for labels, value in metric.samples:
+            if isinstance(value, Histogram):
+                cumulative = 0
+                for bound, count in zip(list(value.buckets) + ['+Inf'], value.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(metric.name, format_labels(labels, ('le', bound)), cumulative))
+                lines.append('{}_sum{} {}'.format(metric.name, format_labels(labels), value.sum))
+                lines.append('{}_count{} {}'.format(metric.name, format_labels(labels), value.count))
+            else:
+                lines.append('{}{} {}'.format(metric.name, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def format_json(metrics):
+    """render metric families as a json snapshot"""
+    return json.dumps({
+        'timestamp': time.time(),
+        'metrics': {
+            metric.name: [
+                dict(labels, value=value.to_dict() if isinstance(value, Histogram) else value)
+                for labels, value in metric.samples
+            ]
+            for metric in metrics
+        }
+    }) + '\n'
+
+
+class MetricsWriter(threading.Thread):
+    """writes the metrics returned by ``collect()`` to a file every ``interval`` seconds
+
+    The file is replaced atomically, so it can be read at any time, e.g. by
+    the textfile collector of the prometheus node exporter. ``trigger`` writes
+    the file at once, without an interval the file is only written on
+    ``trigger`` and when the writer is closed.
+    """
+
+    def __init__(self, path, collect, metrics_format='prometheus', interval=10.0):
+        super(MetricsWriter, self).__init__(name="metrics-writer", daemon=True)
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError("unsupported metrics format: {}".format(metrics_format))
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.collect = collect
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.stopped = False
+        atexit.register(self.close)
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval or None)
+            self.wakeup.clear()
+            self.write()
+
+    def trigger(self):
+        """write the metrics now"""
+        self.wakeup.set()
+
+    def write(self):
+        try:
+            metrics = self.collect()
+            render = format_json if self.metrics_format == 'json' else format_prometheus
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(render(metrics))
+            os.replace(tmp_path, self.path)
+        except Exception:
+            logging.exception("could not write metrics to %s", self.path)
+
+    def close(self):
+        """stop the writer after a last write"""
+        self.stopped = True
+        self.wakeup.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
@@ -0,0 +1,64 @@
+import codecs
+import re
+
+
+# complete escape sequences: CSI (ESC [ ... final), strings terminated by
+# BEL or ST (OSC, DCS, SOS, PM, APC) and the remaining two byte escapes
+# with optional intermediate bytes (e.g. ESC ( B, ESC =, ESC M)
+ESCAPE_SEQUENCE = re.compile(
+    rb'\x1b(?:'
+    rb'\[[0-?]*[ -/]*[@-~]'
+    rb'|[\]PX^_][^\x07\x1b]*(?:\x07|\x1b\\)'
+    rb'|[ -/]*[0-~]'
+    rb')'
+)
+# the start of an escape sequence which is continued by the next read
+INCOMPLETE_SEQUENCE = re.compile(
+    rb'\x1b(?:'
+    rb'\[[0-?]*[ -/]*'
+    rb'|[\]PX^_][^\x07\x1b]*\x1b?'
+    rb'|[ -/]*'
+    rb')'
+)
+
+
+class AnsiFilter:
+    """incremental filter removing ANSI/VT escape sequences from a byte stream
+
+    Escape sequences and multibyte characters split over two reads are held
+    back until the next read completes them. Each read is processed in a
+    single pass with precompiled patterns.
+    """
+
+    # unterminated sequences longer than this are dropped instead of held back
+    MAX_PENDING = 4096
+
+    def __init__(self, encoding='utf-8', errors='replace'):
+        self.pending = b''
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+
+    def filter(self, data):
+        """return ``data`` without escape sequences"""
+        if self.pending:
+            data = self.pending + data
+            self.pending = b''
+        start = data.rfind(b'\x1b')
+        if start > 0 and start == len(data) - 1:
+            # a lone ESC may be the first half of the ST ending a string sequence
+            previous = data.rfind(b'\x1b', 0, start)
+            if previous != -1 and INCOMPLETE_SEQUENCE.fullmatch(data, previous):
+                start = previous
+        if start != -1 and INCOMPLETE_SEQUENCE.fullmatch(data, start):
+            if len(data) - start <= self.MAX_PENDING:
+                self.pending = data[start:]
+            data = data[:start]
+        return ESCAPE_SEQUENCE.sub(b'', data)
+
+    def decode(self, data):
+        """filter ``data`` and decode it, multibyte characters may span reads"""
+        return self.decoder.decode(self.filter(data))
+
+    def flush(self):
+        """return the text held back at the end of the stream"""
+        self.pending = b''
+        return self.decoder.decode(b'', final=True)
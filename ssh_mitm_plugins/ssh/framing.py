@@ -0,0 +1,271 @@
+import logging
+import re
+import threading
+import time
+import uuid
+
+import paramiko
+
+
+def complete_line(command):
+    """True if the quotes of a command line are balanced and it does not end with a backslash"""
+    quote = None
+    escaped = False
+    for char in command.decode('utf-8', errors='replace'):
+        if escaped:
+            escaped = False
+        elif char == '\\' and quote != "'":
+            escaped = True
+        elif quote is None and char in '\'"`':
+            quote = char
+        elif char == quote:
+            quote = None
+    return quote is None and not escaped
+
+
+class FramedCommand:
+    """an injected command whose output is framed by markers
+
+    The output between the markers is written to ``channel`` and collected
+    for ``on_result``, which gets the finished command. The command is also
+    the sender of its input line: the session output outside of the frame
+    is the echoed input line, which is not shown, and the prompt after the
+    command, which goes to ``channel``.
+    """
+
+    def __init__(self, index, command, line, channel=None, on_result=None):
+        self.index = index
+        self.command = command
+        self.line = line
+        self.channel = channel
+        self.on_result = on_result
+        self.output = []
+        self.started = time.monotonic()
+        # the start marker was seen
+        self.opened = None
+        self.finished = None
+        self.exit_status = None
+        self.complete = False
+
+    @property
+    def duration(self):
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def deliver(self, data):
+        if self.on_result is not None:
+            self.output.append(data)
+        self.write(data)
+
+    def sendall(self, data):
+        if self.finished is not None:
+            self.write(data)
+
+    def write(self, data):
+        if self.channel is None or not data:
+            return
+        try:
+            self.channel.sendall(data)
+        except (OSError, EOFError, paramiko.SSHException):
+            logging.debug("framed output of command %d not delivered", self.index)
+
+    def finish(self, complete, exit_status=None):
+        self.finished = time.monotonic()
+        self.complete = complete
+        self.exit_status = exit_status
+        if self.on_result is not None:
+            self.on_result(self)
+
+    def text(self):
+        return b''.join(self.output).decode('utf-8', errors='replace')
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'command': self.command.decode('utf-8', errors='replace'),
+            'output': self.text(),
+            'duration': self.duration,
+            'exit_status': self.exit_status,
+            'complete': self.complete,
+        }
+
+
+class OutputFramer:
+    """takes the framed output of injected commands out of the session output
+
+    ``wrap`` turns a command line into ``echo START; { COMMAND <newline> };
+    echo END$?``. The command ends at the newline, so a trailing comment or
+    ``&`` cannot swallow the end marker. The markers are quoted in the input
+    line, so the echoed input never matches, only the output of the echo
+    commands does. ``feed`` scans the
+    output once, the framed output goes to its command and everything
+    outside of the frames to ``write``, in the order of the output, so the
+    caller can route it by the state of the commands. The end of a read
+    which may be the start of a marker is held back until the next read or
+    ``flush``. While no command is waiting for its markers the output is
+    passed on as it is. A command which still does not print its end marker
+    (e.g. waiting for input) is given up by ``expire``.
+    """
+
+    def __init__(self, timeout=None):
+        self.prefix = '__SSHMITM_{}_'.format(uuid.uuid4().hex[:8]).encode()
+        prefix = re.escape(self.prefix)
+        self.start = re.compile(prefix + rb'(\d+)_S__\r?\n')
+        self.end = re.compile(prefix + rb'(\d+)_E(\d+)__\r?\n')
+        # what may follow the prefix at the end of a read before the marker is complete
+        self.partial = re.compile(rb'\d+_(?:S_{0,2}\r?|E\d*_{0,2}\r?)?|\d*')
+        self.marker_len = len(self.prefix) + 32
+        # seconds a started command may take until its end marker, None waits forever
+        self.timeout = timeout
+        # commands are wrapped by other threads than the one feeding the output
+        self.lock = threading.RLock()
+        # index -> wrapped commands which did not finish yet
+        self.pending = {}
+        self.active = None
+        self.held = b''
+        self.count = 0
+
+        self.framed_bytes = 0
+        self.finished = 0
+        self.incomplete = 0
+        self.expired = 0
+
+    def wrap(self, command, channel=None, on_result=None):
+        if isinstance(command, str):
+            command = command.encode('utf-8')
+        command = command.strip()
+        if not command or b'\r' in command or b'\n' in command:
+            raise ValueError("a framed command has to be a single non-empty line")
+        if b'<<' in command:
+            raise ValueError("a framed command cannot use a here document")
+        if not complete_line(command):
+            raise ValueError("a framed command needs balanced quotes and no trailing backslash")
+        with self.lock:
+            self.count += 1
+            marker = self.prefix + '"{}"'.format(self.count).encode()
+            line = b'echo ' + marker + b'_S__; { ' + command + b'\r}; echo ' + marker + b'_E$?__\r'
+            frame = FramedCommand(self.count, command, line, channel, on_result)
+            self.pending[self.count] = frame
+        return frame
+
+    def feed(self, data, write):
+        """pass the part of ``data`` outside of the frames to ``write``"""
+        with self.lock:
+            if self.active is not None:
+                self.expire(write)
+            if self.held:
+                data, self.held = self.held + data, b''
+            elif not self.pending:
+                write(data)
+                return
+            pos = 0
+            while True:
+                if self.active is None:
+                    match = self.start.search(data, pos)
+                    if match is None:
+                        break
+                    if match.start() > pos:
+                        write(data[pos:match.start()])
+                    pos = match.end()
+                    # the start marker of an unknown or cancelled command is dropped
+                    self.active = self.pending.get(int(match.group(1)))
+                    if self.active is not None:
+                        self.active.opened = time.monotonic()
+                    continue
+                match = self.end.search(data, pos)
+                if match is None:
+                    break
+                self.deliver(data[pos:match.start()])
+                pos = match.end()
+                if int(match.group(1)) == self.active.index:
+                    self.close_frame(self.active, True, int(match.group(2)))
+                else:
+                    # the command never printed its own end marker
+                    self.close_frame(self.active, False)
+            rest = data[pos:]
+            hold = self.holdback(rest)
+            if hold:
+                self.held = rest[-hold:]
+                rest = rest[:-hold]
+            if self.active is not None:
+                self.deliver(rest)
+            elif rest:
+                write(rest)
+
+    def holdback(self, data):
+        """number of bytes at the end of ``data`` which may be the start of a marker"""
+        index = data.rfind(self.prefix, -self.marker_len)
+        if index >= 0 and self.partial.fullmatch(data, index + len(self.prefix)):
+            return len(data) - index
+        for length in range(min(len(self.prefix) - 1, len(data)), 0, -1):
+            if data.endswith(self.prefix[:length]):
+                return length
+        return 0
+
+    def deliver(self, data):
+        if data:
+            self.framed_bytes += len(data)
+            self.active.deliver(data)
+
+    def flush(self, write):
+        """pass on the held back output once no more output arrived"""
+        with self.lock:
+            data, self.held = self.held, b''
+            if not data:
+                return
+            if self.active is not None:
+                self.deliver(data)
+            else:
+                write(data)
+
+    def expire(self, write, at_prompt=False):
+        """give up the started command once the session is back at its prompt or the timeout passed
+
+        The command is finished as incomplete and the held back output goes
+        to ``write``, like all later output. Returns the expired command.
+        """
+        with self.lock:
+            frame = self.active
+            if frame is None:
+                return None
+            if not at_prompt and (self.timeout is None or time.monotonic() - frame.opened < self.timeout):
+                return None
+            self.close_frame(frame, False)
+            self.expired += 1
+            data, self.held = self.held, b''
+            if data:
+                write(data)
+            return frame
+
+    def cancel(self, frame):
+        """finish a command whose input line was never sent"""
+        with self.lock:
+            if self.pending.get(frame.index) is frame:
+                self.close_frame(frame, False)
+
+    def close_frame(self, frame, complete, exit_status=None):
+        self.pending.pop(frame.index, None)
+        if frame is self.active:
+            self.active = None
+        if complete:
+            self.finished += 1
+        else:
+            self.incomplete += 1
+        frame.finish(complete, exit_status)
+
+    def close(self):
+        """finish the commands which are still waiting as incomplete"""
+        with self.lock:
+            for frame in list(self.pending.values()):
+                self.close_frame(frame, False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'finished': self.finished,
+                'incomplete': self.incomplete,
+                'expired': self.expired,
+                'framed_bytes': self.framed_bytes,
+            }
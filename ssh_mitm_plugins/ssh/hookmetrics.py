@@ -0,0 +1,215 @@
+import argparse
+import logging
+import signal
+import threading
+import time
+
+from ssh_mitm_plugins.metrics import METRICS_FORMATS, Histogram, Metric, MetricsWriter
+
+
+HOOKS = ('forward_stdin', 'forward_stdout', 'forward_extra', 'forward_stderr')
+# seconds, a hook without data returns within microseconds
+HOOK_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 1.0)
+
+
+class HookStats:
+    """calls, duration and moved bytes of one forwarder hook"""
+
+    def __init__(self):
+        self.calls = 0
+        # calls which neither received nor sent anything
+        self.idle = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.duration = Histogram(HOOK_BUCKETS)
+
+    def copy(self):
+        stats = HookStats()
+        stats.merge(self)
+        return stats
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.idle += other.idle
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.duration.merge(other.duration)
+
+
+class HookMetricsAction(argparse.Action):
+    """stores the metrics file and installs the SIGUSR1 handler
+
+    Plugin arguments are first parsed in the main thread when ssh-mitm
+    starts, the only thread which may install signal handlers.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, values)
+        HookMetrics.install_signal_handler()
+
+
+def add_hook_metrics_arguments(parser):
+    parser.add_argument(
+        '--ssh-hook-metrics',
+        dest='ssh_hook_metrics',
+        action=HookMetricsAction,
+        help='record calls, durations and moved bytes of the forwarder hooks and write them to this file '
+             '(written on SIGUSR1, at exit and every --ssh-hook-metrics-interval seconds)'
+    )
+    parser.add_argument(
+        '--ssh-hook-metrics-format',
+        dest='ssh_hook_metrics_format',
+        default='prometheus',
+        choices=METRICS_FORMATS,
+        help='write the hook metrics in the prometheus text format or as a json snapshot (default: prometheus)'
+    )
+    parser.add_argument(
+        '--ssh-hook-metrics-interval',
+        dest='ssh_hook_metrics_interval',
+        default=0,
+        type=float,
+        help='seconds between writes of the hook metrics file (default: 0, only on SIGUSR1 and at exit)'
+    )
+
+
+class HookMetrics:
+    """instruments the forwarder hooks of one session
+
+    The hooks and the recv/send methods of both channels are replaced on the
+    forwarder instance only when ``--ssh-hook-metrics`` is given, without it
+    the forwarder runs unchanged. The counters are only updated by the thread
+    running the forwarder loop and are read without a lock, a snapshot may be
+    off by the call in progress.
+    """
+
+    registry = {}
+    ended = {}
+    registry_lock = threading.Lock()
+    writer = None
+    signal_handler_installed = False
+
+    @classmethod
+    def instrument(cls, forwarder):
+        """instrument ``forwarder`` if hook metrics are enabled, returns the HookMetrics or None"""
+        if not getattr(forwarder.args, 'ssh_hook_metrics', None):
+            return None
+        metrics = cls(forwarder)
+        with cls.registry_lock:
+            if cls.writer is None:
+                cls.writer = MetricsWriter(
+                    forwarder.args.ssh_hook_metrics,
+                    cls.collect,
+                    forwarder.args.ssh_hook_metrics_format,
+                    forwarder.args.ssh_hook_metrics_interval
+                )
+                cls.writer.start()
+            cls.registry[forwarder.session] = metrics
+        return metrics
+
+    @classmethod
+    def install_signal_handler(cls):
+        if cls.signal_handler_installed or not hasattr(signal, 'SIGUSR1'):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGUSR1, cls.dump)
+        cls.signal_handler_installed = True
+
+    @classmethod
+    def dump(cls, signum=None, frame=None):
+        """write the hook metrics file now"""
+        if cls.writer is not None:
+            cls.writer.trigger()
+        else:
+            logging.info("hook metrics are not collected yet")
+
+    @classmethod
+    def collect(cls):
+        """return the metric families of all instrumented forwarders"""
+        with cls.registry_lock:
+            for session, metrics in list(cls.registry.items()):
+                if not session.running:
+                    del cls.registry[session]
+                    for hook, stats in metrics.hooks.items():
+                        key = (metrics.plugin, hook)
+                        cls.ended.setdefault(key, HookStats()).merge(stats)
+            series = [
+                (str(session.sessionid), metrics.plugin, hook, stats.copy())
+                for session, metrics in cls.registry.items()
+                for hook, stats in metrics.hooks.items()
+            ]
+            series.extend(('ended', plugin, hook, stats.copy()) for (plugin, hook), stats in cls.ended.items())
+
+        families = [
+            Metric('ssh_mitm_hook_calls_total', 'counter', 'calls of the forwarder hook'),
+            Metric('ssh_mitm_hook_idle_calls_total', 'counter', 'calls which neither received nor sent data'),
+            Metric('ssh_mitm_hook_idle_ratio', 'gauge', 'share of the calls which neither received nor sent data'),
+            Metric('ssh_mitm_hook_received_bytes_total', 'counter', 'bytes received from the session channels'),
+            Metric('ssh_mitm_hook_sent_bytes_total', 'counter', 'bytes sent to the session channels'),
+            Metric('ssh_mitm_hook_seconds', 'histogram', 'time spent in the forwarder hook'),
+        ]
+        for session, plugin, hook, stats in series:
+            labels = {'session': session, 'plugin': plugin, 'hook': hook}
+            values = (
+                stats.calls,
+                stats.idle,
+                stats.idle / stats.calls if stats.calls else 0.0,
+                stats.bytes_in,
+                stats.bytes_out,
+                stats.duration,
+            )
+            for family, value in zip(families, values):
+                family.add(labels, value)
+        return families
+
+    def __init__(self, forwarder):
+        self.plugin = type(forwarder).__name__
+        self.hooks = {hook: HookStats() for hook in HOOKS}
+        self.thread = None
+        self.received = 0
+        self.sent = 0
+        for hook in HOOKS:
+            setattr(forwarder, hook, self.wrap_hook(self.hooks[hook], getattr(forwarder, hook)))
+        for channel in (forwarder.session.ssh_channel, forwarder.server_channel):
+            if channel is None:
+                continue
+            for name in ('recv', 'recv_stderr'):
+                setattr(channel, name, self.wrap_recv(getattr(channel, name)))
+            # sendall and sendall_stderr call these
+            for name in ('send', 'send_stderr'):
+                setattr(channel, name, self.wrap_send(getattr(channel, name)))
+
+    def wrap_hook(self, stats, hook):
+        def instrumented_hook():
+            self.thread = threading.get_ident()
+            received = self.received
+            sent = self.sent
+            started = time.perf_counter()
+            try:
+                return hook()
+            finally:
+                stats.duration.observe(time.perf_counter() - started)
+                stats.calls += 1
+                if self.received == received and self.sent == sent:
+                    stats.idle += 1
+                else:
+                    stats.bytes_in += self.received - received
+                    stats.bytes_out += self.sent - sent
+        return instrumented_hook
+
+    def wrap_recv(self, recv):
+        def instrumented_recv(nbytes):
+            data = recv(nbytes)
+            # only count what the forwarder loop moves, not injector threads
+            if threading.get_ident() == self.thread:
+                self.received += len(data)
+            return data
+        return instrumented_recv
+
+    def wrap_send(self, send):
+        def instrumented_send(data):
+            result = send(data)
+            if threading.get_ident() == self.thread:
+                self.sent += result
+            return result
+        return instrumented_send
@@ -0,0 +1,59 @@
+import functools
+import io
+import os
+import threading
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+
+KEY_TYPES = ('rsa', 'ecdsa', 'ed25519')
+
+_moduli_lock = threading.Lock()
+_moduli_loaded = None
+
+
+def load_server_moduli():
+    """load the group-exchange moduli once per process
+
+    paramiko keeps the modulus pack on the Transport class, so every transport
+    created afterwards supports group-exchange without parsing the file again.
+    """
+    global _moduli_loaded
+    with _moduli_lock:
+        if _moduli_loaded is None:
+            _moduli_loaded = paramiko.Transport.load_server_moduli()
+        return _moduli_loaded
+
+
+@functools.lru_cache(maxsize=None)
+def load_host_key(filename):
+    """parse a private host key file once and reuse it for every injector transport
+    """
+    filename = os.path.expanduser(filename)
+    error = None
+    for key_class in (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key):
+        try:
+            return key_class(filename=filename)
+        except paramiko.SSHException as e:
+            error = e
+    raise error
+
+
+def generate_host_key(key_type='rsa', bits=2048):
+    if key_type == 'rsa':
+        return paramiko.RSAKey.generate(bits=bits)
+    if key_type == 'ecdsa':
+        return paramiko.ECDSAKey.generate()
+    if key_type == 'ed25519':
+        # paramiko can not generate ed25519 keys, so the key is created with
+        # cryptography and loaded from its openssh serialization
+        private_key = ed25519.Ed25519PrivateKey.generate().private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.OpenSSH,
+            serialization.NoEncryption()
+        )
+        return paramiko.Ed25519Key(file_obj=io.StringIO(private_key.decode('ascii')))
+    raise ValueError("unsupported host key type: {}".format(key_type))
+
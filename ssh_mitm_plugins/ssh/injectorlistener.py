@@ -0,0 +1,158 @@
+import logging
+import selectors
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+
+
+class InjectorRouteServer(paramiko.ServerInterface):
+    """server interface which resolves the target session from the ssh username
+
+    Injector shells are not authenticated, the username only selects the session.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.forwarder = None
+        self.injector_channel = None
+
+    def route(self, username):
+        self.forwarder = self.listener.route(username)
+        if self.forwarder is None:
+            logging.warning("injector client requested unknown session %s", username)
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_none(self, username):
+        return self.route(username)
+
+    def check_auth_password(self, username, password):
+        return self.route(username)
+
+    def check_auth_publickey(self, username, key):
+        return self.route(username)
+
+    def get_allowed_auths(self, username):
+        return 'none,password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_shell_request(self, channel):
+        self.injector_channel = channel
+        return True
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+
+class InjectorListener(threading.Thread):
+    """single listener thread serving the injector endpoints of all sessions
+
+    Every bound address is registered with one selector. Sessions register
+    themselves by name and injector clients select the session with their ssh
+    username (e.g. ``ssh -p PORT SESSIONID@HOST``). The ssh handshake of an
+    accepted client runs on a small bounded worker pool, so idle sessions
+    neither hold a listening socket nor a thread.
+    """
+
+    HANDSHAKE_WORKERS = 4
+    # bounds of the banner exchange, key exchange and authentication of a client,
+    # a client which stalls the handshake blocks one of the few workers
+    HANDSHAKE_TIMEOUT = 10
+    # seconds an authenticated client may take to open the shell channel
+    ACCEPT_TIMEOUT = 10
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        super(InjectorListener, self).__init__(name="injector-listener", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.sockets = {}
+        self.routes = {}
+        self.routes_lock = threading.Lock()
+        self.handshakes = ThreadPoolExecutor(
+            max_workers=self.HANDSHAKE_WORKERS,
+            thread_name_prefix="injector-handshake"
+        )
+
+    def listen(self, network, port, host_key):
+        """bind an injector endpoint if it is not bound yet and return its address
+
+        ``host_key`` is a callable returning a host key, it is only called by
+        the first caller for an address. Its key is served to every injector
+        client of the address, so clients see the same host key on every
+        attach.
+        """
+        with self.routes_lock:
+            if (network, port) not in self.sockets:
+                key = host_key()
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind((network, port))
+                sock.listen(128)
+                sock.setblocking(False)
+                self.sockets[(network, port)] = sock
+                self.selector.register(sock, selectors.EVENT_READ, key)
+                if not self.is_alive():
+                    self.start()
+            return self.sockets[(network, port)].getsockname()
+
+    def register(self, name, forwarder):
+        with self.routes_lock:
+            self.routes[name] = forwarder
+
+    def unregister(self, name):
+        with self.routes_lock:
+            self.routes.pop(name, None)
+
+    def route(self, name):
+        with self.routes_lock:
+            return self.routes.get(name)
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    client, addr = key.fileobj.accept()
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    logging.exception("injector listener failed to accept a connection")
+                    continue
+                client.setblocking(True)
+                self.handshakes.submit(self.handshake, client, addr, key.data)
+
+    def handshake(self, client, addr, host_key):
+        t = paramiko.Transport(client)
+        t.banner_timeout = t.handshake_timeout = t.auth_timeout = self.HANDSHAKE_TIMEOUT
+        try:
+            t.set_gss_host(socket.getfqdn(""))
+            t.add_server_key(host_key)
+            inject_server = InjectorRouteServer(self)
+            t.start_server(server=inject_server)
+            injector_channel = t.accept(self.ACCEPT_TIMEOUT)
+        except (ConnectionResetError, EOFError, OSError, paramiko.SSHException):
+            logging.warning("injector handshake with %s failed", str(addr))
+            t.close()
+            return
+        if injector_channel is None or inject_server.forwarder is None:
+            t.close()
+            return
+        try:
+            inject_server.forwarder.injector_attach(addr, injector_channel)
+        except Exception:
+            logging.exception("failed to attach injector client %s", str(addr))
+            t.close()
@@ -1,14 +1,9 @@
 import logging
-import queue
-import select
 import threading
-import socket
-import time
 
 import paramiko
 
 from ssh_proxy_server.forwarders.ssh import SSHForwarder
-from ssh_proxy_server.plugins.ssh.mirrorshell import InjectServer
 
 
 class SSHInjectableForwarder(SSHForwarder):
@@ -16,114 +11,254 @@ class SSHInjectableForwarder(SSHForwarder):
     """
 
     HOST_KEY_LENGTH = 2048
+    # seconds to wait for the injector shells of a closed session to finish
+    SHELL_JOIN_TIMEOUT = 1.0
+    SHELLS_EXHAUSTED = "\r\n[INFO] too many injector shells attached, try again later\r\n"
 
     @classmethod
     def parser_arguments(cls):
+        from ssh_mitm_plugins.ssh.hookmetrics import add_hook_metrics_arguments
+        from ssh_mitm_plugins.ssh.hostkeys import KEY_TYPES
+        from ssh_mitm_plugins.ssh.mirror import OVERFLOW_POLICIES
+
         cls.parser().add_argument(
             '--ssh-injector-net',
             dest='ssh_injector_net',
             default='127.0.0.1',
             help='local address/interface where injector sessions are served'
         )
+        cls.parser().add_argument(
+            '--ssh-injector-port',
+            dest='ssh_injector_port',
+            default=0,
+            type=int,
+            help='port of the injector listener shared by all sessions (default: random port)'
+        )
         cls.parser().add_argument(
             '--ssh-injector-enable-mirror',
             dest='ssh_injector_enable_mirror',
             action="store_true",
             help='enables host session mirroring for the injector shell'
         )
+        cls.parser().add_argument(
+            '--ssh-injector-mirror-buffer',
+            dest='ssh_injector_mirror_buffer',
+            default=1048576,
+            type=int,
+            help='maximum number of mirrored bytes buffered for a slow injector shell'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-mirror-overflow',
+            dest='ssh_injector_mirror_overflow',
+            default='drop-oldest',
+            choices=OVERFLOW_POLICIES,
+            help='what to do when the mirror buffer of an injector shell is full'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-scrollback',
+            dest='ssh_injector_scrollback',
+            default=65536,
+            type=int,
+            help='bytes of recent session output replayed to a new mirrored injector shell (0 disables the replay)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-scrollback-total',
+            dest='ssh_injector_scrollback_total',
+            default=16777216,
+            type=int,
+            help='bytes of session output kept for replay by all sessions together (default: 16777216)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-queue-bytes',
+            dest='ssh_injector_queue_bytes',
+            default=1048576,
+            type=int,
+            help='bytes of queued input after which injector shells have to wait (default: 1048576)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-queue-entries',
+            dest='ssh_injector_queue_entries',
+            default=1024,
+            type=int,
+            help='queued inputs after which injector shells have to wait (default: 1024)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-max-shells',
+            dest='ssh_injector_max_shells',
+            default=256,
+            type=int,
+            help='injector shells attached to all sessions together, further shells are refused (default: 256)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-shell-workers',
+            dest='ssh_injector_shell_workers',
+            default=8,
+            type=int,
+            help='threads serving the input of all injector shells (default: 8)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-record',
+            dest='ssh_injector_record',
+            metavar='DIR',
+            help='record the sessions to indexed binary files in this directory (disabled by default)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-record-index',
+            dest='ssh_injector_record_index',
+            default=1.0,
+            type=float,
+            help='seconds between the time checkpoints of a session recording (default: 1.0)'
+        )
         cls.parser().add_argument(
             '--ssh-injectshell-key',
             dest='ssh_injectshell_key'
         )
+        cls.parser().add_argument(
+            '--ssh-injector-key-type',
+            dest='ssh_injector_key_type',
+            default='rsa',
+            choices=KEY_TYPES,
+            help='type of the generated injector host key (ecdsa and ed25519 are faster to generate than rsa)'
+        )
+        add_hook_metrics_arguments(cls.parser())
 
     def __init__(self, session):
+        from ssh_mitm_plugins.ssh.hookmetrics import HookMetrics
+        from ssh_mitm_plugins.ssh.hostkeys import load_server_moduli
+        from ssh_mitm_plugins.ssh.injectorlistener import InjectorListener
+        from ssh_mitm_plugins.ssh.inputqueue import InjectionQueue
+        from ssh_mitm_plugins.ssh.mirror import MirrorFanout
+        from ssh_mitm_plugins.ssh.recording import open_recorder
+        from ssh_mitm_plugins.ssh.scrollback import ScrollbackPool
+        from ssh_mitm_plugins.ssh.shellpool import ShellPool
+
         super(SSHInjectableForwarder, self).__init__(session)
-        self.injector_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.injector_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.injector_sock.bind((self.args.ssh_injector_net, 0))
-        self.injector_sock.listen(5)
+        load_server_moduli()
 
         self.mirror_enabled = self.args.ssh_injector_enable_mirror
-        self.queue = queue.Queue()
+        scrollback = None
+        if self.mirror_enabled and self.args.ssh_injector_scrollback > 0:
+            scrollback = ScrollbackPool.get(self.args.ssh_injector_scrollback_total).buffer(
+                self.args.ssh_injector_scrollback
+            )
+        self.mirror = MirrorFanout(
+            self.args.ssh_injector_mirror_buffer,
+            self.args.ssh_injector_mirror_overflow,
+            scrollback
+        )
+        self.queue = InjectionQueue(self.args.ssh_injector_queue_bytes, self.args.ssh_injector_queue_entries)
         self.sender = self.session.ssh_channel
         self.injector_shells = []
-        thread = threading.Thread(target=self.injector_connect)
-        thread.start()
-        self.conn_thread = thread
+        self.shells_lock = threading.Lock()
+        # set when the session ends, no shells are attached afterwards
+        self.closing = threading.Event()
+        self.shell_pool = ShellPool.get(self.args.ssh_injector_max_shells, self.args.ssh_injector_shell_workers)
 
-    def injector_connect(self):
-        inject_host, inject_port = self.injector_sock.getsockname()
+        self.injector_name = str(self.session.sessionid)
+        self.recorder = open_recorder(
+            self.args.ssh_injector_record,
+            self.injector_name,
+            self.args.ssh_injector_record_index
+        )
+        self.injector_listener = InjectorListener.get()
+        inject_host, inject_port = self.injector_listener.listen(
+            self.args.ssh_injector_net,
+            self.args.ssh_injector_port,
+            self.injector_host_key
+        )
+        self.injector_listener.register(self.injector_name, self)
         logging.info(
-            "created injector shell on port {port}. connect with: ssh -p {port} {host}".format(
+            "created injector shell on port {port}. connect with: ssh -p {port} {name}@{host}".format(
                 host=inject_host,
-                port=inject_port
+                port=inject_port,
+                name=self.injector_name
             )
         )
-        try:
-            while not self.session.ssh_channel.closed:
-                readable = select.select([self.injector_sock], [], [], 0.5)[0]
-                if len(readable) == 1 and readable[0] is self.injector_sock:
-                    client, addr = self.injector_sock.accept()
-
-                    t = paramiko.Transport(client)
-                    t.set_gss_host(socket.getfqdn(""))
-
-                    t.load_server_moduli()
-                    if self.args.ssh_injectshell_key:
-                        t.add_server_key(paramiko.RSAKey(filename=self.args.ssh_injectshell_key))
-                    else:
-                        t.add_server_key(paramiko.RSAKey.generate(bits=self.HOST_KEY_LENGTH))
-
-                    inject_server = InjectServer(self.server_channel)
-                    try:
-                        t.start_server(server=inject_server)
-                    except (ConnectionResetError, EOFError, paramiko.SSHException):
-                        t.close()
-                        continue
-                    injector_channel = None
-                    while not injector_channel:
-                        injector_channel = t.accept(0.5)
-                    injector_shell = InjectorShell(addr, injector_channel, self)
-                    injector_shell.start()
-                    self.injector_shells.append(injector_shell)
-                time.sleep(0.1)
-        except (paramiko.SSHException, OSError) as e:
-            logging.warning("injector connection suffered an unexpected error")
-            logging.exception(e)
-            self.close_session(self.channel)
+        self.hook_metrics = HookMetrics.instrument(self)
+
+    def injector_host_key(self):
+        from ssh_mitm_plugins.ssh.hostkeys import generate_host_key, load_host_key
+
+        if self.args.ssh_injectshell_key:
+            return load_host_key(self.args.ssh_injectshell_key)
+        return generate_host_key(self.args.ssh_injector_key_type, self.HOST_KEY_LENGTH)
+
+    def injector_attach(self, addr, injector_channel):
+        with self.shells_lock:
+            if self.closing.is_set() or self.session.ssh_channel.closed:
+                injector_channel.get_transport().close()
+                return
+            injector_shell = InjectorShell(addr, injector_channel, self)
+            admitted = self.shell_pool.admit(injector_shell)
+            if admitted:
+                self.injector_shells.append(injector_shell)
+        if not admitted:
+            logging.warning("refused injector shell %s, %d shells are attached", str(addr), self.shell_pool.attached())
+            injector_shell.refuse(self.SHELLS_EXHAUSTED)
 
     def forward_stdin(self):
         if self.session.ssh_channel.recv_ready():
             buf = self.session.ssh_channel.recv(self.BUF_LEN)
-            self.queue.put((buf, self.session.ssh_channel))
+            self.queue.put_client(buf, self.session.ssh_channel)
 
     def forward_stdout(self):
         if self.server_channel.recv_ready():
             buf = self.server_channel.recv(self.BUF_LEN)
+            if self.recorder is not None:
+                self.recorder.output(buf, self.sender is self.session.ssh_channel)
             self.sender.sendall(buf)
             if self.mirror_enabled and self.sender == self.session.ssh_channel:
-                for shell in self.injector_shells:
-                    if shell.client_channel is not self.sender:
-                        shell.client_channel.sendall(buf)
+                self.mirror.publish(buf)
 
     def forward_extra(self):
-        if not self.server_channel.recv_ready() and not self.session.ssh_channel.recv_ready() and not self.queue.empty():
-            msg, sender = self.queue.get()
+        if self.server_channel.recv_ready() or self.session.ssh_channel.recv_ready() or self.queue.empty():
+            return
+        entry = self.queue.get()
+        if entry is not None:
+            msg, sender = entry
             self.server_channel.sendall(msg)
             self.sender = sender
-            self.queue.task_done()
+            if self.recorder is not None:
+                self.recorder.input(msg, sender is self.session.ssh_channel)
+
+    def forward(self):
+        try:
+            super(SSHInjectableForwarder, self).forward()
+        finally:
+            # the forwarder loop ends without close_session when the session stops
+            self.release()
 
     def close_session(self, channel):
         super().close_session(channel)
-        for shell in self.injector_shells:
-            shell.join()
-        self.conn_thread.join()
-        self.injector_sock.close()
+        self.release()
+
+    def release(self):
+        """end the injector shells and stop serving the session, safe to call twice"""
+        with self.shells_lock:
+            if self.closing.is_set():
+                return
+            self.closing.set()
+            shells = list(self.injector_shells)
+        self.injector_listener.unregister(self.injector_name)
+        self.mirror.close()
+        # injector shells waiting for room in the queue give up
+        self.queue.close()
+        logging.debug("injector queue of %s: %s", self.injector_name, self.queue.stats())
+        if self.recorder is not None:
+            # the index is written by the recorder thread after the queued frames
+            self.recorder.close()
+        for shell in shells:
+            # the closed channel wakes up the shell pool, which finishes the shell
+            shell.client_channel.get_transport().close()
+        for shell in shells:
+            if not shell.finished.wait(self.SHELL_JOIN_TIMEOUT):
+                logging.warning("injector shell %s did not finish", str(shell.remote))
 
 
-class InjectorShell(threading.Thread):
+class InjectorShell:
+    """injector shell of a session, its input is served by the process-wide shell pool
+    """
 
-    BUF_LEN = 1024
     STEALTH_WARNING = """
 [INFO]\r
 This is a hidden shell injected into the secure session the original host created.\r
@@ -132,30 +267,63 @@ Exit the hidden shell with CTRL+C\r
 """
 
     def __init__(self, remote, client_channel, forwarder):
-        super(InjectorShell, self).__init__()
         self.remote = remote
         self.forwarder = forwarder
         self.queue = self.forwarder.queue
         self.client_channel = client_channel
+        self.finished = threading.Event()
+        # input which waits for room in the queue
+        self.parked = None
+
+    def open(self):
+        try:
+            self.client_channel.sendall(self.STEALTH_WARNING)
+        except (OSError, EOFError, paramiko.SSHException):
+            return False
+        # subscribed after the banner, the replayed scrollback follows it in one write
+        with self.forwarder.shells_lock:
+            if self.forwarder.closing.is_set():
+                return False
+            if self.forwarder.mirror_enabled:
+                self.forwarder.mirror.subscribe(self.client_channel)
+        return True
 
-    def run(self) -> None:
-        self.client_channel.sendall(self.STEALTH_WARNING)
+    def serve(self):
+        """forward the input of the injector client, False once the shell ends"""
+        if self.forwarder.closing.is_set():
+            return False
         try:
-            while not self.forwarder.session.ssh_channel.closed:
-                if self.client_channel.recv_ready():
-                    data = self.client_channel.recv(self.forwarder.BUF_LEN)
-                    if data == b'\x03':
-                        break
-                    self.queue.put((data, self.client_channel))
-                if self.client_channel.exit_status_ready():
-                    break
-                time.sleep(0.1)
+            if self.parked is None:
+                data = self.client_channel.recv(self.forwarder.BUF_LEN)
+                if not data or data == b'\x03':
+                    return False
+            else:
+                data, self.parked = self.parked, None
+            if not self.queue.put(data, self.client_channel, self.wake):
+                if self.queue.closed:
+                    return False
+                # the channel is not read until the queue has room, which stalls the injector client
+                self.parked = data
+                return self.forwarder.shell_pool.PARKED
+            return not self.client_channel.exit_status_ready()
         except paramiko.SSHException:
             logging.warning("injector shell %s with unexpected SSHError", str(self.remote))
-        finally:
-            self.terminate()
+            return False
+
+    def wake(self):
+        self.forwarder.shell_pool.wake(self)
+
+    def refuse(self, message):
+        try:
+            self.client_channel.sendall(message)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        self.client_channel.get_transport().close()
 
     def terminate(self):
-        if not self.forwarder.session.ssh_channel.closed:
-            self.forwarder.injector_shells.remove(self)
+        self.forwarder.mirror.unsubscribe(self.client_channel)
+        with self.forwarder.shells_lock:
+            if self in self.forwarder.injector_shells:
+                self.forwarder.injector_shells.remove(self)
         self.client_channel.get_transport().close()
+        self.finished.set()
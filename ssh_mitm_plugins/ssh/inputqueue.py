@@ -0,0 +1,115 @@
+import collections
+import threading
+
+
+class InjectionQueue:
+    """bounded input queue of an injector session
+
+    The input of the real client is kept apart and always dispatched first.
+    It is never blocked, the forwarder loop which reads it must not stall.
+    Injected input is dispatched in arrival order. ``put`` refuses input
+    while the queue holds more than ``max_bytes`` bytes or ``max_entries``
+    messages and calls back once there is room again. Until then the
+    injector shell stops reading its channel and the ssh flow control pushes
+    back on the injector client. A sender without queued input may always
+    add one message, so a runaway injector can not lock out the others.
+
+    ``get`` coalesces adjacent messages of the same sender into one write of
+    up to ``max_coalesce`` bytes.
+    """
+
+    def __init__(self, max_bytes=1048576, max_entries=1024, max_coalesce=32768):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_coalesce = max_coalesce
+        self.lock = threading.Lock()
+        # callbacks of the senders waiting for room
+        self.waiting = []
+        self.client = collections.deque()
+        self.injected = collections.deque()
+        # sender -> number of its queued messages
+        self.senders = collections.Counter()
+        self.size = 0
+        self.closed = False
+
+        self.max_size = 0
+        self.blocked = 0
+        self.coalesced = 0
+
+    def full(self):
+        return self.size > self.max_bytes or len(self.client) + len(self.injected) >= self.max_entries
+
+    def put_client(self, msg, sender):
+        """queue input of the real client, never blocks"""
+        with self.lock:
+            self.client.append((msg, sender))
+            self.size += len(msg)
+            self.max_size = max(self.max_size, self.size)
+
+    def put(self, msg, sender, on_space=None):
+        """queue injected input without waiting
+
+        Returns False if the queue is closed or full. If it is full,
+        ``on_space`` is called once by the thread which made room or closed
+        the queue, the sender has to offer the message again.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            if self.full() and self.senders[sender]:
+                self.blocked += 1
+                if on_space is not None:
+                    self.waiting.append(on_space)
+                return False
+            self.injected.append((msg, sender))
+            self.senders[sender] += 1
+            self.size += len(msg)
+            self.max_size = max(self.max_size, self.size)
+            return True
+
+    def empty(self):
+        return not self.client and not self.injected
+
+    def get(self):
+        """return the next (msg, sender) to dispatch or None if nothing is queued"""
+        with self.lock:
+            queue = self.client if self.client else self.injected
+            if not queue:
+                return None
+            msg, sender = queue.popleft()
+            parts = [msg]
+            length = len(msg)
+            while queue and queue[0][1] is sender and length + len(queue[0][0]) <= self.max_coalesce:
+                part, _ = queue.popleft()
+                parts.append(part)
+                length += len(part)
+            waiting = []
+            if queue is self.injected:
+                self.senders[sender] -= len(parts)
+                if not self.senders[sender]:
+                    del self.senders[sender]
+                    waiting, self.waiting = self.waiting, []
+            self.coalesced += len(parts) - 1
+            self.size -= length
+            if not self.full():
+                waiting, self.waiting = waiting + self.waiting, []
+        for on_space in waiting:
+            on_space()
+        return (msg if len(parts) == 1 else b''.join(parts)), sender
+
+    def close(self):
+        """call back all waiting senders, later puts are refused"""
+        with self.lock:
+            self.closed = True
+            waiting, self.waiting = self.waiting, []
+        for on_space in waiting:
+            on_space()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'blocked': self.blocked,
+                'coalesced': self.coalesced,
+            }
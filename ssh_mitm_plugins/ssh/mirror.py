@@ -0,0 +1,190 @@
+import collections
+import logging
+import threading
+import time
+
+import paramiko
+
+
+OVERFLOW_POLICIES = ('drop-oldest', 'coalesce', 'disconnect')
+
+
+class MirrorSubscriber(threading.Thread):
+    """bounded output buffer of one mirrored injector shell
+
+    ``publish`` never blocks, the buffered output is written to the injector
+    channel by this thread. When more than ``max_bytes`` are pending the
+    overflow policy decides what happens:
+
+    - drop-oldest: whole chunks are dropped from the head of the buffer
+    - coalesce: pending chunks are merged and only the newest ``max_bytes`` are kept
+    - disconnect: the subscriber is closed
+    """
+
+    def __init__(self, channel, max_bytes, policy='drop-oldest'):
+        super(MirrorSubscriber, self).__init__(name="injector-mirror", daemon=True)
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("unsupported mirror overflow policy: {}".format(policy))
+        self.channel = channel
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.chunks = collections.deque()
+        self.pending = 0
+        self.closed = False
+        self.disconnected = False
+        self.condition = threading.Condition()
+
+        self.sent_bytes = 0
+        self.dropped_bytes = 0
+        self.dropped_chunks = 0
+        self.max_lag_bytes = 0
+
+    def publish(self, data):
+        with self.condition:
+            if self.closed:
+                return
+            self.chunks.append((time.monotonic(), data))
+            self.pending += len(data)
+            if self.pending > self.max_bytes:
+                self.overflow()
+            self.max_lag_bytes = max(self.max_lag_bytes, self.pending)
+            self.condition.notify()
+            disconnect = self.disconnected
+        if disconnect:
+            # also releases a writer blocked in sendall on the stalled channel
+            try:
+                self.channel.close()
+            except (OSError, EOFError, paramiko.SSHException):
+                pass
+
+    def replay(self, data):
+        """queue output recorded before the subscription, the overflow policy does not apply"""
+        with self.condition:
+            if self.closed:
+                return
+            self.chunks.appendleft((time.monotonic(), data))
+            self.pending += len(data)
+            self.condition.notify()
+
+    def overflow(self):
+        if self.policy == 'disconnect':
+            logging.warning("mirror subscriber fell %d bytes behind, disconnecting", self.pending)
+            self.dropped_bytes += self.pending
+            self.dropped_chunks += len(self.chunks)
+            self.chunks.clear()
+            self.pending = 0
+            self.closed = True
+            self.disconnected = True
+        elif self.policy == 'coalesce':
+            timestamp = self.chunks[0][0]
+            data = b''.join(chunk for _, chunk in self.chunks)
+            self.dropped_bytes += len(data) - self.max_bytes
+            self.dropped_chunks += len(self.chunks) - 1
+            self.chunks.clear()
+            self.chunks.append((timestamp, data[-self.max_bytes:]))
+            self.pending = self.max_bytes
+        else:
+            while self.pending > self.max_bytes and len(self.chunks) > 1:
+                _, chunk = self.chunks.popleft()
+                self.pending -= len(chunk)
+                self.dropped_bytes += len(chunk)
+                self.dropped_chunks += 1
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.chunks and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    data = b''.join(chunk for _, chunk in self.chunks)
+                    self.chunks.clear()
+                    self.pending = 0
+                self.channel.sendall(data)
+                self.sent_bytes += len(data)
+        except (OSError, EOFError, paramiko.SSHException):
+            logging.debug("mirror subscriber %s stopped writing", self.channel)
+        finally:
+            self.close()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.chunks.clear()
+            self.pending = 0
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            lag_seconds = time.monotonic() - self.chunks[0][0] if self.chunks else 0.0
+            return {
+                'lag_bytes': self.pending,
+                'lag_seconds': lag_seconds,
+                'max_lag_bytes': self.max_lag_bytes,
+                'sent_bytes': self.sent_bytes,
+                'dropped_bytes': self.dropped_bytes,
+                'dropped_chunks': self.dropped_chunks,
+            }
+
+
+class MirrorFanout:
+    """fans the session output out to all mirrored injector shells without blocking
+
+    With a ``scrollback`` buffer the output is also recorded, a new
+    subscriber gets the recorded output in one write before the live output.
+    """
+
+    def __init__(self, max_bytes, policy='drop-oldest', scrollback=None):
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.scrollback = scrollback
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscriber = MirrorSubscriber(channel, self.max_bytes, self.policy)
+        with self.lock:
+            # taken under the lock, no output is missed or sent twice
+            if self.scrollback is not None:
+                recorded, _ = self.scrollback.snapshot()
+                if recorded:
+                    subscriber.replay(recorded)
+            self.subscribers[channel] = subscriber
+        subscriber.start()
+        return subscriber
+
+    def unsubscribe(self, channel):
+        with self.lock:
+            subscriber = self.subscribers.pop(channel, None)
+        if subscriber is None:
+            return
+        subscriber.close()
+        stats = subscriber.stats()
+        if stats['dropped_bytes']:
+            logging.info(
+                "mirror subscriber %s dropped %d bytes in %d chunks",
+                channel, stats['dropped_bytes'], stats['dropped_chunks']
+            )
+
+    def publish(self, data):
+        with self.lock:
+            if self.scrollback is not None:
+                self.scrollback.append(data)
+            subscribers = list(self.subscribers.values())
+        for subscriber in subscribers:
+            subscriber.publish(data)
+
+    def stats(self):
+        with self.lock:
+            subscribers = dict(self.subscribers)
+        return {str(channel): subscriber.stats() for channel, subscriber in subscribers.items()}
+
+    def close(self):
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+            self.subscribers.clear()
+        for subscriber in subscribers:
+            subscriber.close()
+        if self.scrollback is not None:
+            self.scrollback.close()
@@ -0,0 +1,109 @@
+import collections
+import re
+import time
+
+
+class PromptDetector:
+    """streaming detection of learned shell prompts
+
+    The detector keeps the last bytes of the server output between reads, so
+    a prompt split over two reads is still found. The session counts as idle
+    when the output ends with a learned prompt (trailing whitespace ignored).
+    Only the end of each read is looked at, so the cost per read does not
+    grow with its size. Prompts change with the working directory or the
+    user, so more than one prompt is remembered and new ones can be learned
+    from the last line of the output. Prompts which did not match for
+    ``MAX_PROMPT_AGE`` seconds are forgotten, the most recent one is kept.
+    """
+
+    # a changed prompt is only accepted if it ends like a prompt, this keeps
+    # questions like "Password:" from being taken for a prompt
+    PROMPT_ENDINGS = b'$#>%'
+    MAX_PROMPTS = 8
+    MAX_PROMPT_LEN = 512
+    MAX_PROMPT_AGE = 600
+    # the user@host part of a prompt, e.g. "[user@host" of "[user@host dir]$"
+    HOST = re.compile(rb'[^@]*@[^\s:/~\]]+')
+
+    def __init__(self):
+        # prompt -> time it matched last
+        self.prompts = collections.OrderedDict()
+        # end of the output without trailing whitespace and the whitespace itself
+        self.tail = b''
+        self.whitespace = b''
+
+    def learned(self):
+        return bool(self.prompts)
+
+    def learn(self, prompt):
+        prompt = prompt.strip()
+        if not prompt or len(prompt) > self.MAX_PROMPT_LEN:
+            return False
+        self.prompts[prompt] = time.monotonic()
+        self.prompts.move_to_end(prompt, last=False)
+        self.forget()
+        while len(self.prompts) > self.MAX_PROMPTS:
+            self.prompts.popitem()
+        return True
+
+    def forget(self):
+        """drop the prompts which did not match for MAX_PROMPT_AGE seconds"""
+        now = time.monotonic()
+        newest = max(self.prompts.values(), default=now)
+        for prompt, seen in list(self.prompts.items()):
+            if seen < newest and now - seen > self.MAX_PROMPT_AGE:
+                del self.prompts[prompt]
+
+    def feed(self, data):
+        """add server output and return True if the output ends with a prompt"""
+        stripped = data.rstrip()
+        if stripped:
+            self.tail = (self.tail + self.whitespace + stripped[-self.MAX_PROMPT_LEN:])[-self.MAX_PROMPT_LEN:]
+            self.whitespace = data[len(stripped):][-self.MAX_PROMPT_LEN:]
+        else:
+            self.whitespace = (self.whitespace + data)[-self.MAX_PROMPT_LEN:]
+        return self.at_prompt()
+
+    def at_prompt(self):
+        for prompt in self.prompts:
+            if self.tail.endswith(prompt):
+                self.prompts[prompt] = time.monotonic()
+                return True
+        return False
+
+    def last_line(self):
+        line = self.tail.rsplit(b'\n', 1)[-1]
+        return line.rsplit(b'\r', 1)[-1].strip()
+
+    def relearn(self):
+        """learn the last output line as prompt, used when the shell is known to wait for a command"""
+        line = self.last_line()
+        if not line or line in self.prompts:
+            return bool(line)
+        return self.learn(line)
+
+    def candidate(self):
+        """the last output line if it may be a changed prompt, otherwise None"""
+        line = self.last_line()
+        if not line or line in self.prompts:
+            return None
+        endings = self.PROMPT_ENDINGS + bytes(prompt[-1] for prompt in self.prompts)
+        if line[-1] not in endings:
+            return None
+        return line
+
+    def same_shape(self, line):
+        """True if the line has the user@host part and the ending of a learned prompt, e.g. after cd"""
+        for prompt in self.prompts:
+            host = self.HOST.match(prompt)
+            if host and line.startswith(host.group(0)) and line[-1] == prompt[-1]:
+                return True
+        return False
+
+    def confirmable(self, line):
+        """True if a line which repeats after a bare return is taken as prompt
+
+        Lines ending in > or % also need a user@host or a path, the prompts of
+        REPLs (>>>) and progress output (45%) repeat as well.
+        """
+        return line[-1:] in (b'$', b'#') or any(part in line for part in (b'@', b'/', b'~', b':'))
@@ -10,7 +10,14 @@ class SSHPuttyDoSForwarder(SSHForwarder):
     PuTTY-Changelog: https://www.chiark.greenend.org.uk/~sgtatham/putty/changes.html
     """
 
+    @classmethod
+    def parser_arguments(cls):
+        from ssh_mitm_plugins.ssh.hookmetrics import add_hook_metrics_arguments
+        add_hook_metrics_arguments(cls.parser())
+
     def __init__(self, session):
+        from ssh_mitm_plugins.ssh.hookmetrics import HookMetrics
+
         super().__init__(session)
         self.exploit = [
             "PS1=''",
@@ -20,6 +27,7 @@ class SSHPuttyDoSForwarder(SSHForwarder):
             "done"
         ]
         self.executed = False
+        self.hook_metrics = HookMetrics.instrument(self)
 
     def forward_extra(self):
         if not self.executed:
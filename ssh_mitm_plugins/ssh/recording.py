@@ -0,0 +1,329 @@
+import bisect
+import collections
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+SOURCE_CLIENT = 0
+SOURCE_SERVER = 1
+SOURCE_INJECTOR = 2
+SOURCES = ('client', 'server', 'injector')
+
+TO_SERVER = 0
+TO_CLIENT = 1
+TO_INJECTOR = 2
+DIRECTIONS = ('server', 'client', 'injector')
+
+MAGIC = b'SSHMITMR'
+INDEX_MAGIC = b'SSHMITMX'
+VERSION = 1
+# magic, version, start of the recording, index interval, length of the session name
+HEADER = struct.Struct('<8sHddH')
+# timestamp, source, direction, length of the data
+FRAME = struct.Struct('<dBBI')
+# timestamp and offset of a frame
+INDEX_ENTRY = struct.Struct('<dQ')
+# offset of the index, time checkpoints, injected frames, magic
+FOOTER = struct.Struct('<QII8s')
+
+Frame = collections.namedtuple('Frame', 'offset timestamp source direction data')
+
+
+def open_recorder(directory, name, index_interval):
+    """recorder of a session or None if recording is disabled or the file cannot be created"""
+    if not directory:
+        return None
+    path = os.path.join(directory, '{}.sshrec'.format(name))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        recorder = SessionRecorder(path, name, index_interval)
+    except OSError:
+        logging.exception("failed to create session recording %s", path)
+        return None
+    logging.info("recording session %s to %s", name, path)
+    return recorder
+
+
+class RecordingWriter(threading.Thread):
+    """process-wide thread which writes the frames of all session recordings
+
+    The forwarders only put the frames into a queue, the files are written
+    and flushed in batches by this thread.
+    """
+
+    BATCH = 1024
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        super(RecordingWriter, self).__init__(name="session-recorder", daemon=True)
+        self.queue = queue.SimpleQueue()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.BATCH:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            written = set()
+            for recorder, frame in batch:
+                if frame is None:
+                    recorder.finish()
+                    written.discard(recorder)
+                else:
+                    recorder.write(*frame)
+                    written.add(recorder)
+            for recorder in written:
+                recorder.flush()
+
+
+class SessionRecorder:
+    """appends the traffic of a session to a binary recording
+
+    Every frame carries a timestamp, the source (client, server or injector)
+    and the direction of the data. A time checkpoint is taken every
+    ``index_interval`` seconds or ``INDEX_BYTES`` of recording, the
+    checkpoints and the offsets of all injected frames are written as index
+    at the end of the file when the recording is closed. ``record`` only
+    queues the frame, the file is written by the ``RecordingWriter`` thread.
+    """
+
+    INDEX_BYTES = 1024 * 1024
+    # queued bytes after which frames are dropped instead of stalling the session
+    MAX_PENDING = 64 * 1024 * 1024
+
+    def __init__(self, path, name, index_interval=1.0):
+        self.path = path
+        self.index_interval = index_interval
+        self.file = open(path, 'wb')
+        name = name.encode('utf-8')
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time(), index_interval, len(name)) + name)
+        self.offset = HEADER.size + len(name)
+        self.checkpoints = []
+        self.injected = []
+        self.writer = RecordingWriter.get()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.closed = False
+        self.failed = False
+        self.done = threading.Event()
+
+        self.frames = 0
+        self.dropped = 0
+
+    def record(self, source, direction, data):
+        if not data:
+            return
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # queued under the lock, so no frame follows the close of the recording
+        with self.lock:
+            if self.closed:
+                return
+            if self.pending > self.MAX_PENDING:
+                self.dropped += 1
+                return
+            self.pending += len(data)
+            self.writer.queue.put((self, (time.time(), source, direction, data)))
+
+    def input(self, data, from_client):
+        """record input sent to the server by the client or an injector shell"""
+        self.record(SOURCE_CLIENT if from_client else SOURCE_INJECTOR, TO_SERVER, data)
+
+    def output(self, data, to_client):
+        """record output of the server sent to the client or an injector shell"""
+        self.record(SOURCE_SERVER, TO_CLIENT if to_client else TO_INJECTOR, data)
+
+    def close(self):
+        """write the index and close the file once the queued frames are written"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.writer.queue.put((self, None))
+
+    def write(self, timestamp, source, direction, data):
+        with self.lock:
+            self.pending -= len(data)
+        if self.failed:
+            return
+        if (
+            not self.checkpoints
+            or timestamp - self.checkpoints[-1][0] >= self.index_interval
+            or self.offset - self.checkpoints[-1][1] >= self.INDEX_BYTES
+        ):
+            self.checkpoints.append((timestamp, self.offset))
+        if source == SOURCE_INJECTOR:
+            self.injected.append((timestamp, self.offset))
+        try:
+            self.file.write(FRAME.pack(timestamp, source, direction, len(data)))
+            self.file.write(data)
+        except OSError:
+            self.fail()
+            return
+        self.offset += FRAME.size + len(data)
+        self.frames += 1
+
+    def flush(self):
+        if self.failed:
+            return
+        try:
+            self.file.flush()
+        except OSError:
+            self.fail()
+
+    def finish(self):
+        try:
+            if not self.failed:
+                index = [INDEX_ENTRY.pack(*entry) for entry in self.checkpoints + self.injected]
+                self.file.write(b''.join(index))
+                self.file.write(FOOTER.pack(self.offset, len(self.checkpoints), len(self.injected), INDEX_MAGIC))
+            self.file.close()
+        except OSError:
+            self.fail()
+        if self.dropped:
+            logging.warning("session recording %s dropped %d frames", self.path, self.dropped)
+        self.done.set()
+
+    def fail(self):
+        logging.exception("session recording %s failed, recording stopped", self.path)
+        self.failed = True
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'bytes': self.offset,
+            'checkpoints': len(self.checkpoints),
+            'injected': len(self.injected),
+            'dropped': self.dropped,
+        }
+
+
+class SessionRecording:
+    """memory mapped reader of a session recording
+
+    The index at the end of the file is loaded when the recording is opened,
+    ``seek`` bisects the time checkpoints and reads at most the frames of one
+    checkpoint interval. A recording which was not closed, e.g. after a
+    crash, has no index, it is rebuilt with a single scan of the frame
+    headers and ``complete`` is False.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError("{} is not a session recording".format(path))
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise ValueError("{} is not a session recording".format(path))
+        magic, version, self.started, self.index_interval, name_length = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("{} is not a session recording".format(path))
+        self.name = self.map[HEADER.size:HEADER.size + name_length].decode('utf-8', errors='replace')
+        self.start = HEADER.size + name_length
+        self.complete = self.load_index()
+        if not self.complete:
+            self.rebuild_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def load_index(self):
+        size = len(self.map)
+        if size < self.start + FOOTER.size:
+            return False
+        end, checkpoints, injected, magic = FOOTER.unpack_from(self.map, size - FOOTER.size)
+        if magic != INDEX_MAGIC or end + (checkpoints + injected) * INDEX_ENTRY.size + FOOTER.size != size:
+            return False
+        entries = list(INDEX_ENTRY.iter_unpack(self.map[end:size - FOOTER.size]))
+        self.end = end
+        self.checkpoint_times = [timestamp for timestamp, _ in entries[:checkpoints]]
+        self.checkpoint_offsets = [offset for _, offset in entries[:checkpoints]]
+        self.injected = [offset for _, offset in entries[checkpoints:]]
+        return True
+
+    def rebuild_index(self):
+        """index a recording without footer, the last incomplete frame is ignored"""
+        size = len(self.map)
+        self.checkpoint_times = []
+        self.checkpoint_offsets = []
+        self.injected = []
+        offset = self.start
+        while offset + FRAME.size <= size:
+            timestamp, source, _, length = FRAME.unpack_from(self.map, offset)
+            if offset + FRAME.size + length > size:
+                break
+            if (
+                not self.checkpoint_times
+                or timestamp - self.checkpoint_times[-1] >= self.index_interval
+                or offset - self.checkpoint_offsets[-1] >= SessionRecorder.INDEX_BYTES
+            ):
+                self.checkpoint_times.append(timestamp)
+                self.checkpoint_offsets.append(offset)
+            if source == SOURCE_INJECTOR:
+                self.injected.append(offset)
+            offset += FRAME.size + length
+        self.end = offset
+
+    def frame_at(self, offset):
+        timestamp, source, direction, length = FRAME.unpack_from(self.map, offset)
+        data_start = offset + FRAME.size
+        return Frame(offset, timestamp, source, direction, self.map[data_start:data_start + length])
+
+    def seek(self, timestamp):
+        """offset of the first frame recorded at or after ``timestamp``"""
+        index = bisect.bisect_right(self.checkpoint_times, timestamp) - 1
+        offset = self.checkpoint_offsets[index] if index >= 0 else self.start
+        while offset < self.end:
+            frame_time, _, _, length = FRAME.unpack_from(self.map, offset)
+            if frame_time >= timestamp:
+                break
+            offset += FRAME.size + length
+        return offset
+
+    def frames(self, start=None, end=None, offset=None):
+        """the frames from ``start`` (or ``offset``) up to before ``end``, timestamps in seconds since the epoch"""
+        if offset is None:
+            offset = self.start if start is None else self.seek(start)
+        while offset < self.end:
+            frame = self.frame_at(offset)
+            if end is not None and frame.timestamp >= end:
+                return
+            yield frame
+            offset += FRAME.size + len(frame.data)
+
+    def injected_frames(self):
+        """the frames sent to the server by injector shells"""
+        for offset in self.injected:
+            yield self.frame_at(offset)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
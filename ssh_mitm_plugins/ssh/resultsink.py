@@ -0,0 +1,103 @@
+import atexit
+import collections
+import gzip
+import json
+import logging
+import os
+import threading
+
+
+COMPRESSIONS = ('none', 'gzip')
+
+
+class ResultSink(threading.Thread):
+    """appends records to a JSON Lines file from a background thread
+
+    ``put`` only queues the record, serialization and writing happen in the
+    sink thread, which writes everything queued since its last write at once.
+    All sessions writing to the same path share one sink and one file. With
+    gzip compression every batch is appended as its own gzip member, so the
+    file can be appended to and read while it is written.
+    """
+
+    MAX_PENDING = 100000
+
+    sinks = {}
+    sinks_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path, compression='none'):
+        path = os.path.abspath(os.path.expanduser(path))
+        with cls.sinks_lock:
+            sink = cls.sinks.get(path)
+            if sink is None:
+                sink = cls(path, compression)
+                sink.start()
+                cls.sinks[path] = sink
+            return sink
+
+    def __init__(self, path, compression='none'):
+        super(ResultSink, self).__init__(name="result-sink", daemon=True)
+        if compression not in COMPRESSIONS:
+            raise ValueError("unsupported result compression: {}".format(compression))
+        self.path = path
+        self.compression = compression
+        self.records = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.written = 0
+        self.dropped = 0
+        atexit.register(self.close)
+
+    def put(self, record):
+        """queue a record without blocking, returns False if it was dropped"""
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.records) >= self.MAX_PENDING:
+                if not self.dropped:
+                    logging.warning("result sink %s can not keep up, dropping records", self.path)
+                self.dropped += 1
+                return False
+            self.records.append(record)
+            self.condition.notify()
+        return True
+
+    def encode(self, records):
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        if self.compression == 'gzip':
+            # a complete member, readers never see a stream that ends mid-member
+            return gzip.compress(data)
+        return data
+
+    def run(self):
+        try:
+            with open(self.path, 'ab') as output:
+                while True:
+                    with self.condition:
+                        while not self.records and not self.closed:
+                            self.condition.wait()
+                        if not self.records:
+                            break
+                        records = list(self.records)
+                        self.records.clear()
+                    output.write(self.encode(records))
+                    output.flush()
+                    self.written += len(records)
+        except OSError:
+            logging.exception("result sink %s failed", self.path)
+            with self.condition:
+                self.closed = True
+                self.dropped += len(self.records)
+                self.records.clear()
+
+    def close(self):
+        """write the queued records and stop the sink"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        with self.sinks_lock:
+            if self.sinks.get(self.path) is self:
+                del self.sinks[self.path]
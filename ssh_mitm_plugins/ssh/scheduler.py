@@ -0,0 +1,105 @@
+import collections
+import logging
+import threading
+import time
+
+
+class InjectionScheduler:
+    """dispatch order for the input of a stealth session
+
+    Input with priority 0 (the user's own keystrokes) is always dispatchable.
+    Everything else is parked until the session is idle. Lower priorities go
+    first, senders of the same priority are served round robin and each
+    sender's input keeps its arrival order, so parked input is never taken
+    out and put back.
+
+    Parked input older than ``timeout`` seconds is dropped and reported to
+    ``on_expire(msg, sender, waited)``.
+    """
+
+    USER_PRIORITY = 0
+
+    def __init__(self, timeout=None, on_expire=None):
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.lock = threading.Lock()
+        # priority -> sender -> deque of (enqueue time, msg)
+        self.queues = {}
+        self.idle = True
+        self.depth = 0
+
+        self.max_depth = 0
+        self.dispatched = 0
+        self.expired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def put(self, priority, msg, sender):
+        with self.lock:
+            senders = self.queues.setdefault(priority, collections.OrderedDict())
+            senders.setdefault(sender, collections.deque()).append((time.monotonic(), msg))
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+    def set_idle(self, idle):
+        self.idle = idle
+
+    def pending(self):
+        return self.depth > 0
+
+    def get(self):
+        """return the next dispatchable (priority, msg, sender) or None"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            if self.timeout:
+                self.expire(now, expired)
+            entry = None
+            for priority in sorted(self.queues):
+                if priority != self.USER_PRIORITY and not self.idle:
+                    break
+                senders = self.queues[priority]
+                if not senders:
+                    continue
+                sender, messages = next(iter(senders.items()))
+                enqueued, msg = messages.popleft()
+                if messages:
+                    senders.move_to_end(sender)
+                else:
+                    del senders[sender]
+                self.depth -= 1
+                self.dispatched += 1
+                self.wait_total += now - enqueued
+                self.wait_max = max(self.wait_max, now - enqueued)
+                entry = (priority, msg, sender)
+                break
+        for msg, sender, waited in expired:
+            logging.debug("injected input of %s expired after %.1fs", sender, waited)
+            if self.on_expire is not None:
+                self.on_expire(msg, sender, waited)
+        return entry
+
+    def expire(self, now, expired):
+        for priority, senders in self.queues.items():
+            if priority == self.USER_PRIORITY:
+                continue
+            for sender in list(senders):
+                messages = senders[sender]
+                while messages and now - messages[0][0] > self.timeout:
+                    enqueued, msg = messages.popleft()
+                    expired.append((msg, sender, now - enqueued))
+                    self.depth -= 1
+                    self.expired += 1
+                if not messages:
+                    del senders[sender]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'dispatched': self.dispatched,
+                'expired': self.expired,
+                'dispatch_wait_avg': self.wait_total / self.dispatched if self.dispatched else 0.0,
+                'dispatch_wait_max': self.wait_max,
+            }
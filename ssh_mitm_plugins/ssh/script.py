@@ -0,0 +1,247 @@
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from ssh_mitm_plugins.ssh.promptdetector import PromptDetector
+
+
+SCRIPT_MODES = ('line', 'prompt', 'marker')
+
+_scripts_lock = threading.Lock()
+_scripts = {}
+
+
+def parse_script(text):
+    """split a script into commands
+
+    Blank lines and comments are skipped, lines continued with a backslash
+    are kept together as one command.
+    """
+    commands = []
+    current = []
+    for line in text.splitlines():
+        if not current and (not line.strip() or line.lstrip().startswith('#')):
+            continue
+        current.append(line)
+        if not line.endswith('\\'):
+            commands.append('\n'.join(current))
+            current = []
+    if current:
+        commands.append('\n'.join(current))
+    return tuple(commands)
+
+
+class Script:
+    """a script file split into lines and commands, shared by all sessions"""
+
+    def __init__(self, path, mtime, text):
+        self.path = path
+        self.mtime = mtime
+        self.lines = tuple(text.splitlines(keepends=True))
+        self.commands = parse_script(text)
+
+
+def load_script(path):
+    """return the parsed script, the file is only read again when its mtime changed
+
+    Sessions keep their own position in the script, so a session which
+    already started continues with the version it started with.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    mtime = os.stat(path).st_mtime_ns
+    with _scripts_lock:
+        script = _scripts.get(path)
+        if script is None or script.mtime != mtime:
+            with open(path, 'r') as f:
+                script = Script(path, mtime, f.read())
+            _scripts[path] = script
+            logging.debug("loaded script %s with %d commands", path, len(script.commands))
+        return script
+
+
+class CommandResult:
+    """output and timing of one script command"""
+
+    def __init__(self, index, command):
+        self.index = index
+        self.command = command
+        self.output = b''
+        self.started = None
+        self.finished = None
+        self.exit_status = None
+        self.complete = False
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def text(self):
+        return self.output.decode('utf-8', errors='replace')
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'command': self.command,
+            'output': self.text(),
+            'duration': self.duration,
+            'exit_status': self.exit_status,
+            'complete': self.complete,
+        }
+
+
+class ScriptExecution:
+    """runs script commands in a shell and splits the output per command
+
+    In ``prompt`` mode one command is sent at a time and it is finished when
+    the shell shows its prompt again. A prompt changed by a command, e.g. by
+    ``cd``, is learned once the output settled if it has the user@host part
+    and the ending of the prompt before. In ``marker`` mode up to ``batch_size``
+    commands are sent at once, each followed by an ``echo`` of a marker with
+    the exit status, and the output is split at the markers.
+
+    ``feed`` takes the server output (without escape sequences), ``poll``
+    returns the input to send next. Finished commands are passed to
+    ``on_result``. A command without a prompt or marker after ``timeout``
+    seconds is finished as incomplete.
+    """
+
+    # seconds without output after which the last line is taken as the prompt
+    PROMPT_SETTLE_TIME = 0.2
+
+    def __init__(self, commands, mode='prompt', batch_size=1, timeout=30.0, on_result=None):
+        if mode not in SCRIPT_MODES[1:]:
+            raise ValueError("unsupported script execution mode: {}".format(mode))
+        self.mode = mode
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.on_result = on_result
+        self.commands = commands
+        # results of the sent commands
+        self.results = []
+        # commands before ``sent`` were sent, commands before ``current`` are finished
+        self.sent = 0
+        self.current = 0
+        self.buffer = b''
+        self.scanned = 0
+        self.ready = False
+        self.last_output = time.monotonic()
+        self.prompts = PromptDetector()
+        self.marker_prefix = '__SSHMITM_{}_'.format(uuid.uuid4().hex[:8])
+        # the echoed marker command shows ``$?``, only the real output has digits
+        self.marker = re.compile(re.escape(self.marker_prefix.encode()) + rb'(\d+)_(\d+)__')
+
+    def done(self):
+        return self.current >= len(self.commands)
+
+    def feed(self, data, now=None):
+        now = time.monotonic() if now is None else now
+        self.last_output = now
+        at_prompt = self.prompts.feed(data)
+        if not self.ready or self.current >= self.sent:
+            return
+        self.buffer += data
+        if self.mode == 'prompt':
+            if at_prompt:
+                output, self.buffer = self.buffer, b''
+                self.finish(output, now, complete=True)
+            return
+        while self.current < self.sent:
+            match = self.marker.search(self.buffer, self.scanned)
+            if match is None:
+                # a marker may be split between two reads
+                self.scanned = max(0, len(self.buffer) - len(self.marker_prefix) - 40)
+                return
+            index = int(match.group(1))
+            if index < self.current:
+                # marker of a command which already timed out
+                self.buffer = self.buffer[match.end():]
+                self.scanned = 0
+                continue
+            while self.current < index:
+                self.finish(b'', now, complete=False)
+            output, self.buffer = self.buffer[:match.start()], self.buffer[match.end():]
+            self.scanned = 0
+            self.finish(output, now, complete=True, exit_status=int(match.group(2)))
+
+    def poll(self, now=None):
+        """return the input to send to the shell or None"""
+        now = time.monotonic() if now is None else now
+        if not self.ready:
+            if now - self.last_output < self.PROMPT_SETTLE_TIME:
+                return None
+            # the shell is waiting for input, its last line is the prompt
+            self.prompts.relearn()
+            self.ready = True
+        if self.current < self.sent:
+            result = self.results[self.current]
+            if self.mode == 'prompt' and now - self.last_output >= self.PROMPT_SETTLE_TIME and self.changed_prompt():
+                output, self.buffer = self.buffer, b''
+                self.finish(output, now, complete=True)
+            elif self.timeout and now - result.started > self.timeout:
+                output, self.buffer, self.scanned = self.buffer, b'', 0
+                self.finish(output, now, complete=False)
+            return None
+        if self.sent >= len(self.commands):
+            return None
+        count = 1 if self.mode == 'prompt' else self.batch_size
+        lines = []
+        for index in range(self.sent, min(self.sent + count, len(self.commands))):
+            result = CommandResult(index, self.commands[index])
+            result.started = now
+            self.results.append(result)
+            lines.append(result.command + '\n')
+            if self.mode == 'marker':
+                lines.append('echo {}{}_$?__\n'.format(self.marker_prefix, index))
+        self.sent = len(self.results)
+        self.buffer = b''
+        self.scanned = 0
+        return ''.join(lines).encode('utf-8')
+
+    def abort(self, now=None):
+        """finish the sent commands as incomplete, e.g. when the session ends during the script"""
+        now = time.monotonic() if now is None else now
+        output, self.buffer, self.scanned = self.buffer, b'', 0
+        while self.current < self.sent:
+            self.finish(output, now, complete=False)
+            output = b''
+
+    def changed_prompt(self):
+        """learn the settled last line as prompt if it looks like a learned one, e.g. after cd"""
+        candidate = self.prompts.candidate()
+        if candidate is None or not self.prompts.same_shape(candidate):
+            return False
+        logging.debug("script learned new prompt %s", candidate)
+        return self.prompts.learn(candidate)
+
+    def finish(self, output, now, complete, exit_status=None):
+        result = self.results[self.current]
+        result.output = self.clean(result.command, output)
+        result.finished = now
+        result.complete = complete
+        result.exit_status = exit_status
+        self.current += 1
+        if self.current < self.sent:
+            # pipelined commands start when the one before them is finished
+            self.results[self.current].started = now
+        if self.on_result is not None:
+            self.on_result(result)
+
+    def clean(self, command, output):
+        """remove the echoed input and the prompt from a command's output"""
+        marker_prefix = self.marker_prefix.encode()
+        lines = [line for line in output.split(b'\n') if marker_prefix not in line]
+        echo = command.splitlines()[-1].strip().encode('utf-8')
+        for index, line in enumerate(lines[:3]):
+            if echo and line.rstrip().endswith(echo):
+                del lines[:index + 1]
+                break
+        if self.mode == 'prompt' and lines and self.prompts.at_prompt():
+            last = lines[-1].strip()
+            if any(last.endswith(prompt) for prompt in self.prompts.prompts):
+                del lines[-1]
+        return b'\n'.join(lines).strip(b'\r\n')
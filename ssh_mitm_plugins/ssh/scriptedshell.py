@@ -1,6 +1,7 @@
+import io
 import logging
 import os
-import re
+import time
 
 from ssh_proxy_server.forwarders.ssh import SSHForwarder
 
@@ -11,6 +12,10 @@ class SSHScriptedForwarder(SSHForwarder):
 
     @classmethod
     def parser_arguments(cls):
+        from ssh_mitm_plugins.ssh.hookmetrics import add_hook_metrics_arguments
+        from ssh_mitm_plugins.ssh.resultsink import COMPRESSIONS
+        from ssh_mitm_plugins.ssh.script import SCRIPT_MODES
+
         cls.parser().add_argument(
             '--ssh-script',
             dest='ssh_script',
@@ -23,41 +28,168 @@ class SSHScriptedForwarder(SSHForwarder):
             help='script output directory',
             default='.'
         )
+        cls.parser().add_argument(
+            '--ssh-out-format',
+            dest='ssh_out_format',
+            default='text',
+            choices=('text', 'jsonl'),
+            help='one text file per session (text) or one JSON Lines file for all sessions (jsonl)'
+        )
+        cls.parser().add_argument(
+            '--ssh-out-compression',
+            dest='ssh_out_compression',
+            default='none',
+            choices=COMPRESSIONS,
+            help='compression of the JSON Lines output'
+        )
+        cls.parser().add_argument(
+            '--ssh-script-mode',
+            dest='ssh_script_mode',
+            default='line',
+            choices=SCRIPT_MODES,
+            help='send one script line per forwarder tick (line), one command per shell prompt (prompt) '
+                 'or batches of commands separated by echoed markers (marker)'
+        )
+        cls.parser().add_argument(
+            '--ssh-script-batch-size',
+            dest='ssh_script_batch_size',
+            default=1,
+            type=int,
+            help='number of commands sent at once in marker mode'
+        )
+        cls.parser().add_argument(
+            '--ssh-script-command-timeout',
+            dest='ssh_script_command_timeout',
+            default=30.0,
+            type=float,
+            help='seconds to wait for the prompt or marker after a command (0 waits forever)'
+        )
+        add_hook_metrics_arguments(cls.parser())
 
     def __init__(self, session):
+        from ssh_mitm_plugins.ssh.ansi import AnsiFilter
+        from ssh_mitm_plugins.ssh.hookmetrics import HookMetrics
+        from ssh_mitm_plugins.ssh.resultsink import ResultSink
+        from ssh_mitm_plugins.ssh.script import ScriptExecution, load_script
+
         super(SSHScriptedForwarder, self).__init__(session)
         self.executing = False
-        self.script = open(os.path.expanduser(self.args.ssh_script), "r")
-        self.output = open(os.path.expanduser(os.path.join(self.args.ssh_out_dir, str(self.session))), "w+")
+        self.finished = False
+        self.ansi_filter = AnsiFilter()
+        script = load_script(self.args.ssh_script)
+        # position of the session in the shared script
+        self.script_lines = None
+        self.execution = None
+        if self.args.ssh_script_mode == 'line':
+            self.script_lines = iter(script.lines)
+        else:
+            self.execution = ScriptExecution(
+                script.commands,
+                self.args.ssh_script_mode,
+                self.args.ssh_script_batch_size,
+                self.args.ssh_script_command_timeout,
+                self.write_result
+            )
+        self.sink = None
+        if self.args.ssh_out_format == 'jsonl':
+            filename = 'scriptedshell.jsonl' + ('.gz' if self.args.ssh_out_compression == 'gzip' else '')
+            self.sink = ResultSink.get(os.path.join(self.args.ssh_out_dir, filename), self.args.ssh_out_compression)
+            # the output of line mode is collected and queued as one record
+            self.output = io.StringIO()
+        else:
+            self.output = open(os.path.expanduser(os.path.join(self.args.ssh_out_dir, str(self.session))), "w+")
+        self.hook_metrics = HookMetrics.instrument(self)
 
     def forward_stdin(self):
         if self.executing:
-            line = self.script.readline()
+            if self.execution is not None:
+                self.execute_commands()
+                return
+            line = next(self.script_lines, "")
             logging.debug(line)
             if line == "" and not self.server_channel.recv_ready():
-                logging.debug("Script: Shutting down")
-                self.executing = False
-                self.script.close()
-                self.output.close()
-                # Resets Shell prompt for user (OpenSSH server's "Last Login" message is omitted)
-                self.server_channel.sendall(b'\n')
+                self.finish_script()
             elif line != "":
                 self.server_channel.sendall(line)
             return
-        if not self.executing and not self.script.closed and self.server_channel.recv_ready():
+        if not self.executing and not self.finished and self.server_channel.recv_ready():
             logging.debug("Script: Starting")
             self.executing = True
         super(SSHScriptedForwarder, self).forward_stdin()
 
+    def execute_commands(self):
+        data = self.execution.poll(time.monotonic())
+        if data:
+            self.server_channel.sendall(data)
+        elif self.execution.done():
+            self.finish_script()
+
+    def finish_script(self):
+        logging.debug("Script: Shutting down")
+        self.write_output(complete=True)
+        # Resets Shell prompt for user (OpenSSH server's "Last Login" message is omitted)
+        self.server_channel.sendall(b'\n')
+
+    def write_output(self, complete):
+        """write the remaining output, commands without a prompt or marker yet are written as incomplete"""
+        self.executing = False
+        self.finished = True
+        if self.execution is not None:
+            self.execution.abort(time.monotonic())
+        self.output.write(self.ansi_filter.flush())
+        if self.sink is not None and self.execution is None:
+            self.sink.put({
+                'session': str(self.session),
+                'timestamp': time.time(),
+                'index': None,
+                'command': None,
+                'output': self.output.getvalue(),
+                'complete': complete,
+            })
+        self.output.close()
+
+    def write_result(self, result):
+        if self.sink is not None:
+            record = {'session': str(self.session), 'timestamp': time.time()}
+            record.update(result.to_dict())
+            self.sink.put(record)
+            return
+        if result.complete:
+            status = "{:.3f}s".format(result.duration)
+            if result.exit_status is not None:
+                status += ", exit status {}".format(result.exit_status)
+        else:
+            status = "incomplete after {:.3f}s".format(result.duration)
+        self.output.write("$ {} ({})\n{}\n".format(result.command, status, result.text()))
+
     def stdout(self, text):
-        # https://stackoverflow.com/a/38662876
-        def escape_ansi(line):
-            ansi_escape = re.compile(r'(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]')
-            return ansi_escape.sub('', line)
         if self.executing:
-            self.output.write(escape_ansi(text.decode('utf-8')))
-            return ""
+            if self.execution is not None:
+                self.execution.feed(self.ansi_filter.filter(text), time.monotonic())
+                return b""
+            # escape sequences and characters split between reads are completed by the next read
+            self.output.write(self.ansi_filter.decode(text))
+            return b""
         return text
 
+    def forward(self):
+        try:
+            super(SSHScriptedForwarder, self).forward()
+        finally:
+            # the forwarder loop ends without close_session when the session stops
+            self.release()
+
     def close_session(self, channel):
         super().close_session(channel)
+        self.release()
+
+    def release(self):
+        """keep the output of a script the session ended in the middle of, safe to call twice"""
+        if self.finished:
+            return
+        if self.executing:
+            logging.debug("Script: session ended before the script finished")
+            self.write_output(complete=False)
+            return
+        self.finished = True
+        self.output.close()
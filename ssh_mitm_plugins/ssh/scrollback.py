@@ -0,0 +1,109 @@
+import collections
+import threading
+import time
+
+
+class ScrollbackPool:
+    """process-wide memory cap of the scrollback buffers of all sessions
+
+    Chunks are tracked in the order they were recorded. When all buffers
+    together hold more than ``max_bytes``, the oldest output of any session is
+    dropped first. All buffers share the lock of the pool, which keeps the
+    eviction across sessions free of lock ordering problems.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, max_bytes):
+        """the pool of the process, the first caller decides its size"""
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls(max_bytes)
+            return cls._instance
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (scrollback, sequence number) of every recorded chunk, oldest first
+        self.order = collections.deque()
+        self.size = 0
+        self.chunks = 0
+
+    def buffer(self, max_bytes):
+        return Scrollback(self, max_bytes)
+
+    def recorded(self, scrollback, seq, length):
+        """account a new chunk, called with the pool lock held"""
+        self.order.append((scrollback, seq))
+        self.size += length
+        self.chunks += 1
+        while self.size > self.max_bytes and self.order:
+            owner, seq = self.order.popleft()
+            owner.drop(seq)
+        if len(self.order) > 2 * self.chunks + 1024:
+            # chunks trimmed by their own buffer are still listed here
+            self.order = collections.deque((owner, seq) for owner, seq in self.order if owner.holds(seq))
+
+    def released(self, length):
+        self.size -= length
+        self.chunks -= 1
+
+
+class Scrollback:
+    """ring buffer of the recent output of one session
+
+    Keeps the newest ``max_bytes`` of output as (timestamp, data) chunks,
+    fewer if the process-wide pool runs full. ``snapshot`` returns the
+    buffered output for a late joining injector shell.
+    """
+
+    def __init__(self, pool, max_bytes):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        # (sequence number, timestamp, data), the sequence numbers are contiguous
+        self.chunks = collections.deque()
+        self.size = 0
+        self.seq = 0
+        self.closed = False
+
+    def append(self, data):
+        if not data or self.max_bytes <= 0:
+            return
+        data = data[-self.max_bytes:]
+        with self.pool.lock:
+            if self.closed:
+                return
+            self.seq += 1
+            self.chunks.append((self.seq, time.time(), data))
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self.drop_oldest()
+            self.pool.recorded(self, self.seq, len(data))
+
+    def drop_oldest(self):
+        _, _, data = self.chunks.popleft()
+        self.size -= len(data)
+        self.pool.released(len(data))
+
+    def holds(self, seq):
+        return bool(self.chunks) and self.chunks[0][0] <= seq
+
+    def drop(self, seq):
+        """drop the chunk ``seq`` if it is still buffered, called by the pool"""
+        if self.chunks and self.chunks[0][0] == seq:
+            self.drop_oldest()
+
+    def snapshot(self):
+        """the buffered output and the time it started, or (b'', None)"""
+        with self.pool.lock:
+            if not self.chunks:
+                return b'', None
+            return b''.join(data for _, _, data in self.chunks), self.chunks[0][1]
+
+    def close(self):
+        with self.pool.lock:
+            self.closed = True
+            while self.chunks:
+                self.drop_oldest()
@@ -0,0 +1,160 @@
+import collections
+import logging
+import selectors
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ssh_mitm_plugins.ssh.wakeup import Wakeup
+
+
+class ShellPool(threading.Thread):
+    """process-wide service for the injector shells of all sessions
+
+    One selector thread watches the channels of all attached shells. When
+    input arrives the channel is taken out of the selector and a worker of a
+    bounded pool calls ``shell.serve()``, afterwards the channel is watched
+    again. So every shell is served by at most one worker at a time and the
+    number of threads does not grow with the number of attached shells.
+    Shells beyond ``max_shells`` are refused by ``admit``.
+
+    A shell provides ``client_channel``, ``open()`` which returns False if
+    the shell could not be started, ``serve()`` and ``terminate()``.
+    ``serve()`` returns False once the shell is finished and must not block.
+    A shell which has to wait, e.g. for room in a full input queue, returns
+    ``PARKED``: its channel is not watched until the shell calls ``wake``.
+    """
+
+    # returned by serve() of a shell which waits for wake()
+    PARKED = 'parked'
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, max_shells=256, workers=8):
+        """the pool of the process, the first caller decides its limits"""
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls(max_shells, workers)
+            return cls._instance
+
+    def __init__(self, max_shells, workers):
+        super(ShellPool, self).__init__(name="injector-shells", daemon=True)
+        self.max_shells = max_shells
+        self.selector = selectors.DefaultSelector()
+        self.wakeup = Wakeup()
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="injector-shell")
+        # registry of the attached shells of all sessions
+        self.lock = threading.Lock()
+        self.shells = set()
+        # shells whose channel is watched again by the selector thread
+        self.resume = collections.deque()
+        # parked shells and shells woken up before they were parked
+        self.parked = set()
+        self.woken = set()
+
+        self.admitted = 0
+        self.refused = 0
+        self.max_attached = 0
+
+    def admit(self, shell):
+        """start serving a shell, False if the limit of attached shells is reached"""
+        with self.lock:
+            if len(self.shells) >= self.max_shells:
+                self.refused += 1
+                return False
+            self.shells.add(shell)
+            self.admitted += 1
+            self.max_attached = max(self.max_attached, len(self.shells))
+            if not self.is_alive():
+                self.start()
+        self.workers.submit(self.open, shell)
+        return True
+
+    def attached(self):
+        with self.lock:
+            return len(self.shells)
+
+    def open(self, shell):
+        try:
+            started = shell.open()
+        except Exception:
+            logging.exception("failed to start injector shell")
+            started = False
+        if started:
+            self.watch(shell)
+        else:
+            self.finish(shell)
+
+    def serve(self, shell):
+        try:
+            result = shell.serve()
+        except Exception:
+            logging.exception("injector shell failed")
+            result = False
+        if result is self.PARKED:
+            self.park(shell)
+        elif result:
+            self.watch(shell)
+        else:
+            self.finish(shell)
+
+    def park(self, shell):
+        with self.lock:
+            if shell not in self.woken:
+                self.parked.add(shell)
+                return
+            self.woken.discard(shell)
+        self.workers.submit(self.serve, shell)
+
+    def wake(self, shell):
+        """serve a parked shell again, may be called before its serve() returned"""
+        with self.lock:
+            if shell not in self.parked:
+                self.woken.add(shell)
+                return
+            self.parked.discard(shell)
+        self.workers.submit(self.serve, shell)
+
+    def watch(self, shell):
+        with self.lock:
+            self.resume.append(shell)
+        self.wakeup.set()
+
+    def finish(self, shell):
+        try:
+            shell.terminate()
+        finally:
+            with self.lock:
+                self.shells.discard(shell)
+                self.parked.discard(shell)
+                self.woken.discard(shell)
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeup:
+                    continue
+                self.selector.unregister(key.fileobj)
+                self.workers.submit(self.serve, key.data)
+            # cleared before the shells are taken, a later watch sets it again
+            self.wakeup.clear()
+            with self.lock:
+                resume = list(self.resume)
+                self.resume.clear()
+            for shell in resume:
+                try:
+                    self.selector.register(shell.client_channel, selectors.EVENT_READ, shell)
+                except (KeyError, OSError, ValueError):
+                    self.workers.submit(self.finish, shell)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'attached': len(self.shells),
+                'parked': len(self.parked),
+                'max_attached': self.max_attached,
+                'admitted': self.admitted,
+                'refused': self.refused,
+            }
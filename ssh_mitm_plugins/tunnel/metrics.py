@@ -0,0 +1,136 @@
+import threading
+import time
+
+from ssh_mitm_plugins.metrics import DURATION_BUCKETS, LATENCY_BUCKETS, Histogram, Metric
+
+
+class TunnelMetrics:
+    """traffic of the client tunnel connections of one session to one destination
+
+    Connections count their own bytes in ``bytes_in`` (from the destination)
+    and ``bytes_out`` (to the destination), which keeps locks off the relay
+    path. The counts of open connections are read when the metrics are
+    collected, those of closed connections are added up here. The metrics of
+    ended sessions are merged into one series per destination.
+    """
+
+    registry = {}
+    ended = {}
+    registry_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, session, destination):
+        key = (session, destination)
+        with cls.registry_lock:
+            metrics = cls.registry.get(key)
+            if metrics is None:
+                metrics = cls.registry[key] = cls(session, destination)
+            return metrics
+
+    @classmethod
+    def collect(cls):
+        """return the metric families of all tunnels"""
+        with cls.registry_lock:
+            for key, metrics in list(cls.registry.items()):
+                if metrics.finished():
+                    del cls.registry[key]
+                    ended = cls.ended.get(metrics.destination)
+                    if ended is None:
+                        ended = cls.ended[metrics.destination] = cls(None, metrics.destination)
+                    ended.merge(metrics.snapshot())
+            snapshots = [metrics.snapshot() for metrics in cls.registry.values()]
+            snapshots.extend(metrics.snapshot() for metrics in cls.ended.values())
+
+        families = [
+            Metric('ssh_mitm_tunnel_received_bytes_total', 'counter', 'bytes received from the destination'),
+            Metric('ssh_mitm_tunnel_sent_bytes_total', 'counter', 'bytes sent to the destination'),
+            Metric('ssh_mitm_tunnel_channels_opened_total', 'counter', 'direct-tcpip channels opened'),
+            Metric('ssh_mitm_tunnel_channels_failed_total', 'counter', 'direct-tcpip channels the client refused'),
+            Metric('ssh_mitm_tunnel_connections_active', 'gauge', 'tunnel connections currently relayed'),
+            Metric('ssh_mitm_tunnel_channel_open_seconds', 'histogram', 'time to open a direct-tcpip channel'),
+            Metric('ssh_mitm_tunnel_connection_duration_seconds', 'histogram', 'duration of closed tunnel connections'),
+        ]
+        for snapshot in snapshots:
+            labels = {
+                'session': 'ended' if snapshot.session is None else str(snapshot.session.sessionid),
+                'destination': snapshot.destination,
+            }
+            values = (
+                snapshot.bytes_in,
+                snapshot.bytes_out,
+                snapshot.channels_opened,
+                snapshot.channels_failed,
+                len(snapshot.connections),
+                snapshot.open_latency,
+                snapshot.duration,
+            )
+            for family, value in zip(families, values):
+                family.add(labels, value)
+        return families
+
+    def __init__(self, session, destination):
+        self.session = session
+        self.destination = destination
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.channels_opened = 0
+        self.channels_failed = 0
+        self.open_latency = Histogram(LATENCY_BUCKETS)
+        self.duration = Histogram(DURATION_BUCKETS)
+
+    def channel_opened(self, latency):
+        with self.lock:
+            self.channels_opened += 1
+            self.open_latency.observe(latency)
+
+    def channel_failed(self, latency):
+        with self.lock:
+            self.channels_failed += 1
+            self.open_latency.observe(latency)
+
+    def data_sent(self, length):
+        """account bytes sent to the destination outside of a connection"""
+        with self.lock:
+            self.bytes_out += length
+
+    def connection_started(self, connection):
+        """start accounting a connection with ``bytes_in`` and ``bytes_out`` attributes"""
+        connection.started = time.monotonic()
+        with self.lock:
+            self.connections.add(connection)
+
+    def connection_closed(self, connection):
+        with self.lock:
+            if connection not in self.connections:
+                return
+            self.connections.discard(connection)
+            self.bytes_in += connection.bytes_in
+            self.bytes_out += connection.bytes_out
+            self.duration.observe(time.monotonic() - connection.started)
+
+    def finished(self):
+        return self.session is not None and not self.session.running and not self.connections
+
+    def snapshot(self):
+        """return a copy including the bytes of the open connections"""
+        snapshot = TunnelMetrics(self.session, self.destination)
+        with self.lock:
+            snapshot.connections = set(self.connections)
+            snapshot.bytes_in = self.bytes_in + sum(c.bytes_in for c in self.connections)
+            snapshot.bytes_out = self.bytes_out + sum(c.bytes_out for c in self.connections)
+            snapshot.channels_opened = self.channels_opened
+            snapshot.channels_failed = self.channels_failed
+            snapshot.open_latency = self.open_latency.copy()
+            snapshot.duration = self.duration.copy()
+        return snapshot
+
+    def merge(self, other):
+        with self.lock:
+            self.bytes_in += other.bytes_in
+            self.bytes_out += other.bytes_out
+            self.channels_opened += other.channels_opened
+            self.channels_failed += other.channels_failed
+            self.open_latency.merge(other.open_latency)
+            self.duration.merge(other.duration)
@@ -0,0 +1,139 @@
+import ipaddress
+import socket
+
+
+SOCKS_VERSION = 5
+SOCKS_NO_AUTH = 0
+SOCKS_NO_ACCEPTABLE_METHOD = 0xff
+SOCKS_CONNECT = 1
+SOCKS_IPV4 = 1
+SOCKS_DOMAIN = 3
+SOCKS_IPV6 = 4
+
+SOCKS_SUCCEEDED = 0
+SOCKS_GENERAL_FAILURE = 1
+SOCKS_COMMAND_NOT_SUPPORTED = 7
+SOCKS_ADDRESS_TYPE_NOT_SUPPORTED = 8
+
+HTTP_MAX_HEADER = 8192
+
+
+class ProxyError(Exception):
+    pass
+
+
+def parse_destination(target):
+    """parse ``host:port`` or ``[ipv6]:port``, returns None if the target is invalid"""
+    host, sep, port = target.rpartition(':')
+    if not sep or not host or not port.isdigit() or not 0 < int(port) < 65536:
+        return None
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    return host, int(port)
+
+
+def recv_exact(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ProxyError("connection closed during proxy handshake")
+        data += chunk
+    return data
+
+
+def read_socks5_request(sock):
+    """negotiate a SOCKS5 CONNECT request (the version byte was already read)
+
+    Returns the requested destination, the reply is sent with
+    ``socks5_reply`` once the channel is open or failed.
+    """
+    methods = recv_exact(sock, recv_exact(sock, 1)[0])
+    if SOCKS_NO_AUTH not in methods:
+        sock.sendall(bytes([SOCKS_VERSION, SOCKS_NO_ACCEPTABLE_METHOD]))
+        raise ProxyError("SOCKS5 client does not offer authentication method 'none'")
+    sock.sendall(bytes([SOCKS_VERSION, SOCKS_NO_AUTH]))
+
+    version, command, _, address_type = recv_exact(sock, 4)
+    if version != SOCKS_VERSION:
+        raise ProxyError("invalid SOCKS5 request version {}".format(version))
+    if address_type == SOCKS_IPV4:
+        host = str(ipaddress.IPv4Address(recv_exact(sock, 4)))
+    elif address_type == SOCKS_IPV6:
+        host = str(ipaddress.IPv6Address(recv_exact(sock, 16)))
+    elif address_type == SOCKS_DOMAIN:
+        host = recv_exact(sock, recv_exact(sock, 1)[0]).decode('idna')
+    else:
+        sock.sendall(socks5_reply(SOCKS_ADDRESS_TYPE_NOT_SUPPORTED))
+        raise ProxyError("unsupported SOCKS5 address type {}".format(address_type))
+    port = int.from_bytes(recv_exact(sock, 2), 'big')
+    if command != SOCKS_CONNECT:
+        sock.sendall(socks5_reply(SOCKS_COMMAND_NOT_SUPPORTED))
+        raise ProxyError("unsupported SOCKS5 command {}".format(command))
+    return host, port
+
+
+def socks5_reply(status):
+    # the bound address is meaningless for a tunnelled connection
+    return bytes([SOCKS_VERSION, status, 0, SOCKS_IPV4, 0, 0, 0, 0, 0, 0])
+
+
+def read_http_connect(sock, data):
+    """read a HTTP CONNECT request starting with ``data``
+
+    Returns the destination and the bytes the client sent after the request.
+    """
+    while b'\r\n\r\n' not in data:
+        if len(data) > HTTP_MAX_HEADER:
+            raise ProxyError("HTTP CONNECT request too long")
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ProxyError("connection closed during proxy handshake")
+        data += chunk
+    header, _, rest = data.partition(b'\r\n\r\n')
+    request = header.split(b'\r\n', 1)[0].decode('latin-1').split()
+    if len(request) != 3 or request[0] != 'CONNECT':
+        sock.sendall(b'HTTP/1.1 405 Method Not Allowed\r\nAllow: CONNECT\r\n\r\n')
+        raise ProxyError("unsupported HTTP proxy request {!r}".format(' '.join(request[:1])))
+    destination = parse_destination(request[1])
+    if destination is None:
+        sock.sendall(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+        raise ProxyError("invalid HTTP CONNECT destination {!r}".format(request[1]))
+    return destination, rest
+
+
+def http_connect_reply(success):
+    if success:
+        return b'HTTP/1.1 200 Connection established\r\n\r\n'
+    return b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
+
+
+class ProxyRequest:
+    """the destination a SOCKS5 or HTTP CONNECT client asked for"""
+
+    def __init__(self, protocol, destination, pending=b''):
+        self.protocol = protocol
+        self.destination = destination
+        # data the client sent after its request
+        self.pending = pending
+
+    @classmethod
+    def read(cls, sock):
+        first = recv_exact(sock, 1)
+        if first[0] == SOCKS_VERSION:
+            return cls('socks5', read_socks5_request(sock))
+        if first.isalpha():
+            # any other HTTP method is answered with 405 Method Not Allowed
+            destination, pending = read_http_connect(sock, first)
+            return cls('http', destination, pending)
+        raise ProxyError("unsupported proxy protocol (first byte {!r})".format(first))
+
+    def reply(self, sock, success):
+        try:
+            if self.protocol == 'socks5':
+                sock.sendall(socks5_reply(SOCKS_SUCCEEDED if success else SOCKS_GENERAL_FAILURE))
+            else:
+                sock.sendall(http_connect_reply(success))
+        except (OSError, socket.timeout):
+            return False
+        return True
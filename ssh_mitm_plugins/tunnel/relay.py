@@ -0,0 +1,314 @@
+import collections
+import concurrent.futures
+import functools
+import logging
+import selectors
+import socket
+import threading
+
+import paramiko
+
+from ssh_mitm_plugins.ssh.wakeup import Wakeup
+
+
+class RelayConnection:
+    """a local socket and the direct-tcpip channel it is relayed to"""
+
+    def __init__(self, sock, channel, metrics=None):
+        self.sock = sock
+        self.channel = channel
+        self.metrics = metrics
+        # data read from one side which the other side did not accept yet
+        self.to_channel = b''
+        self.to_sock = b''
+        self.sock_eof = False
+        self.channel_eof = False
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class TunnelRelay(threading.Thread):
+    """relays all client tunnel connections of the process on one selector loop
+
+    The loop accepts local connections, reads sockets with ``recv_into`` into
+    one preallocated buffer and only writes what the other side accepts, the
+    rest is kept per connection until it can be written. paramiko channels
+    have no write readiness, so connections waiting for the remote window
+    are retried every ``RETRY_INTERVAL`` seconds. Opening a channel takes a
+    round trip to the server and is done by a small pool of threads. Proxy
+    requests are read by a separate pool, so clients which are slow to send
+    them do not hold up opening the channels of other connections.
+    """
+
+    BUF_LEN = 65536
+    OPEN_WORKERS = 8
+    HANDSHAKE_WORKERS = 32
+    RETRY_INTERVAL = 0.01
+    # seconds between checks for listeners of finished sessions
+    SWEEP_INTERVAL = 1.0
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        super(TunnelRelay, self).__init__(name="tunnel-relay", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.buffer = bytearray(self.BUF_LEN)
+        self.view = memoryview(self.buffer)
+        self.openers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.OPEN_WORKERS,
+            thread_name_prefix="tunnel-open"
+        )
+        self.handshakers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.HANDSHAKE_WORKERS,
+            thread_name_prefix="tunnel-handshake"
+        )
+        self.calls = collections.deque()
+        self.wakeup = Wakeup()
+        self.selector.register(self.wakeup, selectors.EVENT_READ, ('wakeup', None))
+        self.listeners = {}
+        self.connections = set()
+        # connections waiting for the remote window of their channel
+        self.blocked = set()
+
+    def call_soon(self, function, *args):
+        """run ``function`` on the relay thread"""
+        self.calls.append((function, args))
+        self.wakeup.set()
+
+    def listen(self, network, port, connect, alive=None, handshake=None):
+        """listen on ``network:port`` and relay connections to ``connect(client, addr)``
+
+        ``connect`` runs in the opener pool and returns the channel to relay
+        the client socket to or None and the TunnelMetrics of the connection
+        or None.
+
+        ``handshake(client, addr)`` runs in the handshake pool before
+        ``connect``. It returns what the client requested, which is passed to
+        ``connect`` as ``request``, or None to close the connection.
+
+        ``alive()`` returning False closes the listener, returns the bound address.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((network, port))
+        sock.listen(128)
+        sock.setblocking(False)
+        self.call_soon(self.add_listener, sock, connect, alive, handshake)
+        return sock.getsockname()
+
+    def add_listener(self, sock, connect, alive, handshake=None):
+        self.listeners[sock] = alive
+        self.selector.register(sock, selectors.EVENT_READ, ('listen', (connect, handshake)))
+
+    def close_listener(self, sock):
+        self.listeners.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except KeyError:
+            pass
+        sock.close()
+
+    def run(self):
+        while True:
+            timeout = self.RETRY_INTERVAL if self.blocked else self.SWEEP_INTERVAL
+            for key, mask in self.selector.select(timeout):
+                kind, data = key.data
+                try:
+                    if kind == 'wakeup':
+                        self.run_calls()
+                    elif kind == 'listen':
+                        self.accept(key.fileobj, data)
+                    elif kind == 'sock':
+                        self.sock_ready(data, mask)
+                    elif kind == 'channel':
+                        self.channel_ready(data)
+                except Exception:
+                    logging.exception("tunnel relay failed to handle %s event", kind)
+                    if kind in ('sock', 'channel'):
+                        self.close(data)
+            for connection in list(self.blocked):
+                self.flush_to_channel(connection)
+            self.sweep()
+
+    def run_calls(self):
+        self.wakeup.clear()
+        while self.calls:
+            function, args = self.calls.popleft()
+            function(*args)
+
+    def sweep(self):
+        for sock, alive in list(self.listeners.items()):
+            if alive is not None and not alive():
+                self.close_listener(sock)
+
+    def accept(self, listener, callbacks):
+        try:
+            client, addr = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        alive = self.listeners.get(listener)
+        if alive is not None and not alive():
+            client.close()
+            self.close_listener(listener)
+            return
+        connect, handshake = callbacks
+        if handshake is None:
+            self.openers.submit(self.open, client, addr, connect)
+        else:
+            self.handshakers.submit(self.handshake, client, addr, connect, handshake)
+
+    def handshake(self, client, addr, connect, handshake):
+        try:
+            request = handshake(client, addr)
+        except Exception:
+            logging.exception("tunnel handshake with %s failed", addr)
+            request = None
+        if request is None:
+            client.close()
+            return
+        self.openers.submit(self.open, client, addr, functools.partial(connect, request=request))
+
+    def open(self, client, addr, connect):
+        try:
+            channel, metrics = connect(client, addr)
+        except Exception:
+            logging.exception("could not open tunnel channel for %s", addr)
+            channel = None
+        if channel is None:
+            client.close()
+            return
+        self.call_soon(self.attach, client, channel, metrics)
+
+    def attach(self, client, channel, metrics=None):
+        client.setblocking(False)
+        channel.setblocking(False)
+        connection = RelayConnection(client, channel, metrics)
+        if metrics is not None:
+            metrics.connection_started(connection)
+        self.connections.add(connection)
+        self.selector.register(client, selectors.EVENT_READ, ('sock', connection))
+        self.selector.register(channel, selectors.EVENT_READ, ('channel', connection))
+
+    def sock_ready(self, connection, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush_to_sock(connection)
+        if mask & selectors.EVENT_READ and not connection.closed and not connection.to_channel:
+            try:
+                length = connection.sock.recv_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.close(connection)
+                return
+            if not length:
+                connection.sock_eof = True
+            else:
+                connection.bytes_out += length
+                connection.to_channel = self.view[:length]
+                self.flush_to_channel(connection)
+                if connection.to_channel:
+                    # keep what is left, the buffer is reused by the next read
+                    connection.to_channel = bytes(connection.to_channel)
+        self.update(connection)
+
+    def channel_ready(self, connection):
+        if connection.closed or connection.to_sock:
+            return
+        try:
+            data = connection.channel.recv(self.BUF_LEN)
+        except socket.timeout:
+            return
+        if not data:
+            connection.channel_eof = True
+        else:
+            connection.bytes_in += len(data)
+            connection.to_sock = data
+            self.flush_to_sock(connection)
+        self.update(connection)
+
+    def flush_to_channel(self, connection):
+        if connection.closed or not connection.to_channel:
+            self.blocked.discard(connection)
+            return
+        try:
+            sent = connection.channel.send(connection.to_channel)
+        except socket.timeout:
+            sent = 0
+        except (OSError, EOFError, paramiko.SSHException):
+            self.close(connection)
+            return
+        connection.to_channel = connection.to_channel[sent:]
+        if connection.to_channel:
+            self.blocked.add(connection)
+        else:
+            self.blocked.discard(connection)
+            self.update(connection)
+
+    def flush_to_sock(self, connection):
+        if connection.closed or not connection.to_sock:
+            return
+        try:
+            sent = connection.sock.send(connection.to_sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(connection)
+            return
+        connection.to_sock = connection.to_sock[sent:]
+
+    def update(self, connection):
+        """register the events a connection waits for, close it when it is done"""
+        if connection.closed:
+            return
+        if (connection.sock_eof and not connection.to_channel) or (connection.channel_eof and not connection.to_sock):
+            self.close(connection)
+            return
+        events = 0
+        if not connection.to_channel and not connection.sock_eof:
+            events |= selectors.EVENT_READ
+        if connection.to_sock:
+            events |= selectors.EVENT_WRITE
+        self.set_events(connection.sock, events, connection, 'sock')
+        self.set_events(connection.channel, 0 if connection.to_sock else selectors.EVENT_READ, connection, 'channel')
+
+    def set_events(self, fileobj, events, connection, kind):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            key = None
+        if not events:
+            if key is not None:
+                self.selector.unregister(fileobj)
+        elif key is None:
+            self.selector.register(fileobj, events, (kind, connection))
+        elif key.events != events:
+            self.selector.modify(fileobj, events, (kind, connection))
+
+    def close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        if connection.metrics is not None:
+            connection.metrics.connection_closed(connection)
+        self.connections.discard(connection)
+        self.blocked.discard(connection)
+        for fileobj in (connection.sock, connection.channel):
+            try:
+                self.selector.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+        connection.sock.close()
+        try:
+            connection.channel.close()
+        except (OSError, EOFError, paramiko.SSHException):
+            pass